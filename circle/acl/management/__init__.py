@@ -6,7 +6,7 @@ from django.apps import apps
 from django.db import DEFAULT_DB_ALIAS
 from django.core.exceptions import ImproperlyConfigured
 
-from ..models import Level, AclBase
+from ..models import Level, AclBase, touch_levels
 
 
 def create_levels(app_config, verbosity=False, using=DEFAULT_DB_ALIAS,
@@ -67,9 +67,13 @@ def create_levels(app_config, verbosity=False, using=DEFAULT_DB_ALIAS,
         print("All: [%s]." % ", ".join(unicode(l) for l in all_levels))
 
     # set weights
+    changed = []
     for ctype, codename, weight in level_weights:
-        Level.objects.filter(codename=codename,
-                             content_type=ctype).update(weight=weight)
+        levels = Level.objects.filter(codename=codename, content_type=ctype)
+        if levels.exclude(weight=weight).update(weight=weight):
+            changed.extend(levels.values_list('pk', flat=True))
+    if changed:
+        touch_levels(changed)
 
 
 signals.post_migrate.connect(
@@ -0,0 +1,135 @@
+# Copyright 2014 Budapest University of Technology and Economics (BME IK)
+#
+# This file is part of CIRCLE Cloud.
+#
+# CIRCLE is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# CIRCLE is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along
+# with CIRCLE.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import unicode_literals, absolute_import
+
+from random import Random
+from time import time
+
+from django.contrib.auth.models import User, Group
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.test.utils import override_settings
+
+from acl.models import ObjectLevel, rebuild_effective_levels
+from vm.models import Lease
+
+
+class Rollback(Exception):
+    pass
+
+
+class Command(BaseCommand):
+    help = ('Compare listing the objects accessible by users with and '
+            'without materialized levels on synthetic data.  The data is '
+            'rolled back.')
+
+    def add_arguments(self, parser):
+
+        parser.add_argument('--objects',
+                            action='store',
+                            dest='objects',
+                            default=5000,
+                            type=int,
+                            help='number of synthetic objects')
+
+        parser.add_argument('--users',
+                            action='store',
+                            dest='users',
+                            default=500,
+                            type=int,
+                            help='number of synthetic users')
+
+        parser.add_argument('--groups',
+                            action='store',
+                            dest='groups',
+                            default=50,
+                            type=int,
+                            help='number of synthetic groups')
+
+        parser.add_argument('--queries',
+                            action='store',
+                            dest='queries',
+                            default=200,
+                            type=int,
+                            help='number of listings to time')
+
+    def handle(self, *args, **options):
+        try:
+            with transaction.atomic():
+                self.benchmark(Random(42), **options)
+                raise Rollback()
+        except Rollback:
+            pass
+
+    def create_data(self, random, objects, users, groups):
+        prefix = 'acl-benchmark-%d' % time()
+        users = [User.objects.create(username='%s-%d' % (prefix, i))
+                 for i in xrange(users)]
+        groups = [Group.objects.create(name='%s-%d' % (prefix, i))
+                  for i in xrange(groups)]
+        for user in users:
+            user.groups.add(*random.sample(groups, min(3, len(groups))))
+        leases = [Lease(name='%s-%d' % (prefix, i)) for i in xrange(objects)]
+        Lease.objects.bulk_create(leases)
+        leases = Lease.objects.filter(name__startswith=prefix)
+
+        levels = [Lease.get_level_object(codename)
+                  for codename, name in Lease.ACL_LEVELS]
+        ObjectLevel.objects.bulk_create(
+            ObjectLevel(content_object=lease, level=level)
+            for lease in leases for level in levels)
+        object_levels = list(ObjectLevel.objects.filter(
+            object_id__in=leases.values('pk'),
+            content_type=levels[0].content_type))
+
+        user_through = ObjectLevel.users.through
+        group_through = ObjectLevel.groups.through
+        user_through.objects.bulk_create(
+            user_through(objectlevel=ol, user=user)
+            for ol in object_levels
+            for user in random.sample(users, min(2, len(users))))
+        group_through.objects.bulk_create(
+            group_through(objectlevel=ol, group=group)
+            for ol in object_levels if random.random() < 0.3
+            for group in random.sample(groups, 1))
+        return users
+
+    def list_objects(self, users, materialized):
+        with override_settings(ACL_MATERIALIZED_LEVELS=materialized):
+            start = time()
+            result = [set(Lease.get_objects_with_level('user', user)
+                          .values_list('pk', flat=True)) for user in users]
+            return time() - start, result
+
+    def benchmark(self, random, objects, users, groups, queries, **options):
+        start = time()
+        users = self.create_data(random, objects, users, groups)
+        self.stdout.write('Created data in %.2f s.' % (time() - start))
+        start = time()
+        rebuild_effective_levels()
+        self.stdout.write('Rebuilt levels in %.2f s.' % (time() - start))
+
+        sample = [random.choice(users) for i in xrange(queries)]
+        old, old_result = self.list_objects(sample, False)
+        new, new_result = self.list_objects(sample, True)
+        if old_result != new_result:
+            self.stderr.write('The results differ.')
+        self.stdout.write('%-15s %10s' % ('levels', 'listing'))
+        self.stdout.write('%-15s %7.2f ms' % ('joined', old * 1e3 / queries))
+        self.stdout.write('%-15s %7.2f ms' % (
+            'materialized', new * 1e3 / queries))
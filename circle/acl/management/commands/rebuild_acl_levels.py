@@ -0,0 +1,32 @@
+# Copyright 2014 Budapest University of Technology and Economics (BME IK)
+#
+# This file is part of CIRCLE Cloud.
+#
+# CIRCLE is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# CIRCLE is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along
+# with CIRCLE.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import unicode_literals, absolute_import
+
+from django.core.management.base import BaseCommand
+
+from acl.models import EffectiveLevel, rebuild_effective_levels
+
+
+class Command(BaseCommand):
+    help = ('Rebuild the effective level table used if '
+            'ACL_MATERIALIZED_LEVELS is set.')
+
+    def handle(self, *args, **options):
+        rebuild_effective_levels()
+        self.stdout.write('%d effective levels.' %
+                          EffectiveLevel.objects.count())
@@ -0,0 +1,38 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+from django.conf import settings
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('contenttypes', '0001_initial'),
+        ('acl', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='EffectiveLevel',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('object_id', models.IntegerField()),
+                ('weight', models.IntegerField()),
+                ('content_type', models.ForeignKey(to='contenttypes.ContentType')),
+                ('user', models.ForeignKey(to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+            },
+            bases=(models.Model,),
+        ),
+        migrations.AlterUniqueTogether(
+            name='effectivelevel',
+            unique_together=set([('user', 'content_type', 'object_id')]),
+        ),
+        migrations.AlterIndexTogether(
+            name='effectivelevel',
+            index_together=set([('user', 'content_type', 'weight')]),
+        ),
+    ]
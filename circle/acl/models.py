@@ -15,15 +15,22 @@
 # You should have received a copy of the GNU General Public License along
 # with CIRCLE.  If not, see <http://www.gnu.org/licenses/>.
 
+from contextlib import contextmanager
 import logging
+from threading import local
 
+from django.conf import settings
 from django.contrib.auth.models import User, Group
 from django.contrib.contenttypes.fields import (
     GenericForeignKey, GenericRelation
 )
 from django.contrib.contenttypes.models import ContentType
+from django.db import transaction
 from django.db.models import (
-    ManyToManyField, ForeignKey, CharField, Model, IntegerField, Q
+    ManyToManyField, ForeignKey, CharField, Model, IntegerField, Max, Q
+)
+from django.db.models.signals import (
+    m2m_changed, post_delete, post_init, post_save, pre_delete
 )
 
 logger = logging.getLogger(__name__)
@@ -68,6 +75,195 @@ class ObjectLevel(Model):
         unique_together = (('content_type', 'object_id', 'level'),)
 
 
+class EffectiveLevel(Model):
+
+    """Highest level weight of a user on an object, directly or through
+    any of the groups of the user.
+
+    Materialized from ObjectLevel if ACL_MATERIALIZED_LEVELS is set."""
+    user = ForeignKey(User)
+    content_type = ForeignKey(ContentType)
+    object_id = IntegerField()
+    weight = IntegerField()
+
+    class Meta:
+        app_label = 'acl'
+        unique_together = (('user', 'content_type', 'object_id'),)
+        index_together = (('user', 'content_type', 'weight'),)
+
+
+def materialized_levels():
+    return getattr(settings, 'ACL_MATERIALIZED_LEVELS', False)
+
+
+def compute_effective_levels(objects=(), users=()):
+    """Return the effective levels of the objects, given as (content type
+    id, object id) pairs, and of the users, given as ids.
+
+    The result is a dict of weights by (user id, content type id, object
+    id).
+    """
+    user_levels = ObjectLevel.users.through.objects
+    group_levels = ObjectLevel.groups.through.objects
+    fields = ('objectlevel__content_type', 'objectlevel__object_id',
+              'objectlevel__level__weight')
+    queries = []
+    by_type = {}
+    for ct, object_id in objects:
+        by_type.setdefault(ct, []).append(object_id)
+    for ct, ids in by_type.items():
+        filters = {'objectlevel__content_type': ct,
+                   'objectlevel__object_id__in': ids}
+        queries.append(user_levels.filter(**filters).values_list(
+            'user', *fields))
+        queries.append(group_levels.filter(
+            group__user__isnull=False, **filters).values_list(
+            'group__user', *fields))
+    users = list(users)
+    if users:
+        queries.append(user_levels.filter(user__in=users).values_list(
+            'user', *fields))
+        queries.append(group_levels.filter(group__user__in=users)
+                       .values_list('group__user', *fields))
+
+    result = {}
+    for query in queries:
+        for user, ct, object_id, weight in query:
+            if weight is None:
+                continue
+            key = (user, ct, object_id)
+            if result.get(key, weight) <= weight:
+                result[key] = weight
+    return result
+
+
+def refresh_effective_levels(objects=(), users=()):
+    """Replace the effective levels of the objects, given as (content type
+    id, object id) pairs, and of the users, given as ids.
+
+    The ObjectLevels of the objects and the users are locked first, so
+    concurrent refreshes of them are serialized instead of computing the
+    levels from the same state and inserting them twice.
+    """
+    objects = set(objects)
+    users = set(users)
+    if not objects and not users:
+        return
+    by_type = {}
+    for ct, object_id in objects:
+        by_type.setdefault(ct, []).append(object_id)
+    with transaction.atomic():
+        for ct, ids in sorted(by_type.items()):
+            list(ObjectLevel.objects.select_for_update().filter(
+                content_type_id=ct, object_id__in=ids).order_by(
+                'pk').values_list('pk', flat=True))
+        if users:
+            list(User.objects.select_for_update().filter(
+                pk__in=users).order_by('pk').values_list('pk', flat=True))
+        levels = compute_effective_levels(objects, users)
+        for ct, ids in by_type.items():
+            EffectiveLevel.objects.filter(content_type_id=ct,
+                                          object_id__in=ids).delete()
+        if users:
+            EffectiveLevel.objects.filter(user__in=users).delete()
+        EffectiveLevel.objects.bulk_create(
+            EffectiveLevel(user_id=user, content_type_id=ct,
+                           object_id=object_id, weight=weight)
+            for (user, ct, object_id), weight in levels.items())
+
+
+def rebuild_effective_levels(chunk_size=500):
+    """Replace all effective levels.
+    """
+    objects = list(ObjectLevel.objects.values_list(
+        'content_type', 'object_id').distinct())
+    EffectiveLevel.objects.all().delete()
+    for i in xrange(0, len(objects), chunk_size):
+        refresh_effective_levels(objects=objects[i:i + chunk_size])
+
+
+_deferred_levels = local()
+
+
+@contextmanager
+def deferred_level_refresh():
+    """Refresh the effective levels changed in the block at once, when the
+    outermost block exits.
+    """
+    outermost = not hasattr(_deferred_levels, 'objects')
+    if outermost:
+        _deferred_levels.objects = set()
+        _deferred_levels.users = set()
+    try:
+        yield
+        if outermost:
+            refresh_effective_levels(_deferred_levels.objects,
+                                     _deferred_levels.users)
+    finally:
+        if outermost:
+            del _deferred_levels.objects
+            del _deferred_levels.users
+
+
+# incremented on each change of the levels in this process
+_level_generation = 0
+
+
+def get_level_cache(user):
+    """Return the level cache of the user object.
+
+    Like the permission cache of Django, it lives as long as the user
+    object, which is usually one request.  It is dropped when any level
+    changes in this process.
+    """
+    cache = getattr(user, '_acl_level_cache', None)
+    if cache is None or cache[0] != _level_generation:
+        cache = (_level_generation, {})
+        user._acl_level_cache = cache
+    return cache[1]
+
+
+def query_user_weights(content_type, ids, user, group_also=True):
+    """Return the highest level weight of the user on the objects by id,
+    with at most two queries.
+    """
+    if group_also and materialized_levels():
+        return dict(EffectiveLevel.objects.filter(
+            user=user, content_type=content_type,
+            object_id__in=ids).values_list('object_id', 'weight'))
+
+    levels = ObjectLevel.objects.filter(
+        content_type=content_type, object_id__in=ids,
+        level__weight__isnull=False)
+    queries = [levels.filter(users=user)]
+    if group_also:
+        queries.append(levels.filter(groups__user=user))
+    result = {}
+    for query in queries:
+        for object_id, weight in query.values('object_id').annotate(
+                weight=Max('level__weight')).values_list('object_id',
+                                                         'weight'):
+            result[object_id] = max(weight, result.get(object_id, weight))
+    return result
+
+
+def touch_effective_levels(objects=(), users=()):
+    """Refresh the effective levels of the objects and users, at the end of
+    the deferred_level_refresh block if in one.
+
+    The level caches of the users are dropped anyway.
+    """
+    global _level_generation
+    _level_generation += 1
+    if not materialized_levels():
+        return
+    if hasattr(_deferred_levels, 'objects'):
+        _deferred_levels.objects.update(objects)
+        _deferred_levels.users.update(users)
+    else:
+        refresh_effective_levels(objects, users)
+
+
 class AclBase(Model):
 
     """Define permission levels for Users/Groups per object."""
@@ -76,20 +272,34 @@ class AclBase(Model):
     def clone_acl(self, other):
         """Clone full ACL from other object."""
         assert self.id != other.id or type(self) != type(other)
-        self.object_level_set.clear()
-        for i in other.object_level_set.all():
-            ol = self.object_level_set.create(level=i.level)
-            for j in i.users.all():
-                ol.users.add(j)
-            for j in i.groups.all():
-                ol.groups.add(j)
+        with deferred_level_refresh():
+            self.object_level_set.clear()
+            for i in other.object_level_set.all():
+                ol = self.object_level_set.create(level=i.level)
+                for j in i.users.all():
+                    ol.users.add(j)
+                for j in i.groups.all():
+                    ol.groups.add(j)
 
     @classmethod
-    def get_level_object(cls, level):
+    def get_level_object(cls, level, user=None):
+
+        """Get Level object for this model by codename.
 
-        """Get Level object for this model by codename."""
+        The levels are cached in the level cache of the user if given."""
         ct = ContentType.objects.get_for_model(cls)
-        return Level.objects.get(codename=level, content_type=ct)
+        if user is None:
+            return Level.objects.get(codename=level, content_type=ct)
+        cache = get_level_cache(user)
+        key = ('levels', ct.pk)
+        if key not in cache:
+            cache[key] = dict(
+                (i.codename, i) for i in Level.objects.filter(
+                    content_type=ct).select_related('content_type'))
+        try:
+            return cache[key][level]
+        except KeyError:
+            raise Level.DoesNotExist('Level %s does not exist.' % level)
 
     def set_level(self, whom, level):
 
@@ -126,12 +336,13 @@ class AclBase(Model):
             if not self.object_level_set.filter(level_id=level.pk).exists():
                 self.object_level_set.create(level=level)
             pk = level.pk
-        for i in self.object_level_set.all():
-            if i.level_id != pk:
-                i.users.remove(user)
-            else:
-                i.users.add(user)
-            i.save()
+        with deferred_level_refresh():
+            for i in self.object_level_set.all():
+                if i.level_id != pk:
+                    i.users.remove(user)
+                else:
+                    i.users.add(user)
+                i.save()
 
     def set_group_level(self, group, level):
 
@@ -152,12 +363,50 @@ class AclBase(Model):
             if not self.object_level_set.filter(level_id=level.pk).exists():
                 self.object_level_set.create(level=level)
             pk = level.pk
-        for i in self.object_level_set.all():
-            if i.level_id != pk:
-                i.groups.remove(group)
-            else:
-                i.groups.add(group)
-            i.save()
+        with deferred_level_refresh():
+            for i in self.object_level_set.all():
+                if i.level_id != pk:
+                    i.groups.remove(group)
+                else:
+                    i.groups.add(group)
+                i.save()
+
+    @classmethod
+    def mass_set_level(cls, objs, whom, level):
+        """Set level of newly created objects for a user or group.
+
+        The objects must not have any level set yet.  A constant number of
+        queries is used instead of a few for each object.
+
+        :param objs: objects of the model to set the level of
+        :param whom: user or group the level is set for
+        :type whom: User or Group
+        :param level: codename of level to set
+        :type level: Level or str or unicode
+        """
+        if isinstance(whom, User):
+            field = 'users'
+        elif isinstance(whom, Group):
+            field = 'groups'
+        else:
+            raise AttributeError('"whom" must be a User or Group object.')
+        if isinstance(level, basestring):
+            level = cls.get_level_object(level)
+        ct = ContentType.objects.get_for_model(cls)
+        ids = [obj.pk for obj in objs]
+        logger.info('%s.mass_set_level(%d objects, %s, %s) called',
+                    cls.__name__, len(ids), unicode(whom), unicode(level))
+        ObjectLevel.objects.bulk_create(
+            ObjectLevel(content_type=ct, object_id=pk, level=level)
+            for pk in ids)
+        ol_ids = ObjectLevel.objects.filter(
+            content_type=ct, level=level, object_id__in=ids).values_list(
+            'id', flat=True)
+        through = getattr(ObjectLevel, field).through
+        fk = '%s_id' % whom._meta.model_name
+        through.objects.bulk_create(
+            through(objectlevel_id=pk, **{fk: whom.pk}) for pk in ol_ids)
+        touch_effective_levels(objects=[(ct.pk, pk) for pk in ids])
 
     def has_level(self, user, level, group_also=True):
         logger.debug('%s.has_level(%s, %s, %s) called',
@@ -168,18 +417,56 @@ class AclBase(Model):
             logger.debug('- superuser granted')
             return True
         if isinstance(level, basestring):
-            level = self.get_level_object(level)
+            level = self.get_level_object(level, user)
             logger.debug("- level set by str: %s", unicode(level))
 
-        object_levels = self.object_level_set.filter(
-            level__weight__gte=level.weight).all()
-        groups = user.groups.values_list('id', flat=True) if group_also else []
-        for i in object_levels:
-            if i.users.filter(pk=user.pk).exists():
-                return True
-            if group_also and i.groups.filter(pk__in=groups).exists():
-                return True
-        return False
+        weight = self.get_user_weights([self], user, group_also)[self.pk]
+        return weight is not None and weight >= level.weight
+
+    @classmethod
+    def get_user_weights(cls, objs, user, group_also=True):
+        """Return the highest level weight of the user on each object by
+        primary key, or None where the user has no level.
+
+        The weights are cached in the level cache of the user, the missing
+        ones are queried at once.
+        """
+        if user is None or not user.is_authenticated():
+            return dict.fromkeys(obj.pk for obj in objs)
+        ct = ContentType.objects.get_for_model(cls)
+        cache = get_level_cache(user)
+        result = {}
+        missing = []
+        for obj in objs:
+            key = (ct.pk, obj.pk, group_also)
+            if obj.pk is None:
+                result[None] = None
+            elif key in cache:
+                result[obj.pk] = cache[key]
+            else:
+                missing.append(obj.pk)
+        if missing:
+            weights = query_user_weights(ct, missing, user, group_also)
+            for pk in missing:
+                result[pk] = weights.get(pk)
+                cache[(ct.pk, pk, group_also)] = result[pk]
+        return result
+
+    @classmethod
+    def filter_objects_with_level(cls, objs, level, user, group_also=True):
+        """Return the objects the user has the level on, like calling
+        has_level on each of them, but with at most two queries.
+        """
+        if user is None or not user.is_authenticated():
+            return []
+        objs = list(objs)
+        if getattr(user, 'is_superuser', False):
+            return objs
+        if isinstance(level, basestring):
+            level = cls.get_level_object(level, user)
+        weights = cls.get_user_weights(objs, user, group_also)
+        return [obj for obj in objs if weights[obj.pk] is not None and
+                weights[obj.pk] >= level.weight]
 
     def get_users_with_level(self, **kwargs):
         logger.debug('%s.get_users_with_level() called', unicode(self))
@@ -221,6 +508,15 @@ class AclBase(Model):
             logger.debug("- level set by str: %s", unicode(level))
 
         ct = ContentType.objects.get_for_model(cls)
+        if group_also and materialized_levels():
+            ids = EffectiveLevel.objects.filter(
+                user=user, content_type=ct,
+                weight__gte=level.weight).values('object_id')
+            clsfilter = Q(pk__in=ids)
+            if owner_also:
+                clsfilter |= Q(owner=user)
+            return cls.objects.filter(clsfilter)
+
         levelfilter = Q(users=user)
         if group_also:
             levelfilter |= Q(groups__in=user.groups.all())
@@ -252,3 +548,87 @@ class AclBase(Model):
 
     class Meta:
         abstract = True
+
+
+def touch_levels(levels):
+    """Refresh the effective levels of the objects with any of the given
+    Levels, after their weights have changed.
+    """
+    touch_effective_levels(objects=ObjectLevel.objects.filter(
+        level__in=levels).values_list('content_type', 'object_id').distinct())
+
+
+def track_level_weight(sender, instance, **kwargs):
+    instance._weight = instance.__dict__.get('weight')
+
+
+def touch_level(sender, instance, created=False, **kwargs):
+    if not created and instance._weight != instance.weight:
+        touch_levels([instance])
+    instance._weight = instance.weight
+
+
+def touch_object_level(sender, instance, **kwargs):
+    touch_effective_levels(objects=[(instance.content_type_id,
+                                     instance.object_id)])
+
+
+def touch_object_level_members(sender, instance, action, reverse,
+                               **kwargs):
+    if not action.startswith('post_'):
+        return
+    if not reverse:
+        touch_object_level(sender, instance)
+    elif isinstance(instance, User):
+        touch_effective_levels(users=[instance.pk])
+    elif not materialized_levels():
+        touch_effective_levels()
+    else:
+        touch_effective_levels(
+            users=instance.user_set.values_list('pk', flat=True))
+
+
+def touch_group_members(sender, instance, action, reverse, pk_set=None,
+                        **kwargs):
+    """Refresh the effective levels of the users whose groups have
+    changed.
+    """
+    if not materialized_levels():
+        if action.startswith('post_'):
+            touch_effective_levels()
+        return
+    if not reverse:
+        users = [instance.pk]
+    elif action == 'pre_clear':
+        instance._cleared_users = list(
+            instance.user_set.values_list('pk', flat=True))
+        return
+    elif action == 'post_clear':
+        users = getattr(instance, '_cleared_users', [])
+    else:
+        users = pk_set or []
+    if action.startswith('post_'):
+        touch_effective_levels(users=users)
+
+
+def save_group_members(sender, instance, **kwargs):
+    if materialized_levels():
+        instance._deleted_users = list(
+            instance.user_set.values_list('pk', flat=True))
+
+
+def touch_deleted_group_members(sender, instance, **kwargs):
+    touch_effective_levels(users=getattr(instance, '_deleted_users', []))
+
+
+post_init.connect(track_level_weight, sender=Level)
+post_save.connect(touch_level, sender=Level)
+post_save.connect(touch_object_level, sender=ObjectLevel)
+post_delete.connect(touch_object_level, sender=ObjectLevel)
+m2m_changed.connect(touch_object_level_members,
+                    sender=ObjectLevel.users.through)
+m2m_changed.connect(touch_object_level_members,
+                    sender=ObjectLevel.groups.through)
+m2m_changed.connect(touch_group_members, sender=User.groups.through)
+pre_delete.connect(save_group_members, sender=Group)
+post_delete.connect(touch_deleted_group_members, sender=Group)
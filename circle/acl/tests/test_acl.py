@@ -18,8 +18,12 @@
 from django.test import TestCase
 from django.contrib.auth.models import User, Group, AnonymousUser
 from django.db.models import TextField, ForeignKey
+from django.test.utils import override_settings
 
-from ..models import ObjectLevel, AclBase
+from ..models import (
+    Level, ObjectLevel, AclBase, EffectiveLevel, deferred_level_refresh,
+    rebuild_effective_levels,
+)
 
 
 class TestModel(AclBase):
@@ -200,6 +204,55 @@ class AclUserTest(TestCase):
         self.assertItemsEqual(
             TestModel.get_objects_with_level('alfa', self.u2), [i2])
 
+    def test_get_user_weights(self):
+        i1 = TestModel.objects.create(normal_field='Hello1')
+        i2 = TestModel.objects.create(normal_field='Hello2')
+        i3 = TestModel.objects.create(normal_field='Hello3')
+        i1.set_level(self.u1, 'alfa')
+        i1.set_level(self.g1, 'charlie')
+        i2.set_level(self.u1, 'bravo')
+        alfa = TestModel.get_level_object('alfa').weight
+        bravo = TestModel.get_level_object('bravo').weight
+        charlie = TestModel.get_level_object('charlie').weight
+        with self.assertNumQueries(2):
+            weights = TestModel.get_user_weights([i1, i2, i3], self.u1)
+        self.assertEqual(weights, {i1.pk: charlie, i2.pk: bravo, i3.pk: None})
+        self.assertEqual(
+            TestModel.get_user_weights([i1], self.u1, group_also=False),
+            {i1.pk: alfa})
+
+    def test_has_level_cached(self):
+        i = TestModel.objects.create(normal_field='Hello')
+        i.set_level(self.g1, 'bravo')
+        self.assertTrue(i.has_level(self.u1, 'bravo'))
+        with self.assertNumQueries(0):
+            self.assertTrue(i.has_level(self.u1, 'alfa'))
+            self.assertFalse(i.has_level(self.u1, 'charlie'))
+        i.set_level(self.g1, 'alfa')
+        self.assertFalse(i.has_level(self.u1, 'bravo'))
+        self.g1.user_set.remove(self.u1)
+        self.assertFalse(i.has_level(self.u1, 'alfa'))
+
+    def test_filter_objects_with_level(self):
+        i1 = TestModel.objects.create(normal_field='Hello1')
+        i2 = TestModel.objects.create(normal_field='Hello2')
+        i1.set_level(self.u1, 'alfa')
+        i2.set_level(self.g1, 'bravo')
+        objs = [i1, i2]
+        self.assertEqual(
+            TestModel.filter_objects_with_level(objs, 'alfa', self.u1), objs)
+        self.assertEqual(
+            TestModel.filter_objects_with_level(objs, 'bravo', self.u1),
+            [i2])
+        self.assertEqual(
+            TestModel.filter_objects_with_level(objs, 'alfa', self.u2,
+                                                group_also=False), [])
+        self.assertEqual(
+            TestModel.filter_objects_with_level(objs, 'charlie', self.us),
+            objs)
+        self.assertEqual(TestModel.filter_objects_with_level(
+            objs, 'alfa', AnonymousUser()), [])
+
     def test_get_objects_with_level_for_superuser(self):
         i1 = TestModel.objects.create(normal_field='Hello1')
         i2 = TestModel.objects.create(normal_field='Hello2')
@@ -263,3 +316,88 @@ class AclUserTest(TestCase):
         self.assertFalse(i.has_level(self.u1, 'one'))
         self.assertFalse(i.has_level(self.u1, 'owner'))
         self.assertTrue(i.has_level(self.u2, 'owner'))
+
+
+@override_settings(ACL_MATERIALIZED_LEVELS=True)
+class EffectiveLevelTest(TestCase):
+    def setUp(self):
+        self.u1 = User.objects.create(username='user1')
+        self.u2 = User.objects.create(username='user2')
+        self.g1 = Group.objects.create(name='group1')
+        self.g1.user_set.add(self.u1)
+        self.i1 = TestModel.objects.create(normal_field='Hello1')
+        self.i2 = TestModel.objects.create(normal_field='Hello2')
+
+    def assertSameObjects(self, level, user):
+        with override_settings(ACL_MATERIALIZED_LEVELS=False):
+            expected = set(TestModel.get_objects_with_level(level, user))
+        self.assertEqual(set(TestModel.get_objects_with_level(level, user)),
+                         expected)
+        return expected
+
+    def test_user_level(self):
+        self.i1.set_level(self.u1, 'bravo')
+        self.assertEqual(self.assertSameObjects('bravo', self.u1),
+                         {self.i1})
+        self.assertEqual(self.assertSameObjects('charlie', self.u1), set())
+        self.i1.set_level(self.u1, None)
+        self.assertEqual(self.assertSameObjects('alfa', self.u1), set())
+
+    def test_group_level(self):
+        self.i1.set_level(self.g1, 'alfa')
+        self.i2.set_level(self.g1, 'charlie')
+        self.i1.set_level(self.u1, 'bravo')
+        self.assertEqual(self.assertSameObjects('alfa', self.u1),
+                         {self.i1, self.i2})
+        self.assertEqual(self.assertSameObjects('bravo', self.u1),
+                         {self.i1, self.i2})
+        self.assertEqual(self.assertSameObjects('alfa', self.u2), set())
+
+    def test_group_membership_change(self):
+        self.i1.set_level(self.g1, 'alfa')
+        self.g1.user_set.add(self.u2)
+        self.assertEqual(self.assertSameObjects('alfa', self.u2), {self.i1})
+        self.u2.groups.remove(self.g1)
+        self.assertEqual(self.assertSameObjects('alfa', self.u2), set())
+        self.g1.user_set.clear()
+        self.assertEqual(self.assertSameObjects('alfa', self.u1), set())
+
+    def test_group_delete(self):
+        self.i1.set_level(self.g1, 'alfa')
+        self.g1.delete()
+        self.assertEqual(self.assertSameObjects('alfa', self.u1), set())
+
+    def test_object_delete(self):
+        self.i1.set_level(self.u1, 'alfa')
+        self.i1.delete()
+        self.assertFalse(EffectiveLevel.objects.exists())
+
+    def test_mass_set_level(self):
+        TestModel.mass_set_level([self.i1, self.i2], self.g1, 'bravo')
+        self.assertEqual(self.assertSameObjects('bravo', self.u1),
+                         {self.i1, self.i2})
+
+    def test_deferred_refresh(self):
+        with deferred_level_refresh():
+            self.i1.set_level(self.u1, 'alfa')
+            self.assertFalse(EffectiveLevel.objects.exists())
+        self.assertEqual(self.assertSameObjects('alfa', self.u1), {self.i1})
+
+    def test_level_weight_change(self):
+        self.i1.set_level(self.u1, 'alfa')
+        self.assertEqual(self.assertSameObjects('charlie', self.u1), set())
+        level = Level.objects.get(codename='alfa',
+                                  content_type__model='testmodel')
+        level.weight = 10
+        level.save()
+        self.assertEqual(self.assertSameObjects('charlie', self.u1),
+                         {self.i1})
+
+    def test_rebuild(self):
+        with override_settings(ACL_MATERIALIZED_LEVELS=False):
+            self.i1.set_level(self.u1, 'alfa')
+            self.i2.set_level(self.g1, 'bravo')
+        self.assertFalse(EffectiveLevel.objects.exists())
+        rebuild_effective_levels()
+        self.assertEqual(self.assertSameObjects('alfa', self.u1),
+                         {self.i1, self.i2})
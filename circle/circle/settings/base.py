@@ -305,6 +305,22 @@ VM_ACCESS_PROTOCOLS = loads(get_env_variable('DJANGO_VM_ACCESS_PROTOCOLS',
                                                  "rdp": ["RDP", 3389, "tcp"],
                                                  "ssh": ["SSH", 22, "tcp"]}'''))
 VM_SCHEDULER = 'manager.scheduler'
+# spread, pack or trait_affinity
+VM_SCHEDULER_POLICY = get_env_variable('DJANGO_VM_SCHEDULER_POLICY', 'spread')
+
+# keep the effective ACL level of each user in a table, see the
+# rebuild_acl_levels command
+ACL_MATERIALIZED_LEVELS = get_env_variable(
+    'DJANGO_ACL_MATERIALIZED_LEVELS', '') == 'True'
+
+# profile the views, see dashboard.profiling
+PROFILE_VIEWS = get_env_variable('DJANGO_PROFILE_VIEWS', '') == 'True'
+# number of the slowest requests kept with their query traces
+PROFILE_KEEP_SLOWEST = int(get_env_variable(
+    'DJANGO_PROFILE_KEEP_SLOWEST', '50'))
+if PROFILE_VIEWS:
+    MIDDLEWARE_CLASSES = (
+        ('dashboard.profiling.ProfilingMiddleware', ) + MIDDLEWARE_CLASSES)
 
 #BROKER_URL = get_env_variable('AMQP_URI')
 
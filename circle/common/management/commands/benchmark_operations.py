@@ -0,0 +1,95 @@
+# Copyright 2014 Budapest University of Technology and Economics (BME IK)
+#
+# This file is part of CIRCLE Cloud.
+#
+# CIRCLE is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# CIRCLE is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along
+# with CIRCLE.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import unicode_literals, absolute_import
+
+from inspect import getargspec
+from time import time
+
+from django.core.management.base import BaseCommand
+
+from common.operations import OperatedMixin, Operation, register_operation
+from vm.models import Instance
+
+
+class SyntheticSubject(OperatedMixin):
+    def __init__(self, pk):
+        self.pk = pk
+
+
+class SyntheticActivity(object):
+    result = None
+
+    def finish(self, succeeded, result=None, event_handler=None):
+        pass
+
+
+@register_operation
+class NoopOperation(Operation):
+    id = 'noop'
+    name = 'noop'
+    host_cls = SyntheticSubject
+    required_perms = ()
+
+    def create_activity(self, parent, user, kwargs):
+        return SyntheticActivity()
+
+    def _operation(self, activity, foo=None):
+        pass
+
+
+class Command(BaseCommand):
+    help = ('Measure the overhead of looking up and calling operations on '
+            'many subjects, without the work of the operations.')
+
+    def add_arguments(self, parser):
+
+        parser.add_argument('--subjects',
+                            action='store',
+                            dest='subjects',
+                            default=5000,
+                            type=int,
+                            help='number of subjects')
+
+        parser.add_argument('--op',
+                            action='store',
+                            dest='op',
+                            default='shut_off',
+                            help='instance operation to look up')
+
+    def handle(self, *args, **options):
+        count = options['subjects']
+        op = options['op']
+        instances = [Instance(pk=i, status='RUNNING') for i in xrange(count)]
+        subjects = [SyntheticSubject(i) for i in xrange(count)]
+
+        self.stdout.write('%-20s %10s' % ('step', 'per call'))
+        self.measure('lookup', count, lambda: [getattr(i, op)
+                                               for i in instances])
+        self.measure('lookup again', count, lambda: [getattr(i, op)
+                                                     for i in instances])
+        self.measure('call', count, lambda: [
+            s.noop(system=True, foo=1) for s in subjects])
+        self.measure('getargspec', count, lambda: [
+            getargspec(s.noop._operation) for s in subjects])
+
+    def measure(self, name, count, function):
+        start = time()
+        function()
+        elapsed = time() - start
+        self.stdout.write('%-20s %7.2f us' % (
+            name, elapsed * 1e6 / max(count, 1)))
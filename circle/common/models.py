@@ -15,13 +15,15 @@
 # You should have received a copy of the GNU General Public License along
 # with CIRCLE.  If not, see <http://www.gnu.org/licenses/>.
 
-from collections import deque
+from collections import deque, OrderedDict
 from contextlib import contextmanager
 from functools import update_wrapper
 from hashlib import sha224
 from itertools import chain, imap
 from logging import getLogger
-from time import time
+from threading import Lock
+from time import sleep, time
+from uuid import uuid4
 from warnings import warn
 
 from django.contrib import messages
@@ -29,6 +31,7 @@ from django.contrib.auth.models import User
 from django.core.cache import cache
 from django.core.exceptions import PermissionDenied
 from django.core.serializers.json import DjangoJSONEncoder
+from django.db import connections, router, transaction
 from django.db.models import (
     CharField, DateTimeField, ForeignKey, NullBooleanField
 )
@@ -88,6 +91,33 @@ activity_context = contextmanager(activitycontextimpl)
 activity_code_separator = '.'
 
 
+def bulk_insert(model, objs):
+    """Insert new objects of the model, bypassing its save method.
+
+    No model signals are sent, callers should do the work of the receivers
+    themselves.  The objects are inserted with a single query if the
+    database backend returns the primary keys of bulk inserted rows
+    (PostgreSQL does), otherwise with the same insert one by one, so the
+    primary keys are set in both cases.
+    """
+    objs = list(objs)
+    db = router.db_for_write(model)
+    if connections[db].features.can_return_ids_from_bulk_insert:
+        return model.objects.using(db).bulk_create(objs)
+    meta = model._meta
+    manager = model._base_manager.using(db)
+    with transaction.atomic(using=db, savepoint=False):
+        for obj in objs:
+            fields = [field for field in meta.concrete_fields
+                      if obj.pk is not None or field is not meta.auto_field]
+            pk = manager._insert([obj], fields=fields, return_id=True)
+            if obj.pk is None:
+                obj.pk = pk
+            obj._state.adding = False
+            obj._state.db = db
+    return objs
+
+
 def has_prefix(activity_code, *prefixes):
     """Determine whether the activity code has the specified prefix.
 
@@ -241,6 +271,139 @@ class ActivityModel(TimeStampedModel):
             return 'failed'
 
 
+def touch_tokens(prefix, keys=None):
+    """Mark the given sections of a generated configuration or index as
+    changed, or all sections if keys is None.
+
+    Processes keep the sections they have built with the tokens returned
+    by get_tokens, and build them again when the tokens differ.
+    """
+    names = (['%s_token' % prefix] if keys is None
+             else ['%s_token_%s' % (prefix, key) for key in keys])
+    cache.set_many({name: uuid4().hex for name in names}, None)
+
+
+def touch_tokens_on_commit(prefix, keys=None):
+    """Touch the tokens when the current transaction is committed, or now
+    outside of transactions.
+
+    Touching them earlier would let another process build the sections
+    from uncommitted data, and cache them under the new tokens.
+    """
+    keys = None if keys is None else list(keys)
+    transaction.on_commit(lambda: touch_tokens(prefix, keys))
+
+
+def get_tokens(prefix, keys):
+    """Return the current change token of each section.
+
+    A token containing None can not be trusted, the section has to be
+    generated again.
+    """
+    common_name = '%s_token' % prefix
+    names = {key: '%s_token_%s' % (prefix, key) for key in keys}
+    tokens = cache.get_many([common_name] + names.values())
+    missing = [name for name in [common_name] + names.values()
+               if name not in tokens]
+    if missing:
+        for name in missing:
+            cache.add(name, uuid4().hex, None)
+        tokens.update(cache.get_many(missing))
+    common = tokens.get(common_name)
+    return {key: (common, tokens.get(name)) for key, name in names.items()}
+
+
+# stored to memcached instead of None, which means a missing key
+CACHED_NONE = 'common.models.method_cache:None'
+# seconds None results are cached for at most
+NONE_SECONDS = 10
+# seconds the process computing a result holds its lock for at most
+LOCK_SECONDS = 30
+# seconds to wait for the result of another process computing it, before
+# computing it in this process too
+LOCK_WAIT_SECONDS = 2
+# results kept in the memory of each process
+LOCAL_CACHE_SIZE = 1000
+
+MISSING = object()
+
+
+class LocalCache(object):
+    """Bounded, least recently used cache of expiring values, shared by the
+    threads of the process.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.data = OrderedDict()
+        self.lock = Lock()
+
+    def get(self, key, now):
+        """Return the value of the key, or MISSING if it is expired or not
+        cached.
+        """
+        with self.lock:
+            try:
+                expires, value = self.data.pop(key)
+            except KeyError:
+                return MISSING
+            if expires < now:
+                return MISSING
+            self.data[key] = (expires, value)
+            return value
+
+    def set(self, key, value, expires):
+        with self.lock:
+            self.data.pop(key, None)
+            self.data[key] = (expires, value)
+            while len(self.data) > self.size:
+                self.data.popitem(last=False)
+
+    def delete(self, key):
+        with self.lock:
+            self.data.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.data.clear()
+
+
+local_cache = LocalCache(LOCAL_CACHE_SIZE)
+
+
+class MethodCacheStats(object):
+    """Hit, miss and latency counters of a cached method.
+    """
+
+    def __init__(self):
+        self.local_hits = 0
+        self.shared_hits = 0
+        self.misses = 0
+        self.waits = 0
+        self.compute_time = 0.0
+
+    @property
+    def average_compute_time(self):
+        return self.compute_time / self.misses if self.misses else 0.0
+
+    def __repr__(self):
+        return ('<MethodCacheStats local_hits=%d shared_hits=%d misses=%d '
+                'waits=%d average_compute_time=%.3f>' % (
+                    self.local_hits, self.shared_hits, self.misses,
+                    self.waits, self.average_compute_time))
+
+
+# module.method: MethodCacheStats of each cached method
+method_cache_stats = {}
+
+
+def get_cached(key):
+    """Return the result stored to memcached, or MISSING.
+    """
+    result = cache.get(key, MISSING)
+    return None if result == CACHED_NONE else result
+
+
 @celery.task()
 def compute_cached(method, instance, memcached_seconds,
                    key, start, *args, **kwargs):
@@ -263,7 +426,10 @@ def compute_cached(method, instance, memcached_seconds,
     #  call the actual method
     result = method(instance, *args, **kwargs)
     # save to memcache
-    cache.set(key, result, memcached_seconds)
+    if result is None:
+        cache.set(key, CACHED_NONE, min(memcached_seconds, NONE_SECONDS))
+    else:
+        cache.set(key, result, memcached_seconds)
     elapsed = time() - start
     cache.set("%s.cached" % key, 2, max(memcached_seconds * 0.5,
                                         memcached_seconds * 0.75 - elapsed))
@@ -277,24 +443,31 @@ def method_cache(memcached_seconds=60, instance_seconds=5):  # noqa
     """Cache return value of decorated method to memcached and memory.
 
     :param memcached_seconds: Invalidate memcached results after this time.
-    :param instance_seconds: Invalidate results cached to static memory after
-    this time.
+    :param instance_seconds: Invalidate results cached to the memory of the
+    process after this time.
 
-    If a result is cached on instance, return that first.  If that fails, check
-    memcached. If all else fails, run the method and cache on instance and in
-    memcached.
+    Results are cached in the memory of the process first, shared by all
+    instances of the same id, in a bounded LRU cache.  If that fails, check
+    memcached.  If all else fails, run the method and cache in memory and
+    in memcached.  Only one process runs the method for a key at a time,
+    the others wait for its result for LOCK_WAIT_SECONDS at most.
 
     Do not use for methods with side effects.
     Instances are hashed by their id attribute, args by their unicode
     representation.
 
-    ** NOTE: Methods that return None are always "recached".
+    None results are cached for at most NONE_SECONDS.
+    The cached result of a call is dropped by passing invalidate_cache=True
+    to the method, which computes it again, or by calling
+    method.invalidate(instance, *args, **kwargs).
     Based on https://djangosnippets.org/snippets/2477/
     """
 
     def inner_cache(method):
 
         method_name = method.__name__
+        stats = method_cache_stats.setdefault(
+            '%s.%s' % (method.__module__, method_name), MethodCacheStats())
 
         def get_key(instance, *args, **kwargs):
             return sha224(unicode(method.__module__) +
@@ -303,45 +476,77 @@ def method_cache(memcached_seconds=60, instance_seconds=5):  # noqa
                           unicode(args) +
                           unicode(kwargs)).hexdigest()
 
+        def compute(instance, key, *args, **kwargs):
+            lock = "%s.lock" % key
+            locked = cache.add(lock, 1, LOCK_SECONDS)
+            if not locked:
+                # another process is computing it, wait for the result
+                stats.waits += 1
+                deadline = time() + LOCK_WAIT_SECONDS
+                while time() < deadline and cache.get(lock):
+                    sleep(0.1)
+                    result = get_cached(key)
+                    if result is not MISSING:
+                        return result
+            start = time()
+            try:
+                return compute_cached(method, instance, memcached_seconds,
+                                      key, start, *args, **kwargs)
+            finally:
+                stats.misses += 1
+                stats.compute_time += time() - start
+                if locked:
+                    cache.delete(lock)
+
         def x(instance, *args, **kwargs):
             invalidate = kwargs.pop('invalidate_cache', False)
             now = time()
             key = get_key(instance, *args, **kwargs)
 
-            result = None
-            try:
-                vals = getattr(instance, key)
-            except AttributeError:
-                pass
+            if invalidate:
+                cache.delete(key)
+                result = MISSING
             else:
-                if vals['time'] + instance_seconds > now:
-                    # has valid on class cache, return that
-                    result = vals['value']
-                    setattr(instance, key, {'time': now, 'value': result})
+                result = local_cache.get(key, now)
+                if result is not MISSING:
+                    stats.local_hits += 1
+                    return result
+                result = get_cached(key)
 
-            if result is None:
-                result = cache.get(key)
-
-            if invalidate or (result is None):
+            if result is MISSING:
                 logger.debug("all caches failed, compute now")
-                result = compute_cached(method, instance, memcached_seconds,
-                                        key, time(), *args, **kwargs)
-                setattr(instance, key, {'time': now, 'value': result})
-            elif not cache.get("%s.cached" % key):
-                logger.debug("caches expiring, compute async")
-                cache.set("%s.cached" % key, 1, memcached_seconds * 0.5)
-                try:
-                    compute_cached.apply_async(
-                        queue='localhost.man', kwargs=kwargs, args=[
-                            method_name, (instance.__class__, instance.id),
-                            memcached_seconds, key, time()] + list(args))
-                except:
-                    logger.exception("Couldnt compute async %s", method_name)
-
+                result = compute(instance, key, *args, **kwargs)
+            else:
+                stats.shared_hits += 1
+                if not cache.get("%s.cached" % key):
+                    logger.debug("caches expiring, compute async")
+                    cache.set("%s.cached" % key, 1, memcached_seconds * 0.5)
+                    try:
+                        compute_cached.apply_async(
+                            queue='localhost.man', kwargs=kwargs, args=[
+                                method_name, (instance.__class__,
+                                              instance.id),
+                                memcached_seconds, key, time()] + list(args))
+                    except:
+                        logger.exception("Couldnt compute async %s",
+                                         method_name)
+
+            local_cache.set(key, result, now + instance_seconds)
             return result
 
+        def invalidate(instance, *args, **kwargs):
+            """Drop the cached result of the call from memcached and the
+            memory of this process.
+            """
+            key = get_key(instance, *args, **kwargs)
+            local_cache.delete(key)
+            cache.delete(key)
+
         update_wrapper(x, method)
         x._original = method
+        x.invalidate = invalidate
+        x.get_key = get_key
+        x.stats = stats
         return x
 
     return inner_cache
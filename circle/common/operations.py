@@ -63,6 +63,18 @@ class Operation(object):
     def __unicode__(self):
         return self.name
 
+    @classmethod
+    def get_argspec(cls):
+        """Return the argument specification of _operation.
+
+        It is computed once for each class.
+        """
+        argspec = cls.__dict__.get('_argspec')
+        if argspec is None:
+            argspec = getargspec(cls._operation)
+            cls._argspec = argspec
+        return argspec
+
     def __prelude(self, kwargs):
         """This method contains the shared prelude of call and async.
         """
@@ -82,7 +94,7 @@ class Operation(object):
                 skip_auth_check = True
 
         # check for unexpected keyword arguments
-        argspec = getargspec(self._operation)
+        argspec = self.get_argspec()
         if argspec.keywords is None:  # _operation doesn't take ** args
             unexpected_kwargs = set(auxargs) - set(argspec.args)
             if unexpected_kwargs:
@@ -102,7 +114,7 @@ class Operation(object):
         """Execute the operation inside the specified activity's context.
         """
         # compile arguments for _operation
-        argspec = getargspec(self._operation)
+        argspec = self.get_argspec()
         if argspec.keywords is not None:  # _operation takes ** args
             arguments = allargs.copy()
         else:  # _operation doesn't take ** args
@@ -188,6 +200,40 @@ class Operation(object):
 
         self.check_perms(user)
 
+    def get_availability_key(self, user):
+        """Return a hashable key which determines the result of check_auth
+        and check_precond for the user along with the class, or None if
+        the result can not be shared between subjects.
+        """
+        return None
+
+    def get_availability(self, user):
+        """Return the exception raised by check_auth or check_precond, or
+        None if the operation is available for the user.
+
+        The results are cached on the user object by the availability key,
+        so the exception may have been raised for another subject with the
+        same key.
+        """
+        key = self.get_availability_key(user)
+        if key is not None:
+            cache = getattr(user, '_operation_availability', None)
+            if cache is None:
+                cache = user._operation_availability = {}
+            key = (self.__class__, key)
+            if key in cache:
+                return cache[key]
+        try:
+            self.check_auth(user)
+            self.check_precond()
+        except Exception as e:
+            result = e
+        else:
+            result = None
+        if key is not None:
+            cache[key] = result
+        return result
+
     def create_activity(self, parent, user, kwargs):
         raise NotImplementedError
 
@@ -222,7 +268,19 @@ class OperatedMixin(object):
     def __getattr__(self, name):
         # NOTE: __getattr__ is only called if the attribute doesn't already
         # exist in your __dict__
-        return self.get_operation_class(name)(self)
+        op = self.get_operation_class(name)(self)
+        # keep the bound operation for the next access
+        self.__dict__[name] = op
+        return op
+
+    def __reduce__(self):
+        # bound operations are not pickled or copied to other subjects
+        reduced = super(OperatedMixin, self).__reduce__()
+        if len(reduced) < 3 or not isinstance(reduced[2], dict):
+            return reduced
+        ops = getattr(self.__class__, operation_registry_name, {})
+        state = {k: v for k, v in reduced[2].iteritems() if k not in ops}
+        return reduced[:2] + (state, ) + reduced[3:]
 
     @classmethod
     def get_operation_class(cls, name):
@@ -239,12 +297,7 @@ class OperatedMixin(object):
         """
         for name in getattr(self, operation_registry_name, {}):
             op = getattr(self, name)
-            try:
-                op.check_auth(user)
-                op.check_precond()
-            except:
-                pass  # unavailable
-            else:
+            if op.get_availability(user) is None:
                 yield op
 
     def get_operation_from_activity_code(self, activity_code):
@@ -298,4 +351,5 @@ def register_operation(op_cls, op_id=None, target_cls=None):
         setattr(target_cls, operation_registry_name, dict())
 
     getattr(target_cls, operation_registry_name)[op_id] = op_cls
+    op_cls.get_argspec()
     return op_cls
@@ -0,0 +1,30 @@
+# Copyright 2014 Budapest University of Technology and Economics (BME IK)
+#
+# This file is part of CIRCLE Cloud.
+#
+# CIRCLE is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# CIRCLE is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along
+# with CIRCLE.  If not, see <http://www.gnu.org/licenses/>.
+
+
+from django.db import DEFAULT_DB_ALIAS, connections
+
+
+def run_commit_hooks(using=DEFAULT_DB_ALIAS):
+    """Run the transaction.on_commit callbacks registered so far.
+
+    TestCase rolls its transaction back, so they would never run.
+    """
+    connection = connections[using]
+    callbacks, connection.run_on_commit = connection.run_on_commit, []
+    for savepoints, callback in callbacks:
+        callback()
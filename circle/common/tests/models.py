@@ -30,3 +30,8 @@ class TestClass(object):
         # print 'Called TestClass(%d).method(%s)' % (self.id, s)
         self.called += 1
         return self.id + len(s)
+
+    @method_cache()
+    def none_method(self):
+        self.called += 1
+        return None
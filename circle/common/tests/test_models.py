@@ -17,16 +17,24 @@
 
 from collections import deque
 
-from django.test import TestCase
-from mock import MagicMock
+from django.contrib.auth.models import User
+from django.db.models.signals import post_save
+from django.core.cache import cache
+from django.test import TestCase, override_settings
+from mock import MagicMock, patch
 
 from .celery_mock import MockCeleryMixin
 from .models import TestClass
-from ..models import HumanSortField
-from ..models import activitycontextimpl
+from ..models import HumanSortField, LocalCache, LOCK_WAIT_SECONDS, MISSING
+from .commit import run_commit_hooks
+from ..models import activitycontextimpl, bulk_insert, local_cache
+from ..models import get_tokens, touch_tokens, touch_tokens_on_commit
 
 
 class MethodCacheTestCase(MockCeleryMixin, TestCase):
+    def setUp(self):
+        local_cache.clear()
+
     def test_cache(self):
         t1 = TestClass(1)
         t2 = TestClass(2)
@@ -53,6 +61,86 @@ class MethodCacheTestCase(MockCeleryMixin, TestCase):
         self.assertEqual(val1a, val1b)
         self.assertEqual(t1.called, 2)
 
+    def test_invalidate_method(self):
+        t1 = TestClass(1)
+        t1.method('a')
+        TestClass.method.invalidate(t1, 'a')
+        t1.method('a')
+        self.assertEqual(t1.called, 2)
+
+
+@override_settings(CACHES={'default': {
+    'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+class SharedMethodCacheTestCase(MockCeleryMixin, TestCase):
+    def setUp(self):
+        local_cache.clear()
+        cache.clear()
+        self.addCleanup(cache.clear)
+
+    def test_none(self):
+        t1 = TestClass(1)
+        self.assertIsNone(t1.none_method())
+        local_cache.clear()
+        self.assertIsNone(t1.none_method())
+        self.assertEqual(t1.called, 1)
+
+    def test_stats(self):
+        stats = TestClass.method.stats
+        before = (stats.local_hits, stats.shared_hits, stats.misses)
+        t1 = TestClass(1)
+        t1.method('a')
+        t1.method('a')
+        local_cache.clear()
+        t1.method('a')
+        self.assertEqual((stats.local_hits, stats.shared_hits, stats.misses),
+                         (before[0] + 1, before[1] + 1, before[2] + 1))
+
+    def test_wait_for_lock(self):
+        t1 = TestClass(1)
+        key = TestClass.method.get_key(t1, 'a')
+        cache.add('%s.lock' % key, 1)
+
+        def other_process_finishes(seconds):
+            cache.set(key, 42)
+
+        with patch('common.models.sleep', side_effect=other_process_finishes):
+            self.assertEqual(t1.method('a'), 42)
+        self.assertEqual(t1.called, 0)
+
+    def test_lock_wait_bounded(self):
+        t1 = TestClass(1)
+        key = TestClass.method.get_key(t1, 'a')
+        cache.add('%s.lock' % key, 1)
+        clock = [1000.0]
+
+        def sleep(seconds):
+            clock[0] += seconds
+
+        with patch('common.models.time', side_effect=lambda: clock[0]), \
+                patch('common.models.sleep', side_effect=sleep):
+            self.assertEqual(t1.method('a'), 2)
+        self.assertEqual(t1.called, 1)
+        self.assertLessEqual(clock[0] - 1000.0, LOCK_WAIT_SECONDS + 0.1)
+
+
+class LocalCacheTestCase(TestCase):
+    def test_expiry(self):
+        lc = LocalCache(2)
+        lc.set('a', 1, 10)
+        self.assertEqual(lc.get('a', 5), 1)
+        self.assertIs(lc.get('a', 11), MISSING)
+
+    def test_eviction(self):
+        lc = LocalCache(2)
+        lc.set('a', 1, 10)
+        lc.set('b', 2, 10)
+        lc.get('a', 5)
+        lc.set('c', 3, 10)
+        self.assertEqual(lc.get('a', 5), 1)
+        self.assertEqual(lc.get('c', 5), 3)
+        self.assertIs(lc.get('b', 5), MISSING)
+        self.assertEqual(len(lc.data), 2)
+
 
 class TestHumanSortField(TestCase):
 
@@ -101,3 +189,47 @@ class ActivityContextTestCase(TestCase):
         gen.next()
         with self.assertRaises(self.MyException):
             gen.throw(self.MyException('test\xbe'))
+
+
+class BulkInsertTestCase(TestCase):
+    def test_bulk_insert(self):
+        receiver = MagicMock()
+        post_save.connect(receiver, sender=User, weak=False)
+        try:
+            users = bulk_insert(User, [User(username='bulk%d' % i)
+                                       for i in range(3)])
+        finally:
+            post_save.disconnect(receiver, sender=User)
+        self.assertFalse(receiver.called)
+        self.assertEqual(
+            set(user.pk for user in users),
+            set(User.objects.filter(username__startswith='bulk')
+                .values_list('pk', flat=True)))
+        self.assertEqual(3, len(set(user.pk for user in users)))
+        for user in users:
+            self.assertFalse(user._state.adding)
+
+
+@override_settings(CACHES={'default': {
+    'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+class TokenTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.addCleanup(cache.clear)
+
+    def test_tokens(self):
+        tokens = get_tokens('test', [1, 2])
+        self.assertEqual(tokens, get_tokens('test', [1, 2]))
+        touch_tokens('test', [1])
+        changed = get_tokens('test', [1, 2])
+        self.assertNotEqual(tokens[1], changed[1])
+        self.assertEqual(tokens[2], changed[2])
+        touch_tokens('test')
+        self.assertNotEqual(changed[2], get_tokens('test', [2])[2])
+
+    def test_touch_on_commit(self):
+        tokens = get_tokens('test', [1])
+        touch_tokens_on_commit('test', [1])
+        self.assertEqual(tokens, get_tokens('test', [1]))
+        run_commit_hooks()
+        self.assertNotEqual(tokens, get_tokens('test', [1]))
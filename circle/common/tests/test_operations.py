@@ -19,7 +19,7 @@ from mock import MagicMock, patch
 
 from django.test import TestCase
 
-from ..operations import Operation
+from ..operations import OperatedMixin, Operation, register_operation
 
 
 class OperationTestCase(TestCase):
@@ -85,9 +85,34 @@ class OperationTestCase(TestCase):
         with patch.object(TestOp, 'create_activity'):
             self.assertRaises(TypeError, op.call, system=True)
 
+    def test_argspec_cached(self):
+        self.assertEqual(TestOp.get_argspec().args, ['self', 'foo'])
+        with patch('common.operations.getargspec') as getargspec:
+            TestOp.get_argspec()
+            self.assertFalse(getargspec.called)
+
+
+class OperatedMixinTestCase(TestCase):
+    def test_bound_operation_kept(self):
+        subject = TestSubject()
+        self.assertIs(subject.test, subject.test)
+        self.assertIs(subject.test.subject, subject)
+        self.assertIsNot(TestSubject().test, subject.test)
+
+    def test_unknown_operation(self):
+        with self.assertRaises(AttributeError):
+            TestSubject().foo
+
 
 class TestOp(Operation):
     id = 'test'
 
     def _operation(self, foo):
         pass
+
+
+class TestSubject(OperatedMixin):
+    pass
+
+
+register_operation(TestOp, target_cls=TestSubject)
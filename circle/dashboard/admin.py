@@ -18,10 +18,13 @@
 # -*- coding: utf-8 -*-
 
 from django import contrib
+from django.utils.html import format_html, format_html_join
+from django.utils.translation import ugettext_lazy as _
 from django.contrib.auth.admin import UserAdmin, GroupAdmin
 from django.contrib.auth.models import User, Group
 
-from dashboard.models import Profile, GroupProfile, ConnectCommand, Message
+from dashboard.models import (
+    Profile, GroupProfile, ConnectCommand, Message, SlowRequest)
 
 
 class ProfileInline(contrib.admin.TabularInline):
@@ -45,3 +48,31 @@ contrib.admin.site.unregister(Group)
 contrib.admin.site.register(Group, GroupAdmin)
 
 contrib.admin.site.register(Message)
+
+
+class SlowRequestAdmin(contrib.admin.ModelAdmin):
+    list_display = ('path', 'method', 'view', 'status_code', 'duration',
+                    'query_count', 'query_time', 'similar_queries',
+                    'cache_hits', 'cache_misses', 'render_time', 'user',
+                    'created')
+    list_filter = ('view', 'method', 'status_code')
+    search_fields = ('path', 'view')
+    exclude = ('queries', )
+    readonly_fields = ('path', 'method', 'view', 'user', 'status_code',
+                       'duration', 'query_count', 'query_time',
+                       'similar_queries', 'cache_hits', 'cache_misses',
+                       'render_time', 'query_trace')
+
+    def has_add_permission(self, request):
+        return False
+
+    def query_trace(self, obj):
+        return format_html(
+            '<table>{}</table>', format_html_join(
+                '', '<tr><td>{}</td><td>{}&nbsp;ms</td><td>{}</td></tr>',
+                ((q['alias'], '%.1f' % (q['time'] * 1000), q['sql'])
+                 for q in obj.queries)))
+    query_trace.short_description = _('query trace')
+
+
+contrib.admin.site.register(SlowRequest, SlowRequestAdmin)
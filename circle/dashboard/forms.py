@@ -54,6 +54,7 @@ from firewall.models import Vlan, Host
 from vm.models import (
     InstanceTemplate, Lease, InterfaceTemplate, Node, Trait, Instance
 )
+from vm.models.node import get_trait_index, mask_traits, trait_mask
 from storage.models import DataStore, Disk
 from django.contrib.admin.widgets import FilteredSelectMultiple
 from django.contrib.auth.models import Permission
@@ -997,12 +998,14 @@ class DeployChoiceField(forms.ModelChoiceField):
     def __init__(self, *args, **kwargs):
         self.instance = kwargs.pop("instance")
         super(DeployChoiceField, self).__init__(*args, **kwargs)
+        self.req_traits = {t.pk: t for t in self.instance.req_traits.all()}
+        self.traits = trait_mask(self.req_traits)
+        self.trait_index = get_trait_index()
 
     def label_from_instance(self, obj):
-        traits = set(obj.traits.all())
-        req_traits = set(self.instance.req_traits.all())
+        missing = self.trait_index.missing_traits(obj, self.traits)
         # if the subset is empty the node satisfies the required traits
-        subset = req_traits - traits
+        subset = [self.req_traits[pk] for pk in mask_traits(missing)]
 
         label = "%s %s" % (
             "&#xf071" if subset else "&#xf00c;", escape(obj.name),
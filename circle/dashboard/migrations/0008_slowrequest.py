@@ -0,0 +1,46 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+import jsonfield.fields
+import model_utils.fields
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('dashboard', '0007_profile_network_limit'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SlowRequest',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created', model_utils.fields.AutoCreatedField(default=django.utils.timezone.now, editable=False, verbose_name='created')),
+                ('modified', model_utils.fields.AutoLastModifiedField(default=django.utils.timezone.now, editable=False, verbose_name='modified')),
+                ('path', models.CharField(max_length=500, verbose_name='path')),
+                ('method', models.CharField(max_length=10, verbose_name='method')),
+                ('view', models.CharField(blank=True, db_index=True, max_length=100, verbose_name='view')),
+                ('status_code', models.PositiveSmallIntegerField(verbose_name='status code')),
+                ('duration', models.FloatField(db_index=True, verbose_name='duration')),
+                ('query_count', models.IntegerField(verbose_name='queries')),
+                ('query_time', models.FloatField(verbose_name='query time')),
+                ('similar_queries', models.IntegerField(help_text='The most queries differing only in their parameters, a sign of queries made in a loop.', verbose_name='similar queries')),
+                ('cache_hits', models.IntegerField(verbose_name='cache hits')),
+                ('cache_misses', models.IntegerField(verbose_name='cache misses')),
+                ('render_time', models.FloatField(blank=True, null=True, verbose_name='render time')),
+                ('queries', jsonfield.fields.JSONField(default=list, verbose_name='queries')),
+                ('user', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, to=settings.AUTH_USER_MODEL, verbose_name='user')),
+            ],
+            options={
+                'ordering': ('-duration',),
+                'verbose_name': 'slow request',
+                'verbose_name_plural': 'slow requests',
+            },
+        ),
+    ]
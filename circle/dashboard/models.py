@@ -28,7 +28,8 @@ from django.contrib.auth.signals import user_logged_in
 from django.core.urlresolvers import reverse
 from django.db.models import (
     Model, ForeignKey, OneToOneField, CharField, IntegerField, TextField,
-    DateTimeField, BooleanField
+    DateTimeField, BooleanField, FloatField, PositiveSmallIntegerField,
+    SET_NULL,
 )
 from django.db.models.signals import post_save, pre_delete, post_delete
 from django.templatetags.static import static
@@ -319,6 +320,39 @@ class GroupProfile(AclBase):
                        kwargs={'pk': self.group.pk})
 
 
+class SlowRequest(TimeStampedModel):
+    """The query trace of one of the slowest requests, see
+    dashboard.profiling.  Times are in milliseconds.
+    """
+    path = CharField(max_length=500, verbose_name=_('path'))
+    method = CharField(max_length=10, verbose_name=_('method'))
+    view = CharField(max_length=100, blank=True, db_index=True,
+                     verbose_name=_('view'))
+    user = ForeignKey(User, null=True, blank=True, on_delete=SET_NULL,
+                      verbose_name=_('user'))
+    status_code = PositiveSmallIntegerField(verbose_name=_('status code'))
+    duration = FloatField(db_index=True, verbose_name=_('duration'))
+    query_count = IntegerField(verbose_name=_('queries'))
+    query_time = FloatField(verbose_name=_('query time'))
+    similar_queries = IntegerField(
+        verbose_name=_('similar queries'),
+        help_text=_('The most queries differing only in their parameters, '
+                    'a sign of queries made in a loop.'))
+    cache_hits = IntegerField(verbose_name=_('cache hits'))
+    cache_misses = IntegerField(verbose_name=_('cache misses'))
+    render_time = FloatField(null=True, blank=True,
+                             verbose_name=_('render time'))
+    queries = JSONField(default=list, verbose_name=_('queries'))
+
+    class Meta:
+        ordering = ('-duration', )
+        verbose_name = _('slow request')
+        verbose_name_plural = _('slow requests')
+
+    def __unicode__(self):
+        return u"%s %s (%.0f ms)" % (self.method, self.path, self.duration)
+
+
 def get_or_create_profile(self):
     obj, created = GroupProfile.objects.get_or_create(group_id=self.pk)
     return obj
@@ -0,0 +1,256 @@
+# Copyright 2014 Budapest University of Technology and Economics (BME IK)
+#
+# This file is part of CIRCLE Cloud.
+#
+# CIRCLE is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# CIRCLE is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along
+# with CIRCLE.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""Opt-in profiling of the views.
+
+ProfilingMiddleware records the wall time, the SQL queries, the cache hits
+and misses and the template render time of each request, and sends them
+to Graphite per URL name.  The query traces of the PROFILE_KEEP_SLOWEST
+slowest requests are kept as SlowRequest objects, browsable in the admin.
+
+Enable it with the DJANGO_PROFILE_VIEWS=True environment variable.
+"""
+
+from __future__ import absolute_import
+
+from collections import Counter
+from logging import getLogger
+from threading import local
+from time import time
+import re
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import connections
+from django.utils.deprecation import MiddlewareMixin
+
+from monitor.client import Client
+
+logger = getLogger(__name__)
+
+# queries of a request kept in its trace
+MAX_TRACE_QUERIES = 1000
+MAX_SQL_LENGTH = 2000
+# seconds between reading the duration of the slowest requests again
+THRESHOLD_INTERVAL = 60
+
+_local = local()
+_missing = object()
+
+
+class RequestStats(object):
+    """The statistics of the request being processed by this thread.
+    """
+
+    def __init__(self):
+        self.start = time()
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.render_start = None
+        self.render_time = None
+
+
+def get_stats():
+    """Return the statistics of the current request, or None if it is not
+    being profiled.
+    """
+    return getattr(_local, 'stats', None)
+
+
+def instrument_cache(backend):
+    """Count the hits and misses of the cache backend in the statistics of
+    the current request.
+
+    Cache backends are created for each thread, so patching the instance
+    is safe.
+    """
+    if getattr(backend, '_profiled', False):
+        return
+    get, get_many = backend.get, backend.get_many
+
+    def profiled_get(key, default=None, version=None):
+        value = get(key, _missing, version=version)
+        stats = get_stats()
+        if stats is not None:
+            if value is _missing:
+                stats.cache_misses += 1
+            else:
+                stats.cache_hits += 1
+        return default if value is _missing else value
+
+    def profiled_get_many(keys, version=None):
+        keys = list(keys)
+        # the default get_many calls get for each key
+        stats, _local.stats = get_stats(), None
+        try:
+            result = get_many(keys, version=version)
+        finally:
+            _local.stats = stats
+        if stats is not None:
+            stats.cache_hits += len(result)
+            stats.cache_misses += len(keys) - len(result)
+        return result
+
+    backend.get = profiled_get
+    backend.get_many = profiled_get_many
+    backend._profiled = True
+
+
+def normalize_sql(sql):
+    """Return the statement with the literals replaced, so the queries of
+    an N+1 pattern are equal.
+    """
+    return re.sub(r"'(?:[^']|'')*'|\b\d+\b", '?', sql)
+
+
+def get_queries():
+    """Return the queries logged by the connections during the request.
+
+    The query logs are reset when a request starts.
+    """
+    queries = []
+    for connection in connections.all():
+        for query in connection.queries_log:
+            queries.append({'alias': connection.alias,
+                            'sql': query['sql'],
+                            'time': float(query['time'])})
+    return queries
+
+
+def clean_metric_name(name):
+    return re.sub(r'[^\w-]', '_', name or 'none')
+
+
+def send_metrics(view, values, now):
+    try:
+        client = Client()
+    except RuntimeError as e:
+        logger.debug('Not sending view metrics: %s', unicode(e))
+        return
+    prefix = '%s.views.%s' % (client.name, clean_metric_name(view))
+    client.send(['%s.%s %f %d' % (prefix, name, value, now)
+                 for name, value in values.iteritems() if value is not None])
+
+
+# 'threshold': (time of reading, duration of the slowest kept request)
+local_threshold = {}
+
+
+def get_threshold():
+    """Return the duration a request has to exceed to be kept, or 0 if
+    fewer than PROFILE_KEEP_SLOWEST requests are kept.
+    """
+    from .models import SlowRequest
+
+    now = time()
+    read, threshold = local_threshold.get('threshold', (0, 0))
+    if now - read > THRESHOLD_INTERVAL:
+        durations = SlowRequest.objects.order_by('-duration').values_list(
+            'duration', flat=True)
+        keep = settings.PROFILE_KEEP_SLOWEST
+        threshold = next(iter(durations[keep - 1:keep]), 0)
+        local_threshold['threshold'] = (now, threshold)
+    return threshold
+
+
+def keep_slow_request(request, response, view, values, queries):
+    """Store the trace of the request if it is among the slowest ones.
+    """
+    from .models import SlowRequest
+
+    keep = settings.PROFILE_KEEP_SLOWEST
+    if keep <= 0 or values['time'] <= get_threshold():
+        return
+    user = getattr(request, 'user', None)
+    SlowRequest.objects.create(
+        path=request.get_full_path()[:500],
+        method=request.method,
+        view=view or '',
+        user=user if user is not None and user.is_authenticated() else None,
+        status_code=response.status_code,
+        duration=values['time'],
+        query_count=values['queries'],
+        query_time=values['query_time'],
+        similar_queries=values['similar_queries'],
+        cache_hits=values['cache_hits'],
+        cache_misses=values['cache_misses'],
+        render_time=values['render_time'],
+        queries=[dict(q, sql=q['sql'][:MAX_SQL_LENGTH])
+                 for q in queries[:MAX_TRACE_QUERIES]])
+    outdated = SlowRequest.objects.order_by('-duration').values_list(
+        'id', flat=True)[keep:]
+    SlowRequest.objects.filter(id__in=list(outdated)).delete()
+    local_threshold.pop('threshold', None)
+
+
+class ProfilingMiddleware(MiddlewareMixin):
+    """Record the statistics of each request.  Times are in milliseconds.
+    """
+
+    def process_request(self, request):
+        for alias in settings.CACHES:
+            instrument_cache(caches[alias])
+        request._debug_cursors = [(c, c.force_debug_cursor)
+                                  for c in connections.all()]
+        for connection, previous in request._debug_cursors:
+            connection.force_debug_cursor = True
+        _local.stats = RequestStats()
+
+    def process_template_response(self, request, response):
+        stats = get_stats()
+        if stats is not None:
+            stats.render_start = time()
+
+            def rendered(response):
+                stats.render_time = (time() - stats.render_start) * 1000
+
+            response.add_post_render_callback(rendered)
+        return response
+
+    def process_response(self, request, response):
+        stats = get_stats()
+        _local.stats = None
+        for connection, previous in getattr(request, '_debug_cursors', ()):
+            connection.force_debug_cursor = previous
+        if stats is None:
+            return response
+        try:
+            self.record(request, response, stats)
+        except Exception:
+            logger.exception('Recording the profile of %s failed.',
+                             request.path)
+        return response
+
+    def record(self, request, response, stats):
+        now = time()
+        match = getattr(request, 'resolver_match', None)
+        view = (match.url_name or match.view_name) if match else None
+        queries = get_queries()
+        similar = Counter(normalize_sql(q['sql']) for q in queries)
+        values = {
+            'time': (now - stats.start) * 1000,
+            'queries': len(queries),
+            'query_time': sum(q['time'] for q in queries) * 1000,
+            'similar_queries': max(similar.values()) if similar else 0,
+            'cache_hits': stats.cache_hits,
+            'cache_misses': stats.cache_misses,
+            'render_time': stats.render_time,
+        }
+        if view is not None:
+            send_metrics(view, values, now)
+        keep_slow_request(request, response, view, values, queries)
@@ -0,0 +1,107 @@
+# Copyright 2014 Budapest University of Technology and Economics (BME IK)
+#
+# This file is part of CIRCLE Cloud.
+#
+# CIRCLE is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# CIRCLE is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along
+# with CIRCLE.  If not, see <http://www.gnu.org/licenses/>.
+
+
+from django.conf import settings
+from django.core.cache import caches
+from django.test import TestCase, override_settings
+from mock import patch
+
+from ..models import SlowRequest
+from ..profiling import (
+    RequestStats, _local, instrument_cache, local_threshold, normalize_sql,
+)
+
+
+class NormalizeSqlTestCase(TestCase):
+
+    def test_literals(self):
+        self.assertEqual(
+            normalize_sql("SELECT * FROM a WHERE id = 12 AND name = 'x''y'"),
+            "SELECT * FROM a WHERE id = ? AND name = ?")
+
+    def test_names_kept(self):
+        self.assertEqual(normalize_sql('SELECT "t1"."id2" FROM "t1"'),
+                         'SELECT "t1"."id2" FROM "t1"')
+
+
+@override_settings(CACHES={'default': {
+    'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+class InstrumentCacheTestCase(TestCase):
+
+    def setUp(self):
+        self.cache = caches['default']
+        instrument_cache(self.cache)
+        self.cache.clear()
+        _local.stats = RequestStats()
+
+    def tearDown(self):
+        _local.stats = None
+        self.cache.clear()
+
+    def test_get(self):
+        self.cache.set('a', 1)
+        self.assertEqual(self.cache.get('a'), 1)
+        self.assertEqual(self.cache.get('b', 2), 2)
+        self.assertIsNone(self.cache.get('c'))
+        self.assertEqual(_local.stats.cache_hits, 1)
+        self.assertEqual(_local.stats.cache_misses, 2)
+
+    def test_get_many(self):
+        self.cache.set('a', 1)
+        self.assertEqual(self.cache.get_many(iter(['a', 'b'])), {'a': 1})
+        self.assertEqual(_local.stats.cache_hits, 1)
+        self.assertEqual(_local.stats.cache_misses, 1)
+
+    def test_not_profiled(self):
+        _local.stats = None
+        self.cache.set('a', 1)
+        self.assertEqual(self.cache.get('a'), 1)
+
+
+@override_settings(
+    MIDDLEWARE_CLASSES=(('dashboard.profiling.ProfilingMiddleware', ) +
+                        settings.MIDDLEWARE_CLASSES),
+    PROFILE_KEEP_SLOWEST=2)
+class ProfilingMiddlewareTestCase(TestCase):
+
+    def setUp(self):
+        local_threshold.clear()
+        patcher = patch('dashboard.profiling.send_metrics')
+        self.send_metrics = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        local_threshold.clear()
+
+    def test_metrics(self):
+        response = self.client.get('/accounts/login/')
+        self.assertEqual(response.status_code, 200)
+        view, values, now = self.send_metrics.call_args[0]
+        self.assertEqual(view, 'accounts.login')
+        self.assertGreater(values['time'], 0)
+        self.assertIsNotNone(values['render_time'])
+        self.assertIn('queries', values)
+
+    def test_keep_slowest(self):
+        for i in range(3):
+            self.client.get('/accounts/login/')
+        self.assertEqual(SlowRequest.objects.count(), 2)
+        slow = SlowRequest.objects.all()[0]
+        self.assertEqual(slow.path, '/accounts/login/')
+        self.assertEqual(slow.view, 'accounts.login')
+        self.assertEqual(slow.query_count, len(slow.queries))
@@ -27,12 +27,15 @@ from django.contrib.auth import authenticate
 
 from common.tests.celery_mock import MockCeleryMixin
 from dashboard.views import VmAddInterfaceView
-from vm.models import Instance, InstanceTemplate, Lease, Node, Trait
+from vm.models import (Instance, InstanceTemplate, InterfaceTemplate, Lease,
+                       Node, Trait)
 from vm.operations import (WakeUpOperation, AddInterfaceOperation,
                            AddPortOperation, RemoveInterfaceOperation,
                            DeployOperation, RenameOperation)
 from ..models import Profile
 from firewall.models import Vlan, Host, VlanGroup
+from storage.models import Disk
+from manager.latency import Histogram
 from mock import Mock, patch
 from django_sshkey.models import UserKey
 
@@ -532,7 +535,7 @@ class VmDetailTest(LoginMixin, MockCeleryMixin, TestCase):
         self.login(c, "superuser")
 
         instance_count = Instance.objects.all().count()
-        with patch.object(DeployOperation, 'async') as async:
+        with patch.object(Instance, 'mass_deploy') as mass_deploy:
             response = c.post("/dashboard/vm/create/", {
                 'name': 'vm',
                 'amount': 2,
@@ -542,10 +545,80 @@ class VmDetailTest(LoginMixin, MockCeleryMixin, TestCase):
                 'network': [],
             })
 
-        assert async.called
+        assert mass_deploy.called
         self.assertEqual(response.status_code, 302)
         self.assertEqual(instance_count + 2, Instance.objects.all().count())
 
+    def test_mass_create_from_template(self):
+        template = InstanceTemplate.objects.get(pk=1)
+        vlan = Vlan.objects.get(pk=2)
+        vlan.set_level(self.u1, 'user')
+        networks = [InterfaceTemplate(vlan=vlan, managed=True)]
+        with patch('firewall.models.reloadtask') as reloadtask:
+            insts = Instance.mass_create_from_template(
+                template, self.u1, amount=3, networks=networks,
+                tags=['lab'])
+        reloadtask.apply_async.assert_called_once_with(
+            queue='localhost.man', args=['Host'])
+        self.assertEqual(3, len(set(inst.pk for inst in insts)))
+        addresses = set()
+        for inst in Instance.objects.filter(pk__in=[i.pk for i in insts]):
+            self.assertTrue(inst.has_level(self.u1, 'owner'))
+            self.assertEqual(template.disks.get(),
+                             inst.disks.get().base)
+            host = inst.interface_set.get().host
+            self.assertEqual(inst.vm_name, host.hostname)
+            self.assertTrue(host.record_set.filter(type='A').exists())
+            addresses.add(host.ipv4)
+            act = inst.activity_log.get(parent=None)
+            self.assertEqual('PENDING', act.resultant_state)
+            self.assertEqual('PENDING', inst.status)
+            self.assertTrue(act.children.get().succeeded)
+            self.assertEqual(['lab'], list(inst.tags.names()))
+        self.assertEqual(3, len(addresses))
+        self.assertEqual(['PENDING'] * 3, [inst.status for inst in insts])
+
+    def test_mass_deploy(self):
+        template = InstanceTemplate.objects.get(pk=1)
+        insts = Instance.mass_create_from_template(template, self.u1,
+                                                   amount=2, networks=[])
+        node = Node.objects.get(pk=1)
+        with patch.object(Instance, 'select_nodes',
+                          return_value=[node, node]), \
+                patch.object(Disk, 'mass_deploy',
+                             return_value={}) as mass_deploy, \
+                patch.object(DeployOperation, 'async') as async:
+            Instance._mass_deploy(insts, self.u1)
+        self.assertEqual(2, len(list(mass_deploy.call_args[0][0])))
+        self.assertEqual(2, async.call_count)
+        async.assert_called_with(user=self.u1, node=node)
+        for inst in insts:
+            self.assertTrue(inst.activity_log.get(
+                activity_code='vm.Instance.deploying_disks').succeeded)
+            batch = inst.batch_activity_log.get()
+            self.assertTrue(batch.succeeded)
+            self.assertEqual(2, batch.instances.count())
+
+    def test_mass_deploy_skips_unavailable(self):
+        template = InstanceTemplate.objects.get(pk=1)
+        insts = Instance.mass_create_from_template(template, self.u1,
+                                                   amount=2, networks=[])
+        Instance.objects.filter(pk=insts[0].pk).update(status='RUNNING')
+        insts[0].refresh_from_db()
+        node = Node.objects.get(pk=1)
+        with patch.object(Instance, 'select_nodes',
+                          return_value=[node]) as select_nodes, \
+                patch.object(Disk, 'mass_deploy',
+                             return_value={}) as mass_deploy, \
+                patch.object(DeployOperation, 'async') as async:
+            Instance._mass_deploy(insts, self.u1)
+        select_nodes.assert_called_with([insts[1]])
+        self.assertEqual(1, len(list(mass_deploy.call_args[0][0])))
+        self.assertEqual(1, async.call_count)
+        self.assertFalse(insts[0].activity_log.filter(
+            activity_code='vm.Instance.deploying_disks').exists())
+        self.assertFalse(insts[0].batch_activity_log.exists())
+
     def test_unpermitted_description_update(self):
         c = Client()
         self.login(c, "user1")
@@ -643,6 +716,24 @@ class NodeDetailTest(LoginMixin, MockCeleryMixin, TestCase):
         response = c.get('/dashboard/node/1/')
         self.assertEqual(response.status_code, 302)
 
+    def test_task_latency_page(self):
+        histogram = Histogram()
+        histogram.add(0.5)
+        c = Client()
+        self.login(c, 'superuser')
+        with patch('dashboard.views.node.get_histograms') as get_histograms:
+            get_histograms.return_value = {
+                ('run', 'vm.tasks.deploy', 'node.vm.slow'): histogram}
+            response = c.get('/dashboard/node/task-latency/')
+        self.assertEqual(response.status_code, 200)
+        self.assertContains(response, 'vm.tasks.deploy')
+
+    def test_task_latency_page_not_permitted(self):
+        c = Client()
+        self.login(c, 'user1')
+        response = c.get('/dashboard/node/task-latency/')
+        self.assertEqual(response.status_code, 403)
+
     def test_permitted_node_delete(self):
         c = Client()
         self.login(c, 'superuser')
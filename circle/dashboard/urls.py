@@ -50,7 +50,7 @@ from .views import (
     TransferInstanceOwnershipView, TransferInstanceOwnershipConfirmView,
     TransferTemplateOwnershipView, TransferTemplateOwnershipConfirmView,
     OpenSearchDescriptionView,
-    NodeActivityView,
+    NodeActivityView, TaskLatencyView,
     UserList,
     StorageDetail, StorageList, StorageChoose, StorageCreate, DiskDetail,
     StorageDelete, StorageRestore, StorageRefreshCredential,
@@ -119,6 +119,8 @@ urlpatterns = [
         name='dashboard.views.vm-toggle-tutorial'),
 
     url(r'^node/list/$', NodeList.as_view(), name='dashboard.views.node-list'),
+    url(r'^node/task-latency/$', TaskLatencyView.as_view(),
+        name='dashboard.views.task-latency'),
     url(r'^node/(?P<pk>\d+)/$', NodeDetailView.as_view(),
         name='dashboard.views.node-detail'),
     url(r'^node/(?P<pk>\d+)/add-trait/$', NodeAddTraitView.as_view(),
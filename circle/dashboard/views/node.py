@@ -35,6 +35,7 @@ from braces.views import LoginRequiredMixin, SuperuserRequiredMixin
 from django_tables2 import SingleTableView
 
 from firewall.models import Host
+from manager.latency import get_histograms, PERCENTILES
 from vm.models import Node, NodeActivity, Trait
 from vm.tasks.vm_tasks import check_queue
 
@@ -214,6 +215,28 @@ class NodeList(LoginRequiredMixin, GraphMixin, SingleTableView):
             number_of_VMs=Count('instance_set')).select_related('host')
 
 
+class TaskLatencyView(LoginRequiredMixin, TemplateView):
+    template_name = "dashboard/task-latency.html"
+
+    def get(self, *args, **kwargs):
+        if not self.request.user.has_perm('vm.view_statistics'):
+            raise PermissionDenied()
+        return super(TaskLatencyView, self).get(*args, **kwargs)
+
+    def get_context_data(self, **kwargs):
+        context = super(TaskLatencyView, self).get_context_data(**kwargs)
+        rows = []
+        for (kind, task, target), histogram in sorted(
+                get_histograms().iteritems()):
+            rows.append({
+                'kind': kind, 'task': task, 'target': target,
+                'count': histogram.count, 'mean': histogram.mean * 1000,
+                'percentiles': [histogram.percentile(p) * 1000
+                                for p in PERCENTILES]})
+        context.update({'rows': rows, 'percentiles': PERCENTILES})
+        return context
+
+
 class NodeCreate(LoginRequiredMixin, SuperuserRequiredMixin, TemplateView):
 
     form_class = HostForm
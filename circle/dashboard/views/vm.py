@@ -75,7 +75,7 @@ from ..forms import (
 from request.models import TemplateAccessType, LeaseType
 from request.forms import LeaseRequestForm, TemplateRequestForm
 from ..models import Favourite
-from manager.scheduler import has_traits
+from vm.models.node import get_trait_index, trait_mask
 
 logger = logging.getLogger(__name__)
 
@@ -322,13 +322,13 @@ def get_operations(instance, user):
     ops = []
     for k, v in vm_ops.iteritems():
         try:
-            op = v.get_op_by_object(instance)
-            op.check_auth(user)
-            op.check_precond()
-        except PermissionDenied as e:
+            error = v.get_op_by_object(instance).get_availability(user)
+        except Exception as e:
+            error = e
+        if isinstance(error, PermissionDenied):
             logger.debug('Not showing operation %s for %s: %s',
-                         k, instance, unicode(e))
-        except Exception:
+                         k, instance, unicode(error))
+        elif error is not None:
             ops.append(v.bind_to_object(instance, disabled=True))
         else:
             ops.append(v.bind_to_object(instance))
@@ -505,10 +505,11 @@ class VmMigrateView(FormOperationMixin, VmOperationView):
 
         inst = self.get_object()
         if isinstance(inst, Instance):
+            traits = trait_mask(inst.req_traits.all())
             nodes_w_traits = [
-                n.pk for n in Node.objects.filter(enabled=True)
-                if n.online and
-                has_traits(inst.req_traits.all(), n)
+                n.pk for n in get_trait_index().filter_nodes(
+                    Node.objects.filter(enabled=True), traits)
+                if n.online
             ]
             ctx['nodes_w_traits'] = nodes_w_traits
 
@@ -924,7 +925,10 @@ class MassOperationView(OperationView):
 
     def get_object(self):
         vms = getattr(self.request, self.request.method).getlist("vm")
-        return Instance.objects.filter(pk__in=vms)
+        instances = list(Instance.objects.filter(pk__in=vms))
+        # fill the level cache of the user for the ACL checks at once
+        Instance.get_user_weights(instances, self.request.user)
+        return instances
 
     def _get_operable_instances(self, instances, user):
         for i in instances:
@@ -1187,8 +1191,11 @@ class VmCreate(LoginRequiredMixin, TemplateView):
     def __deploy(self, request, instances, *args, **kwargs):
         # workaround EncodeError: dictionary changed size during iteration
         user = User.objects.get(pk=request.user.pk)
-        for i in instances:
-            i.deploy.async(user=user)
+        if len(instances) > 1:
+            Instance.mass_deploy(instances, user)
+        else:
+            for i in instances:
+                i.deploy.async(user=user)
 
         if len(instances) > 1:
             messages.success(request, ungettext_lazy(
@@ -0,0 +1,483 @@
+# Copyright 2014 Budapest University of Technology and Economics (BME IK)
+#
+# This file is part of CIRCLE Cloud.
+#
+# CIRCLE is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# CIRCLE is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along
+# with CIRCLE.  If not, see <http://www.gnu.org/licenses/>.
+
+import logging
+import random
+from time import time
+
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import CharField, Q
+from django.db.models.functions import Cast
+from netaddr import IPAddress
+
+from common.models import get_tokens, touch_tokens_on_commit
+
+from .models import Host
+
+logger = logging.getLogger(__name__)
+
+# seconds an allocated but not yet saved address is kept from others
+RESERVATION_TIMEOUT = 120
+# random probes before falling back to a scan of the network
+RANDOM_PROBES = 8
+
+
+def address_to_int(address):
+    """Convert an address, or its string form stored by IPAddressField,
+    to an integer.
+
+    Parsing the stored form directly is several times faster than
+    creating an IPAddress object of each address.
+    """
+    if isinstance(address, (int, long)):
+        return address
+    if isinstance(address, basestring):
+        address = address.split('/')[0]
+        parts = address.split('.')
+        if len(parts) == 4:
+            return (int(parts[0]) << 24 | int(parts[1]) << 16 |
+                    int(parts[2]) << 8 | int(parts[3]))
+        parts = address.split(':')
+        if len(parts) == 8 and all(len(part) == 4 for part in parts):
+            return int(''.join(parts), 16)
+    return int(IPAddress(address))
+
+
+def raw_values(queryset, field):
+    """Return the values of an address field as stored in the database.
+    """
+    raw = Cast(field, CharField(max_length=100))
+    return queryset.annotate(raw_value=raw).values_list('raw_value',
+                                                        flat=True)
+
+
+class AddressIndex(object):
+    """Index of the free IPv4 addresses of a vlan.
+
+    Each address of the network is represented by one byte, so finding a
+    free address is a random probe or a substring search in C instead of
+    walking the network address by address.
+
+    Addresses handed out are held until a host using them is marked, or
+    until their reservation expires.
+    """
+
+    def __init__(self, network4, used_v4=(), used_v6=()):
+        self.first = network4.first
+        self.used = bytearray(network4.size)
+        # position: (expiry, IPv6 address) of the held addresses
+        self.held = {}
+        if network4.prefixlen < 31:
+            # network and broadcast addresses
+            self.used[0] = self.used[-1] = 1
+        self.mark(network4.ip)
+        for ipv4 in used_v4:
+            self.mark(ipv4)
+        self.used_v6 = set(address_to_int(ipv6) for ipv6 in used_v6)
+
+    def mark(self, ipv4):
+        """Mark the address as used, if it is part of the network.
+        """
+        pos = address_to_int(ipv4) - self.first
+        if 0 <= pos < len(self.used):
+            self.used[pos] = 1
+            self.held.pop(pos, None)
+
+    def unmark(self, ipv4):
+        """Mark the address as free, if it is part of the network.
+        """
+        pos = address_to_int(ipv4) - self.first
+        if 0 <= pos < len(self.used):
+            self.used[pos] = 0
+            self.held.pop(pos, None)
+
+    def hold(self, ipv4, ipv6, expires):
+        """Keep the handed out address pair used until expires.
+        """
+        self.held[address_to_int(ipv4) - self.first] = (expires, ipv6)
+        if ipv6 is not None:
+            self.used_v6.add(ipv6)
+
+    def release_expired(self, now):
+        """Free the held addresses whose reservation has expired without
+        a host using them being marked.
+        """
+        for pos, (expires, ipv6) in self.held.items():
+            if expires <= now:
+                del self.held[pos]
+                self.used[pos] = 0
+                self.used_v6.discard(ipv6)
+
+    def is_free(self, ipv4):
+        pos = address_to_int(ipv4) - self.first
+        return 0 <= pos < len(self.used) and not self.used[pos]
+
+    def free_count(self):
+        return self.used.count(b'\0')
+
+    def find_free(self):
+        """Return a random free address and mark it used, or None if the
+        network is full.
+        """
+        size = len(self.used)
+        for i in xrange(RANDOM_PROBES):
+            pos = random.randrange(size)
+            if not self.used[pos]:
+                break
+        else:
+            start = random.randrange(size)
+            pos = self.used.find(b'\0', start)
+            if pos == -1:
+                pos = self.used.find(b'\0', 0, start)
+            if pos == -1:
+                return None
+        self.used[pos] = 1
+        return IPAddress(self.first + pos, 4)
+
+
+# vlan pk: (token, index) of the last built index of each vlan
+address_index_cache = {}
+
+
+def touch_address_indexes(vlans=None):
+    """Mark the address index of the given vlans, or all vlans if vlans is
+    None, as changed when the transaction is committed.
+
+    Only needed when the network of a vlan changes, saved hosts update the
+    indexes in place.
+    """
+    touch_tokens_on_commit('vlan_addresses', vlans)
+
+
+def host_addresses(vlan, ipv4, ipv6, external_ipv4):
+    """Return the (vlan pk, ipv4, ipv6, external ipv4) tuple of a host
+    with the addresses in integer form, as used by update_address_indexes.
+    """
+    return (vlan, ) + tuple(address_to_int(address) if address else None
+                            for address in (ipv4, ipv6, external_ipv4))
+
+
+def update_address_indexes(added=(), removed=()):
+    """Mark the addresses of the added hosts used and the addresses of the
+    removed ones free in the address indexes of this process, when the
+    transaction is committed.
+
+    :param added: host_addresses of the saved hosts
+    :param removed: host_addresses of the deleted hosts and of the old
+                    addresses of the changed ones
+
+    Other processes check the addresses they allocate against the
+    database, and build their index again when it is full.
+    """
+    added = list(added)
+    removed = list(removed)
+    if added or removed:
+        transaction.on_commit(
+            lambda: apply_address_changes(added, removed))
+
+
+def apply_address_changes(added, removed):
+    if not address_index_cache:
+        return
+    # addresses still used by another host, like shared external ones
+    used = get_used_addresses(
+        set(address for host in removed for address in (host[1], host[3])
+            if address is not None),
+        set(host[2] for host in removed if host[2] is not None))
+    for pk, (token, index) in address_index_cache.items():
+        for vlan, ipv4, ipv6, external_ipv4 in removed:
+            for address in set([ipv4, external_ipv4]) - used - set([None]):
+                index.unmark(address)
+            if pk == vlan and ipv6 not in used:
+                index.used_v6.discard(ipv6)
+        for vlan, ipv4, ipv6, external_ipv4 in added:
+            for address in set([ipv4, external_ipv4]) - set([None]):
+                index.mark(address)
+            if pk == vlan and ipv6 is not None:
+                index.used_v6.add(ipv6)
+
+
+def get_used_addresses(v4=(), v6=()):
+    """Return the integer form of the given IPv4 and IPv6 addresses saved
+    to a host.
+    """
+    v4 = [IPAddress(address_to_int(address), 4) for address in v4]
+    v6 = [IPAddress(address_to_int(address), 6) for address in v6]
+    if not v4 and not v6:
+        return set()
+    used = set()
+    for row in Host.objects.filter(
+            Q(ipv4__in=v4) | Q(external_ipv4__in=v4) |
+            Q(ipv6__in=v6)).values_list('ipv4', 'external_ipv4', 'ipv6'):
+        used.update(int(address) for address in row if address is not None)
+    return used
+
+
+def build_address_index(vlan):
+    hosts = Host.objects.filter(vlan=vlan)
+    used_v4 = list(raw_values(hosts, 'ipv4'))
+    used_v4.extend(raw_values(Host.objects.filter(
+        external_ipv4__isnull=False).distinct(), 'external_ipv4'))
+    used_v6 = raw_values(hosts.exclude(ipv6__isnull=True), 'ipv6')
+    return AddressIndex(vlan.network4, used_v4, used_v6)
+
+
+def get_address_index(vlan, rebuild=False):
+    """Return the address index of the vlan, built again only if the
+    network of the vlan has changed since the last call, or rebuild is
+    set.
+    """
+    token = get_tokens('vlan_addresses', [vlan.pk])[vlan.pk]
+    cached = address_index_cache.get(vlan.pk)
+    if (rebuild or None in token or cached is None or cached[0] != token or
+            cached[1].first != vlan.network4.first or
+            len(cached[1].used) != vlan.network4.size):
+        index = build_address_index(vlan)
+        if cached is not None and cached[1].first == index.first:
+            # addresses handed out by this process, but not saved yet
+            for pos, (expires, ipv6) in cached[1].held.items():
+                if pos < len(index.used) and not index.used[pos]:
+                    index.used[pos] = 1
+                    index.hold(index.first + pos, ipv6, expires)
+        cached = (token, index)
+        address_index_cache[vlan.pk] = cached
+    cached[1].release_expired(time())
+    return cached[1]
+
+
+def reserve_address(ipv4, timeout=RESERVATION_TIMEOUT):
+    """Reserve the address for the caller until the host using it is saved.
+
+    Return False if somebody else has already reserved it.  The reservation
+    is an atomic add to the shared cache, so concurrent allocations in
+    different processes can not get the same address.
+    """
+    return cache.add('vlan_address_reservation_%s' % ipv4, True, timeout)
+
+
+def release_address(ipv4):
+    cache.delete('vlan_address_reservation_%s' % ipv4)
+
+
+def reserve_free_addresses(vlan, index, count):
+    """Return at most count address pairs free in the index and reserved.
+    """
+    result = []
+    while len(result) < count:
+        ipv4 = index.find_free()
+        if ipv4 is None:
+            break
+        ipv6 = None
+        if vlan.network6 is not None:
+            ipv6 = vlan.convert_ipv4_to_ipv6(ipv4)
+            if int(ipv6) in index.used_v6:
+                continue
+        if not reserve_address(ipv4):
+            logger.debug("IPv4 address %s is reserved, skipping.", ipv4)
+            continue
+        result.append({'ipv4': ipv4, 'ipv6': ipv6})
+    return result
+
+
+def allocate_addresses(vlan, count=1):
+    """Return count reserved, unused address pairs of the vlan as dicts
+    with ipv4 and ipv6 keys.
+
+    Fewer pairs are returned if the vlan runs out of addresses.
+
+    The index of this process does not know about the hosts saved by
+    other processes, so the allocated addresses are checked against the
+    database, and the index is built again before giving up.
+    """
+    index = get_address_index(vlan)
+    rebuilt = False
+    result = []
+    while len(result) < count:
+        new = reserve_free_addresses(vlan, index, count - len(result))
+        if not new:
+            if rebuilt:
+                break
+            index = get_address_index(vlan, rebuild=True)
+            rebuilt = True
+            continue
+        used = get_used_addresses(
+            [address['ipv4'] for address in new],
+            [address['ipv6'] for address in new
+             if address['ipv6'] is not None])
+        for address in new:
+            ipv4, ipv6 = address['ipv4'], address['ipv6']
+            ipv6_int = None if ipv6 is None else int(ipv6)
+            if int(ipv4) in used or ipv6_int in used:
+                logger.info("IPv4 address %s is in use, skipping.", ipv4)
+                index.mark(ipv4)
+                release_address(ipv4)
+                continue
+            index.hold(ipv4, ipv6_int, time() + RESERVATION_TIMEOUT)
+            logger.debug("Allocated IPv4 address %s, IPv6 address %s.",
+                         ipv4, ipv6)
+            result.append(address)
+    return result
+
+
+class PortIndex(object):
+    """Index of the free ports of a set of port ranges.
+
+    Ports outside the ranges are marked as used.
+    """
+
+    def __init__(self, ranges, used=()):
+        self.ranges = ranges
+        self.used = bytearray(b'\1') * 65536
+        for start, end in ranges:
+            self.used[start:end] = bytearray(end - start)
+        for port in used:
+            self.mark(port)
+
+    def mark(self, port):
+        if port is not None and 0 <= port < len(self.used):
+            self.used[port] = 1
+
+    def unmark(self, port):
+        """Mark the port as free, if it is part of the ranges.
+        """
+        if any(start <= port < end for start, end in self.ranges):
+            self.used[port] = 0
+
+    def is_free(self, port):
+        return 0 <= port < len(self.used) and not self.used[port]
+
+    def free_count(self):
+        return self.used.count(b'\0')
+
+    def find_free(self, random_range=None):
+        """Return a free port and mark it used, or None if all ports are
+        used.
+
+        A random port of random_range is tried first, if it is given,
+        then the smallest free port.
+        """
+        port = None
+        if random_range is not None:
+            port = random.randrange(*random_range)
+        if port is None or not self.is_free(port):
+            port = self.used.find(b'\0')
+            if port == -1:
+                return None
+        self.used[port] = 1
+        return port
+
+
+# key: (token, index) of the last built index of each port range
+port_index_cache = {}
+
+
+def touch_port_indexes(keys=None):
+    """Mark the given port indexes, or all of them if keys is None, as
+    changed when the transaction is committed.
+
+    Only needed when the ports an index covers change, allocated and freed
+    ports update the indexes in place.
+    """
+    touch_tokens_on_commit('ports', keys)
+
+
+def update_port_indexes(added=(), removed=()):
+    """Mark the added ports used and the removed ones free in the port
+    indexes of this process, when the transaction is committed.
+
+    :param added: (index key, port) pairs of the ports taken
+    :param removed: (index key, port) pairs of the ports given back
+
+    Other processes find the ports taken by checking them against the
+    database, and the ones given back when they build their full index
+    again.
+    """
+    added = list(added)
+    removed = list(removed)
+    if added or removed:
+        transaction.on_commit(lambda: apply_port_changes(added, removed))
+
+
+def apply_port_changes(added, removed):
+    for key, port in removed:
+        if key in port_index_cache:
+            port_index_cache[key][1].unmark(port)
+    for key, port in added:
+        if key in port_index_cache:
+            port_index_cache[key][1].mark(port)
+
+
+def get_port_index(key, ranges, get_used_ports, rebuild=False):
+    """Return the port index identified by key, built again only if it has
+    been touched since the last call, or rebuild is set.
+
+    :param get_used_ports: Function returning the used ports, called only
+                           when the index is built.
+    """
+    token = get_tokens('ports', [key])[key]
+    cached = port_index_cache.get(key)
+    if (rebuild or None in token or cached is None or cached[0] != token or
+            cached[1].ranges != ranges):
+        cached = (token, PortIndex(ranges, get_used_ports()))
+        port_index_cache[key] = cached
+    return cached[1]
+
+
+def reserve_port(key, port, timeout=RESERVATION_TIMEOUT):
+    """Reserve the port of the index identified by key, like reserve_address
+    does with addresses.
+    """
+    return cache.add('port_reservation_%s_%s' % (key, port), True, timeout)
+
+
+def release_port(key, port):
+    cache.delete('port_reservation_%s_%s' % (key, port))
+
+
+def allocate_ports(key, ranges, get_used_ports, count, random_range=None):
+    """Return count reserved, unused ports of the index identified by key.
+
+    Fewer ports are returned if the index runs out of ports, even after
+    building it again to find the ports given back by other processes.
+    """
+    index = get_port_index(key, ranges, get_used_ports)
+    rebuilt = False
+    result = []
+    while len(result) < count:
+        port = index.find_free(random_range)
+        if port is None:
+            if rebuilt:
+                break
+            index = get_port_index(key, ranges, get_used_ports, rebuild=True)
+            for taken in result:
+                index.mark(taken)
+            rebuilt = True
+            continue
+        if reserve_port(key, port):
+            result.append(port)
+        else:
+            logger.debug("Port %s of %s is reserved, skipping.", port, key)
+    return result
+
+
+def allocate_port(key, ranges, get_used_ports, random_range=None):
+    """Return a reserved, unused port of the index identified by key, or
+    None if all ports are used.
+    """
+    ports = allocate_ports(key, ranges, get_used_ports, 1, random_range)
+    return ports[0] if ports else None
@@ -18,6 +18,7 @@
 import re
 import logging
 from collections import OrderedDict
+from hashlib import sha1
 from netaddr import IPAddress, AddrFormatError
 from itertools import product
 
@@ -28,21 +29,60 @@ import django.conf
 from django.template import loader
 from django.utils import timezone
 
+from common.models import get_tokens, touch_tokens_on_commit
+
 
 settings = django.conf.settings.FIREWALL_SETTINGS
 logger = logging.getLogger(__name__)
 
 
+# sections of the iptables rules built separately
+FIREWALL_SECTIONS = ('firewall', 'host', 'vlan', 'nat')
+
+
+def touch_firewall_sections(sections=None):
+    """Mark the given sections of the iptables rules as changed, or all
+    sections if sections is None.
+    """
+    touch_tokens_on_commit('firewall_section', sections)
+
+
 class BuildFirewall:
+    """Build the iptables rules of the firewalls.
+
+    The rules of a section are queried and built again only if a rule,
+    host, vlan or group membership the section depends on has changed
+    since the last build in this process.  Chains and the rendered output
+    of the previous build are reused while unchanged, which saves
+    compiling the rules and rendering the template, and lets the reload
+    task skip sending unchanged rules.
+    """
+    # section: (token, [(chain name, rules)]) of the last build in this
+    # process
+    last_sections = {}
+    # chains of the last build in this process, reused while unchanged
+    last_chains = {}
+    # (chain names, output) of the last build in this process
+    last_output = None
 
     def __init__(self):
         self.chains = OrderedDict()
+        self.changed_chains = []
+        self.removed_chains = []
+        self.rebuilt_sections = []
+        self.section_rules = None
 
     def add_rules(self, *args, **kwargs):
         for chain_name, ipt_rule in kwargs.items():
+            self.add_rules_bulk({chain_name: [ipt_rule]})
+
+    def add_rules_bulk(self, rules):
+        for chain_name, ipt_rules in rules.iteritems():
             if chain_name not in self.chains:
                 self.create_chain(chain_name)
-            self.chains[chain_name].add(ipt_rule)
+            self.chains[chain_name].add(*ipt_rules)
+            if self.section_rules is not None:
+                self.section_rules.append((chain_name, ipt_rules))
 
     def create_chain(self, chain_name):
         self.chains[chain_name] = IptChain(name=chain_name)
@@ -97,11 +137,15 @@ class BuildFirewall:
                 'foreign_network__vlans'):
             self.add_rules(**rule.get_ipt_rules(rule.host))
         # group rules
+        addresses = {}  # group id: addresses of member hosts by vlan
         for rule in rules.exclude(hostgroup=None).select_related(
                 'hostgroup', 'foreign_network').prefetch_related(
                 'hostgroup__host_set__vlan', 'foreign_network__vlans'):
-            for host in rule.hostgroup.host_set.all():
-                self.add_rules(**rule.get_ipt_rules(host))
+            if rule.hostgroup_id not in addresses:
+                addresses[rule.hostgroup_id] = (
+                    rule.hostgroup.get_host_addresses())
+            self.add_rules_bulk(rule.get_ipt_rules_for_hosts(
+                addresses[rule.hostgroup_id]))
 
     def ipt_filter_vlan_rules(self):
         """Enable communication between VLANs."""
@@ -134,15 +178,71 @@ class BuildFirewall:
                                     extra='-i %s -o %s' % (vl_in, vl_out))
                 self.add_rules(FORWARD=jump_rule)
 
+    def build_sections(self, sections):
+        """Add the rules of the given sections, reusing the ones of the last
+        build for the sections not touched since.
+        """
+        builders = {'firewall': self.ipt_filter_firewall,
+                    'host': self.ipt_filter_host_rules,
+                    'vlan': self.ipt_filter_vlan_rules,
+                    'nat': self.build_ipt_nat}
+        tokens = get_tokens('firewall_section', sections)
+        for section in sections:
+            token = tokens[section]
+            cached = BuildFirewall.last_sections.get(section)
+            if None in token or cached is None or cached[0] != token:
+                self.section_rules = []
+                builders[section]()
+                cached = (token, self.section_rules)
+                self.section_rules = None
+                BuildFirewall.last_sections[section] = cached
+                self.rebuilt_sections.append(section)
+            else:
+                for chain_name, ipt_rules in cached[1]:
+                    self.add_rules_bulk({chain_name: ipt_rules})
+
+    def reuse_unchanged_chains(self):
+        """Replace chains unchanged since the last build with the already
+        compiled ones, and record which chains have changed.
+        """
+
+        previous = BuildFirewall.last_chains
+        self.changed_chains = []
+        for name, chain in self.chains.items():
+            old = previous.get(name)
+            if old is not None and old.rules == chain.rules:
+                self.chains[name] = old
+            else:
+                self.changed_chains.append(name)
+        self.removed_chains = [name for name in previous
+                               if name not in self.chains]
+        BuildFirewall.last_chains = dict(self.chains)
+
+    def chain_digests(self):
+        """Return the content hash of each chain."""
+
+        return OrderedDict((name, chain.digest())
+                           for name, chain in self.chains.iteritems())
+
     def build_ipt(self):
         """Build rules."""
 
-        self.ipt_filter_firewall()
-        self.ipt_filter_host_rules()
-        self.ipt_filter_vlan_rules()
+        self.build_sections(['firewall', 'host', 'vlan'])
         self.ipt_filter_vlan_jump()
         self.ipt_filter_vlan_drop()
-        self.build_ipt_nat()
+        self.build_sections(['nat'])
+        self.reuse_unchanged_chains()
+        logger.info("BuildFirewall: sections rebuilt: %s, %d chains "
+                    "changed, %d removed: %s",
+                    ", ".join(self.rebuilt_sections),
+                    len(self.changed_chains), len(self.removed_chains),
+                    ", ".join(self.changed_chains + self.removed_chains))
+
+        names = tuple(self.chains)
+        last_output = BuildFirewall.last_output
+        if (not self.changed_chains and not self.removed_chains and
+                last_output is not None and last_output[0] == names):
+            return last_output[1]
 
         context = {
             'filter': lambda: (chain for name, chain in self.chains.iteritems()
@@ -155,7 +255,9 @@ class BuildFirewall:
         ipv4 = unicode(template.render(context))
         context['proto'] = 'ipv6'
         ipv6 = unicode(template.render(context))
-        return (ipv4, ipv6)
+        output = (ipv4, ipv6)
+        BuildFirewall.last_output = (names, output)
+        return output
 
 
 def ipset():
@@ -184,10 +286,12 @@ def ipv6_to_octal(ipv6):
 # :                     generic
 # 'fqdn:s:ttl           TXT
 
-def generate_ptr_records():
+def generate_ptr_records(hosts=None):
     DNS = []
 
-    for host in Host.objects.order_by('vlan').all():
+    if hosts is None:
+        hosts = Host.objects.all()
+    for host in hosts.select_related('vlan').order_by('vlan'):
         template = host.vlan.reverse_domain
         if not host.shared_ip and host.external_ipv4:  # DMZ
             i = host.external_ipv4.words
@@ -213,7 +317,7 @@ def txt_to_octal(txt):
     return '\\' + '\\'.join(['%03o' % ord(x) for x in txt])
 
 
-def generate_records():
+def generate_records(records=None):
     types = {'A': '+%(fqdn)s:%(address)s:%(ttl)s',
              'AAAA': ':%(fqdn)s:28:%(octal)s:%(ttl)s',
              'NS': '&%(fqdn)s::%(address)s:%(ttl)s',
@@ -224,7 +328,9 @@ def generate_records():
 
     retval = []
 
-    for r in Record.objects.all():
+    if records is None:
+        records = Record.objects.all()
+    for r in records.select_related('domain'):
         params = {'fqdn': r.fqdn, 'address': r.address, 'ttl': r.ttl}
         if r.type == 'MX':
             params['dist'], params['address'] = r.address.split(':', 2)
@@ -242,20 +348,75 @@ def generate_records():
     return retval
 
 
-def dns():
-    DNS = []
+def generate_soa_record(domain):
+    return "Z%s:%s:support.ik.bme.hu::::::%s" % (
+        domain.name, settings['dns_hostname'], settings['dns_ttl'])
+
+
+def generate_zone(zone):
+    """Return the tinydns data of a single zone.
+
+    Zones are identified by 'domain:<pk>' for the forward zone of a Domain,
+    and by 'vlan:<pk>' for the reverse records of the hosts of a Vlan.
+    """
+    model, pk = zone.split(':')
+    if model == 'domain':
+        domain = Domain.objects.get(pk=pk)
+        return ([generate_soa_record(domain)] +
+                generate_records(Record.objects.filter(domain=domain)))
+    else:
+        return generate_ptr_records(Host.objects.filter(vlan=pk))
+
+
+# zone: (token, lines, digest) of the last generated version of each zone
+dns_zone_cache = {}
+
+
+def touch_dns_zones(zones=None):
+    """Mark the given dns zones as changed, or all zones if zones is None.
+    """
+    touch_tokens_on_commit('dns_zone', zones)
+
+
+def dns_zones():
+    """Generate (zone, lines) pairs of all dns zones.
+
+    Only zones changed since the last call are generated again, the lines
+    of the other ones are reused.
+    """
+    zones = (['domain:%d' % pk for pk in
+              Domain.objects.values_list('pk', flat=True)] +
+             ['vlan:%d' % pk for pk in
+              Vlan.objects.values_list('pk', flat=True)])
+    tokens = get_tokens('dns_zone', zones)
 
-    # host PTR record
-    DNS += generate_ptr_records()
+    changed = []
+    for zone in zones:
+        token = tokens[zone]
+        cached = dns_zone_cache.get(zone)
+        if None in token or cached is None or cached[0] != token:
+            lines = generate_zone(zone)
+            digest = sha1('\n'.join(lines).encode('utf-8')).hexdigest()
+            if cached is None or cached[2] != digest:
+                changed.append(zone)
+            cached = dns_zone_cache[zone] = (token, lines, digest)
+        yield zone, cached[1]
 
-    # domain SOA record
-    for domain in Domain.objects.all():
-        DNS.append("Z%s:%s:support.ik.bme.hu::::::%s" %
-                   (domain.name, settings['dns_hostname'],
-                    settings['dns_ttl']))
+    for zone in set(dns_zone_cache) - set(zones):
+        del dns_zone_cache[zone]
+    logger.info("dns: %d zones changed: %s", len(changed), ", ".join(changed))
 
-    # records
-    DNS += generate_records()
+
+def dns_zone_digests():
+    """Return the content hash of each zone generated by dns_zones()."""
+    return {zone: cached[2] for zone, cached in dns_zone_cache.iteritems()}
+
+
+def dns():
+    DNS = []
+
+    for zone, lines in dns_zones():
+        DNS += lines
 
     return DNS
 
@@ -272,12 +433,10 @@ class UniqueHostname(object):
         return hostname
 
 
-def dhcp():
-    regex = re.compile(r'^([0-9]+)\.([0-9]+)\.[0-9]+\.[0-9]+\s+'
-                       r'([0-9]+)\.([0-9]+)\.[0-9]+\.[0-9]+$')
-    config = []
+DHCP_POOL_RE = re.compile(r'^([0-9]+)\.([0-9]+)\.[0-9]+\.[0-9]+\s+'
+                          r'([0-9]+)\.([0-9]+)\.[0-9]+\.[0-9]+$')
 
-    VLAN_TEMPLATE = '''
+DHCP_VLAN_TEMPLATE = '''
     # %(name)s - %(interface)s
     subnet %(net)s netmask %(netmask)s {
       %(extra)s;
@@ -291,38 +450,89 @@ def dhcp():
       allow bootp; allow booting;
     }'''
 
-    HOST_TEMPLATE = '''
+DHCP_HOST_TEMPLATE = '''
     host %(hostname)s {
         hardware ethernet %(mac)s;
         fixed-address %(ipv4)s;
     }'''
 
+
+def generate_dhcp_subnet(vlan):
+    """Return the dhcpd configuration of a vlan.
+
+    The result is the subnet declaration and a list of (hostname, params,
+    declaration) tuples of the hosts, or None if the vlan has no DHCP
+    service.
+    """
+    m = DHCP_POOL_RE.search(vlan.dhcp_pool)
+    if not (m or vlan.dhcp_pool == "manual"):
+        return None
+
+    subnet = DHCP_VLAN_TEMPLATE % {
+        'net': str(vlan.network4.network),
+        'netmask': str(vlan.network4.netmask),
+        'domain': vlan.domain,
+        'router': vlan.network4.ip,
+        'ntp': vlan.network4.ip,
+        'dnsserver': settings['rdns_ip'],
+        'extra': ("range %s" % vlan.dhcp_pool
+                  if m else "deny unknown-clients"),
+        'interface': vlan.name,
+        'name': vlan.name,
+        'tftp': vlan.network4.ip}
+
+    hosts = []
+    for host in vlan.host_set.all():
+        params = {'hostname': host.hostname, 'mac': host.mac,
+                  'ipv4': host.ipv4}
+        hosts.append((host.hostname, params, DHCP_HOST_TEMPLATE % params))
+
+    return subnet, hosts
+
+
+# vlan id: (token, vid, subnet) of the last generated version of each vlan
+dhcp_subnet_cache = {}
+
+
+def touch_dhcp_subnets(vlans=None):
+    """Mark the dhcp configuration of the given vlans as changed, or all of
+    them if vlans is None.
+    """
+    touch_tokens_on_commit('dhcp_subnet', vlans)
+
+
+def dhcp():
+    vlans = list(Vlan.objects.exclude(dhcp_pool=None).values_list(
+        'pk', flat=True))
+    tokens = get_tokens('dhcp_subnet', vlans)
+
+    stale = [pk for pk in vlans
+             if None in tokens[pk] or pk not in dhcp_subnet_cache or
+             dhcp_subnet_cache[pk][0] != tokens[pk]]
+    if stale:
+        for vlan in Vlan.objects.filter(pk__in=stale).select_related(
+                'domain').prefetch_related('host_set'):
+            dhcp_subnet_cache[vlan.pk] = (tokens[vlan.pk], vlan.vid,
+                                          generate_dhcp_subnet(vlan))
+    for pk in set(dhcp_subnet_cache) - set(vlans):
+        del dhcp_subnet_cache[pk]
+    logger.info("dhcp: %d subnets changed", len(stale))
+
+    config = []
     unique_hostnames = UniqueHostname()
 
-    for vlan in Vlan.objects.exclude(
-            dhcp_pool=None).select_related(
-            'domain').prefetch_related('host_set'):
-        m = regex.search(vlan.dhcp_pool)
-        if(m or vlan.dhcp_pool == "manual"):
-            config.append(VLAN_TEMPLATE % {
-                'net': str(vlan.network4.network),
-                'netmask': str(vlan.network4.netmask),
-                'domain': vlan.domain,
-                'router': vlan.network4.ip,
-                'ntp': vlan.network4.ip,
-                'dnsserver': settings['rdns_ip'],
-                'extra': ("range %s" % vlan.dhcp_pool
-                          if m else "deny unknown-clients"),
-                'interface': vlan.name,
-                'name': vlan.name,
-                'tftp': vlan.network4.ip})
-
-            for host in vlan.host_set.all():
-                config.append(HOST_TEMPLATE % {
-                    'hostname': unique_hostnames.get(host.hostname, vlan.vid),
-                    'mac': host.mac,
-                    'ipv4': host.ipv4,
-                })
+    for pk in vlans:
+        token, vid, subnet = dhcp_subnet_cache.get(pk, (None, None, None))
+        if subnet is None:
+            continue
+        declaration, hosts = subnet
+        config.append(declaration)
+        for hostname, params, host_declaration in hosts:
+            unique = unique_hostnames.get(hostname, vid)
+            if unique != hostname:
+                host_declaration = DHCP_HOST_TEMPLATE % dict(
+                    params, hostname=unique)
+            config.append(host_declaration)
 
     return config
 
@@ -17,7 +17,7 @@
 
 import logging
 import re
-from collections import OrderedDict
+from hashlib import sha1
 
 logger = logging.getLogger()
 
@@ -30,6 +30,23 @@ class InvalidRuleExcepion(Exception):
 
 
 class IptRule(object):
+    """Immutable iptables rule.
+
+    The hash and the compiled form of the rule for both protocols are
+    computed once, when the rule is created.
+    """
+
+    __slots__ = ('priority', 'action', 'src4', 'src6', 'dst4', 'dst6',
+                 'proto', 'sport', 'dport', 'extra', 'ipv4_only', 'comment',
+                 '_key', '_hash', '_compiled')
+    opts = (('src', '-s %s'),
+            ('dst', '-d %s'),
+            ('proto', '-p %s'),
+            ('sport', '--sport %s'),
+            ('dport', '--dport %s'),
+            ('extra', '%s'),
+            ('comment', '-m comment --comment "%s"'),
+            ('action', '-g %s'))
 
     def __init__(self, priority=1000, action=None, src=None, dst=None,
                  proto=None, sport=None, dport=None, extra=None,
@@ -40,34 +57,53 @@ class IptRule(object):
                                             dport is not None):
             raise InvalidRuleExcepion()
 
-        self.priority = int(priority)
-        self.action = action
-
-        (self.src4, self.src6) = (None, None)
+        (src4, src6) = (None, None)
         if isinstance(src, tuple):
-            (self.src4, self.src6) = src
-            if not self.src6:
+            (src4, src6) = src
+            if not src6:
                 ipv4_only = True
-        (self.dst4, self.dst6) = (None, None)
+        (dst4, dst6) = (None, None)
         if isinstance(dst, tuple):
-            (self.dst4, self.dst6) = dst
-            if not self.dst6:
+            (dst4, dst6) = dst
+            if not dst6:
                 ipv4_only = True
 
-        self.proto = proto
-        self.sport = sport
-        self.dport = dport
-
-        self.extra = extra
-        self.ipv4_only = (ipv4_only or
-                          extra is not None and bool(ipv4_re.search(extra)))
-        self.comment = comment
+        ipv4_only = (ipv4_only or
+                     extra is not None and bool(ipv4_re.search(extra)))
+        values = (('priority', int(priority)), ('action', action),
+                  ('src4', src4), ('src6', src6),
+                  ('dst4', dst4), ('dst6', dst6),
+                  ('proto', proto), ('sport', sport), ('dport', dport),
+                  ('extra', extra), ('ipv4_only', ipv4_only),
+                  ('comment', comment))
+        for name, value in values:
+            object.__setattr__(self, name, value)
+        key = tuple(value for name, value in values)
+        object.__setattr__(self, '_key', key)
+        object.__setattr__(self, '_hash', hash(key))
+        object.__setattr__(self, '_compiled', {
+            'ipv4': self._compile(src4, dst4),
+            'ipv6': self._compile(src6, dst6)})
+
+    def _compile(self, src, dst):
+        values = {'src': src, 'dst': dst, 'proto': self.proto,
+                  'sport': self.sport, 'dport': self.dport,
+                  'extra': self.extra, 'comment': self.comment,
+                  'action': self.action}
+        return ' '.join(fmt % values[param] for param, fmt in self.opts
+                        if values[param] is not None)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("IptRule is immutable")
 
     def __hash__(self):
-        return hash(frozenset(self.__dict__.items()))
+        return self._hash
 
     def __eq__(self, other):
-        return self.__dict__ == other.__dict__
+        return self._key == other._key
+
+    def __ne__(self, other):
+        return not self == other
 
     def __lt__(self, other):
         return self.priority < other.priority
@@ -79,18 +115,7 @@ class IptRule(object):
         return self.__repr__()
 
     def compile(self, proto='ipv4'):
-        opts = OrderedDict([('src4' if proto == 'ipv4' else 'src6', '-s %s'),
-                            ('dst4' if proto == 'ipv4' else 'dst6', '-d %s'),
-                            ('proto', '-p %s'),
-                            ('sport', '--sport %s'),
-                            ('dport', '--dport %s'),
-                            ('extra', '%s'),
-                            ('comment', '-m comment --comment "%s"'),
-                            ('action', '-g %s')])
-        params = [opts[param] % getattr(self, param)
-                  for param in opts
-                  if getattr(self, param) is not None]
-        return ' '.join(params)
+        return self._compiled[proto]
 
 
 class IptChain(object):
@@ -100,13 +125,30 @@ class IptChain(object):
     def __init__(self, name):
         self.rules = set()
         self.name = name
+        self._buckets = {}  # priority: [rules]
+        self._ordered = None
+        self._compiled = {}
 
     def add(self, *args, **kwargs):
         for rule in args:
-            self.rules.add(rule)
+            if rule not in self.rules:
+                self.rules.add(rule)
+                self._buckets.setdefault(rule.priority, []).append(rule)
+        self._ordered = None
+        self._compiled.clear()
 
     def sort(self):
-        return sorted(list(self.rules), reverse=True)
+        """Return the rules in descending order of priority.
+
+        Rules of the same priority are ordered by their compiled form,
+        so the output does not depend on the order they were added in.
+        """
+        if self._ordered is None:
+            self._ordered = [
+                rule for priority in sorted(self._buckets, reverse=True)
+                for rule in sorted(self._buckets[priority],
+                                   key=lambda rule: rule.compile())]
+        return self._ordered
 
     def __len__(self):
         return len(self.rules)
@@ -119,10 +161,18 @@ class IptChain(object):
 
     def compile(self, proto='ipv4'):
         assert proto in ('ipv4', 'ipv6')
-        prefix = '-A %s ' % self.name
-        return '\n'.join([prefix + rule.compile(proto)
-                          for rule in self.sort()
-                          if not (proto == 'ipv6' and rule.ipv4_only)])
+        if proto not in self._compiled:
+            prefix = '-A %s ' % self.name
+            self._compiled[proto] = '\n'.join(
+                [prefix + rule.compile(proto) for rule in self.sort()
+                 if not (proto == 'ipv6' and rule.ipv4_only)])
+        return self._compiled[proto]
 
     def compile_v6(self):
         return self.compile('ipv6')
+
+    def digest(self):
+        """Return a stable content hash of the compiled chain."""
+        content = '\n'.join((self.name, self.compile('ipv4'),
+                             self.compile('ipv6')))
+        return sha1(content.encode('utf-8')).hexdigest()
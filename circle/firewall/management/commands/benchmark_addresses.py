@@ -0,0 +1,113 @@
+# Copyright 2014 Budapest University of Technology and Economics (BME IK)
+#
+# This file is part of CIRCLE Cloud.
+#
+# CIRCLE is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# CIRCLE is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along
+# with CIRCLE.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import unicode_literals, absolute_import
+
+from time import time
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from netaddr import IPNetwork
+
+from firewall.allocation import build_address_index
+from firewall.models import Host, Vlan, Domain
+
+
+class Rollback(Exception):
+    pass
+
+
+class Command(BaseCommand):
+    help = ('Measure address allocation of a synthetic vlan at different '
+            'fill levels.  Nothing is saved to the database.')
+
+    def add_arguments(self, parser):
+
+        parser.add_argument('--network',
+                            action='store',
+                            dest='network',
+                            default='10.200.0.1/16',
+                            help='network of the synthetic vlan')
+
+        parser.add_argument('--levels',
+                            action='store',
+                            dest='levels',
+                            default='0,50,90,99,99.9',
+                            help='comma separated fill levels in percent')
+
+        parser.add_argument('--allocations',
+                            action='store',
+                            dest='allocations',
+                            default=1000,
+                            type=int,
+                            help='number of allocations on each level')
+
+    def handle(self, *args, **options):
+        network = IPNetwork(options['network'])
+        levels = [float(i) for i in options['levels'].split(',')]
+        count = options['allocations']
+        self.stdout.write('%7s %8s %12s %14s' % (
+            'level', 'hosts', 'build', 'allocate'))
+        try:
+            with transaction.atomic():
+                vlan = self.create_vlan(network)
+                hosts = list(network.iter_hosts())[1:]
+                filled = 0
+                for level in levels:
+                    target = int(len(hosts) * level / 100)
+                    self.fill(vlan, hosts[filled:target], filled)
+                    filled = max(filled, target)
+                    self.measure(vlan, level, filled, count)
+                raise Rollback()
+        except Rollback:
+            pass
+
+    def create_vlan(self, network):
+        owner = User.objects.create(username='benchmark-addresses')
+        domain = Domain.objects.create(name='benchmark.example.org',
+                                       owner=owner)
+        self.owner = owner
+        return Vlan.objects.create(vid=4000, name='benchmark',
+                                   network4=network, domain=domain,
+                                   owner=owner)
+
+    def fill(self, vlan, addresses, offset):
+        Host.objects.bulk_create(
+            Host(hostname='bench%d' % (offset + i), vlan=vlan,
+                 mac='02:00:%02x:%02x:%02x:%02x' % (
+                     (offset + i) >> 24 & 255, (offset + i) >> 16 & 255,
+                     (offset + i) >> 8 & 255, (offset + i) & 255),
+                 ipv4=address, owner=self.owner)
+            for i, address in enumerate(addresses))
+
+    def measure(self, vlan, level, filled, count):
+        start = time()
+        index = build_address_index(vlan)
+        build = time() - start
+
+        start = time()
+        allocated = 0
+        for i in xrange(count):
+            if index.find_free() is None:
+                break
+            allocated += 1
+        allocate = time() - start
+
+        self.stdout.write('%6.1f%% %8d %9.2f ms %11.2f us' % (
+            level, filled, build * 1e3,
+            allocate * 1e6 / max(allocated, 1)))
@@ -0,0 +1,104 @@
+# Copyright 2014 Budapest University of Technology and Economics (BME IK)
+#
+# This file is part of CIRCLE Cloud.
+#
+# CIRCLE is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# CIRCLE is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along
+# with CIRCLE.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import unicode_literals, absolute_import
+
+from time import time
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from firewall.fw import BuildFirewall
+from firewall.models import Domain, Group, Host, Rule, Vlan, VlanGroup
+
+
+class Command(BaseCommand):
+    help = ('Measure building host group rules for a growing number of '
+            'synthetic hosts. The test data is rolled back.')
+
+    def add_arguments(self, parser):
+
+        parser.add_argument('--hosts',
+                            action='store',
+                            dest='hosts',
+                            default=[100, 1000, 10000],
+                            type=int,
+                            nargs='+',
+                            help='numbers of hosts to measure')
+
+        parser.add_argument('--vlans',
+                            action='store',
+                            dest='vlans',
+                            default=4,
+                            type=int,
+                            help='number of vlans')
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            self.populate(options['vlans'])
+            created = 0
+            for count in sorted(options['hosts']):
+                self.add_hosts(created, count)
+                created = count
+                start = time()
+                BuildFirewall().ipt_filter_host_rules()
+                self.stdout.write('%8d hosts %8.3f s' % (
+                    count, time() - start))
+            transaction.set_rollback(True)
+
+    def populate(self, vlans):
+        # bulk_create is used to avoid triggering firewall reloads
+        self.owner = User.objects.create(username='benchmark_firewall')
+        domain = Domain.objects.bulk_create([
+            Domain(name='benchmark.example.org', owner=self.owner)])[0]
+        domain = Domain.objects.get(name=domain.name, owner=self.owner)
+        Vlan.objects.bulk_create([
+            Vlan(vid=4000 + i, name='bench%d' % i, domain=domain,
+                 network4='10.%d.255.254/16' % (200 + i),
+                 network6='2001:db8:%x::/48' % i,
+                 ipv6_template='2001:db8:%x:%%(c)d:%%(d)d::' % i,
+                 host_ipv6_prefixlen=112)
+            for i in range(vlans)])
+        self.vlans = list(Vlan.objects.filter(name__startswith='bench'))
+        vlangroup = VlanGroup.objects.create(name='benchmark')
+        vlangroup.vlans.add(*self.vlans)
+        Group.objects.bulk_create([Group(name='benchmark')])
+        self.group = Group.objects.get(name='benchmark')
+        Rule.objects.bulk_create([
+            Rule(direction=direction, action='accept', proto=proto,
+                 dport=dport, hostgroup=self.group,
+                 foreign_network=vlangroup)
+            for direction, proto, dport in (('in', 'tcp', 22),
+                                            ('in', 'tcp', 3389),
+                                            ('in', 'icmp', None),
+                                            ('out', None, None))])
+
+    def add_hosts(self, first, last):
+        hosts = []
+        for i in xrange(first, last):
+            vlan = self.vlans[i % len(self.vlans)]
+            ipv4 = vlan.network4[i // len(self.vlans) + 1]
+            hosts.append(Host(
+                hostname='bench%d' % i, vlan=vlan, owner=self.owner,
+                mac='02:00:%02x:%02x:%02x:%02x' % (
+                    i >> 24 & 255, i >> 16 & 255, i >> 8 & 255, i & 255),
+                ipv4=ipv4, ipv6=vlan.convert_ipv4_to_ipv6(ipv4)))
+        Host.objects.bulk_create(hosts)
+        self.group.host_set.add(*Host.objects.filter(
+            hostname__startswith='bench', vlan__in=self.vlans,
+            groups=None))
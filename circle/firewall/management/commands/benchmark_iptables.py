@@ -0,0 +1,83 @@
+# Copyright 2014 Budapest University of Technology and Economics (BME IK)
+#
+# This file is part of CIRCLE Cloud.
+#
+# CIRCLE is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# CIRCLE is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along
+# with CIRCLE.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import unicode_literals, absolute_import
+
+from random import Random
+from time import time
+
+from django.core.management.base import BaseCommand
+
+from firewall.iptables import IptRule, IptChain
+
+
+class Command(BaseCommand):
+    help = 'Measure building and compiling synthetic iptables rules.'
+
+    def add_arguments(self, parser):
+
+        parser.add_argument('--rules',
+                            action='store',
+                            dest='rules',
+                            default=100000,
+                            type=int,
+                            help='number of synthetic rules')
+
+        parser.add_argument('--chains',
+                            action='store',
+                            dest='chains',
+                            default=20,
+                            type=int,
+                            help='number of chains to spread rules over')
+
+    def handle(self, *args, **options):
+        random = Random(42)
+        count = options['rules']
+        chains = [IptChain(name='vlan%d_pub' % i)
+                  for i in range(options['chains'])]
+
+        start = time()
+        rules = []
+        for i in xrange(count):
+            ipv4 = '10.%d.%d.%d' % (i >> 16 & 255, i >> 8 & 255, i & 255)
+            ipv6 = '2001:db8::%x/112' % i
+            rules.append(IptRule(
+                priority=random.choice((1000, 30000, 40000)),
+                action=random.choice(('LOG_ACC', 'LOG_DROP')),
+                dst=(ipv4, ipv6), proto='tcp',
+                dport=random.randint(1, 65535), comment='Rule #%d' % i))
+        self.report('create', start, count)
+
+        start = time()
+        for i, rule in enumerate(rules):
+            chains[i % len(chains)].add(rule)
+        self.report('add', start, count)
+
+        start = time()
+        set(hash(rule) for rule in rules)
+        self.report('hash', start, count)
+
+        for proto in ('ipv4', 'ipv6'):
+            start = time()
+            for chain in chains:
+                chain.compile(proto)
+            self.report('compile %s' % proto, start, count)
+
+    def report(self, name, start, count):
+        elapsed = time() - start
+        self.stdout.write('%-14s %8.3f s %10.2f us/rule' % (
+            name, elapsed, elapsed * 1e6 / count))
@@ -44,7 +44,8 @@ class Command(BaseCommand):
 
     def handle(self, *args, **options):
 
-        reloadtask('Vlan', sync=options["sync"], timeout=options["timeout"])
+        reloadtask('Vlan', sync=options["sync"], timeout=options["timeout"],
+                   force=True)
 
     def positive_int(self, val):
 
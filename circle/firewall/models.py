@@ -17,11 +17,14 @@
 # You should have received a copy of the GNU General Public License along
 # with CIRCLE.  If not, see <http://www.gnu.org/licenses/>.
 
+from collections import OrderedDict
+from contextlib import contextmanager
+from copy import copy
 from string import ascii_letters
-from itertools import islice, ifilter, chain
+from threading import local
+from itertools import chain
 from math import ceil
 import logging
-import random
 
 from django.contrib.auth.models import User
 from django.db import models
@@ -35,13 +38,16 @@ from firewall.fields import (MACAddressField, val_alfanum, val_reverse_domain,
 from django.core.validators import MinValueValidator, MaxValueValidator
 from django.core.urlresolvers import reverse
 import django.conf
-from django.db.models.signals import post_save, post_delete
+from django.db.models.signals import (
+    m2m_changed, post_delete, post_init, post_save, pre_delete, pre_save)
 from celery.exceptions import TimeoutError
-from netaddr import IPSet, EUI, IPNetwork, IPAddress, ipv6_full
+from netaddr import EUI, IPNetwork, IPAddress, ipv6_full
 
-from common.models import method_cache, WorkerNotFound, HumanSortField
+from common.models import (method_cache, WorkerNotFound, HumanSortField,
+                           bulk_insert)
 from firewall.tasks.local_tasks import reloadtask
 from firewall.tasks.remote_tasks import get_dhcp_clients
+from manager.latency import measure_remote
 from .iptables import IptRule
 from acl.models import AclBase
 
@@ -49,6 +55,9 @@ from acl.models import AclBase
 logger = logging.getLogger(__name__)
 settings = django.conf.settings.FIREWALL_SETTINGS
 
+# public ports of port forwards, random ports are picked from the first range
+PUBLIC_PORT_RANGES = ((1024, 21000), (24000, 65535))
+
 
 class Rule(models.Model):
 
@@ -166,6 +175,33 @@ class Rule(models.Model):
         return (self.nat_external_ipv4
                 if self.nat_external_ipv4 else self.host.get_external_ipv4())
 
+    def get_firewall_sections(self):
+        """Return the sections of the iptables rules depending on the rule.
+        """
+        sections = set()
+        if self.firewall_id is not None:
+            sections.add('firewall')
+        if self.host_id is not None or self.hostgroup_id is not None:
+            sections.add('host')
+        if self.vlan_id is not None:
+            sections.add('vlan')
+        if self.nat:
+            sections.add('nat')
+        return sections
+
+    def get_public_port(self):
+        """Return the key of the port index and the public port forwarded by
+        the rule, or None if it forwards no port.
+        """
+        if (not self.nat or self.host_id is None or self.proto is None or
+                self.nat_external_port is None):
+            return None
+        try:
+            return (self.host.get_port_key(self.proto),
+                    self.nat_external_port)
+        except Host.DoesNotExist:
+            return None
+
     def get_external_port(self, proto='ipv4'):
         assert proto in ('ipv4', 'ipv6')
         if proto == 'ipv4' and self.nat_external_port:
@@ -211,46 +247,83 @@ class Rule(models.Model):
         elif self.firewall_id:
             return 'INPUT' if self.direction == 'in' else 'OUTPUT'
 
-    def get_ipt_rules(self, host=None):
+    def _get_ipt_rule(self, ip=None):
+        """Return the iptables rule matching the given (ipv4, ipv6) pair as
+        local address.
+        """
         # action
         action = 'LOG_ACC' if self.action == 'accept' else 'LOG_DROP'
 
-        # 'chain_name': rule dict
-        retval = {}
-
         # src and dst addresses
         src = None
         dst = None
-
-        if host:
-            ip = (host.ipv4, host.ipv6_with_host_prefixlen)
+        if ip:
             if self.direction == 'in':
                 dst = ip
             else:
                 src = ip
+
+        return IptRule(priority=self.weight, action=action,
+                       proto=self.proto, extra=self.extra,
+                       comment='Rule #%s' % self.pk,
+                       src=src, dst=dst, dport=self.dport, sport=self.sport)
+
+    def get_ipt_rules(self, host=None):
+        # 'chain_name': rule dict
+        retval = {}
+
+        if host:
+            ip = (host.ipv4, host.ipv6_with_host_prefixlen)
             vlan = host.vlan
         elif self.vlan_id:
+            ip = None
             vlan = self.vlan
         else:
+            ip = None
             vlan = None
 
         if vlan and not vlan.managed:
             return retval
 
         # process foreign vlans
+        r = None
         for foreign_vlan in self.foreign_network.vlans.all():
             if not foreign_vlan.managed:
                 continue
 
-            r = IptRule(priority=self.weight, action=action,
-                        proto=self.proto, extra=self.extra,
-                        comment='Rule #%s' % self.pk,
-                        src=src, dst=dst, dport=self.dport, sport=self.sport)
+            if r is None:
+                r = self._get_ipt_rule(ip)
             chain_name = self.get_chain_name(local=vlan, remote=foreign_vlan)
             retval[chain_name] = r
 
         return retval
 
+    def get_ipt_rules_for_hosts(self, addresses):
+        """Return the iptables rules of the rule applied to many hosts.
+
+        :param addresses: (ipv4, ipv6) address pairs of the hosts grouped by
+                          vlan, as returned by Group.get_host_addresses.
+        :type addresses: dict.
+        :returns: dict -- lists of rules by chain name.
+        """
+        retval = {}
+        foreign_vlans = [foreign_vlan
+                         for foreign_vlan in self.foreign_network.vlans.all()
+                         if foreign_vlan.managed]
+        if not foreign_vlans:
+            return retval
+
+        for vlan, ips in addresses.iteritems():
+            if not vlan.managed:
+                continue
+            rules = [self._get_ipt_rule(ip) for ip in ips]
+            for foreign_vlan in foreign_vlans:
+                chain_name = self.get_chain_name(local=vlan,
+                                                 remote=foreign_vlan)
+                retval.setdefault(chain_name, []).extend(rules)
+
+        return retval
+
     @classmethod
     def portforwards(cls, host=None):
         qs = cls.objects.filter(dport__isnull=False, direction='in')
@@ -490,35 +563,28 @@ class Vlan(AclBase, models.Model):
     def get_absolute_url(self):
         return reverse('network.vlan', kwargs={'vid': self.vid})
 
-    def get_random_addresses(self, used_v4, buffer_size=100, max_hosts=10000):
-        addresses = islice(self.network4.iter_hosts(), max_hosts)
-        unused_addresses = list(islice(
-            ifilter(lambda x: x not in used_v4, addresses), buffer_size))
-        random.shuffle(unused_addresses)
-        return unused_addresses
+    def get_dhcp_subnets(self):
+        """Return the vlans whose dhcp configuration depends on the vlan.
+        """
+        return set([self.pk])
 
-    def get_new_address(self):
-        hosts = self.host_set
-        used_ext_addrs = Host.objects.filter(
-            external_ipv4__isnull=False).values_list(
-            'external_ipv4', flat=True)
-        used_v4 = IPSet(hosts.values_list('ipv4', flat=True)).union(
-            used_ext_addrs).union([self.network4.ip])
-        used_v6 = IPSet(hosts.exclude(ipv6__isnull=True)
-                        .values_list('ipv6', flat=True))
-
-        for ipv4 in self.get_random_addresses(used_v4):
-            logger.debug("Found unused IPv4 address %s.", ipv4)
-            ipv6 = None
-            if self.network6 is not None:
-                ipv6 = self.convert_ipv4_to_ipv6(ipv4)
-                if ipv6 in used_v6:
-                    continue
-                else:
-                    logger.debug("Found unused IPv6 address %s.", ipv6)
-            return {'ipv4': ipv4, 'ipv6': ipv6}
-        else:
+    def get_new_addresses(self, count):
+        """Return count unused address pairs of the vlan.
+
+        The addresses are reserved for a while, so concurrent callers get
+        different addresses even before the hosts using them are saved.
+        """
+        from firewall.allocation import allocate_addresses, release_address
+
+        addresses = allocate_addresses(self, count)
+        if len(addresses) < count:
+            for address in addresses:
+                release_address(address['ipv4'])
             raise ValidationError(_("All IP addresses are already in use."))
+        return addresses
+
+    def get_new_address(self):
+        return self.get_new_addresses(1)[0]
 
     def convert_ipv4_to_ipv6(self, ipv4):
         """Convert IPv4 address string to IPv6 address string."""
@@ -595,6 +661,16 @@ class Group(models.Model):
     def get_absolute_url(self):
         return reverse('network.group', kwargs={'pk': self.pk})
 
+    def get_host_addresses(self):
+        """Return the (ipv4, ipv6) address pairs of the member hosts grouped
+        by vlan.
+        """
+        addresses = OrderedDict()
+        for host in self.host_set.all():
+            addresses.setdefault(host.vlan, []).append(
+                (host.ipv4, host.ipv6_with_host_prefixlen))
+        return addresses
+
 
 class Host(models.Model):
     """
@@ -756,6 +832,89 @@ class Host(models.Model):
                        description='created by host.save()',
                        type='AAAA').save()
 
+    @classmethod
+    def mass_create(cls, hosts, ports=()):
+        """Save new hosts with their dns records, default groups and the
+        given ports opened on each of them.
+
+        Rows are inserted in bulk, and a single reload is requested instead
+        of one for each saved object.
+
+        :param hosts: unsaved Host objects
+        :param ports: (proto, private port) pairs to open on each host
+        """
+        from firewall.allocation import host_addresses, update_address_indexes
+        from firewall.fw import (touch_dhcp_subnets, touch_dns_zones,
+                                 touch_firewall_sections)
+
+        with deferred_reload():
+            for host in hosts:
+                if host.ipv6 == "auto":
+                    host.ipv6 = host.vlan.convert_ipv4_to_ipv6(host.ipv4)
+                host.full_clean()
+            bulk_insert(Host, hosts)
+
+            Record.objects.bulk_create(
+                Record(host=host, name=host.hostname,
+                       domain=host.vlan.domain, address=address,
+                       owner=host.owner, type=type,
+                       description='created by host.save()')
+                for host in hosts
+                for type, address in (('A', host.ipv4), ('AAAA', host.ipv6))
+                if address is not None)
+
+            groups = Group.objects.filter(
+                name__in=settings.get('default_host_groups', []))
+            Host.groups.through.objects.bulk_create(
+                Host.groups.through(host_id=host.pk, group_id=group.pk)
+                for host in hosts for group in groups)
+
+            if ports:
+                cls._mass_add_ports(hosts, ports)
+
+            vlans = set(host.vlan_id for host in hosts)
+            touch_dns_zones(set('vlan:%d' % pk for pk in vlans) |
+                            set('domain:%d' % host.vlan.domain_id
+                                for host in hosts))
+            touch_dhcp_subnets(vlans)
+            # groups and rules are inserted without signals
+            touch_firewall_sections(['host', 'nat'])
+            # the ports of the new rules are marked used when allocated
+            update_address_indexes(added=[
+                host_addresses(host.vlan_id, host.ipv4, host.ipv6,
+                               host.external_ipv4) for host in hosts])
+            _deferred_reload.types.add('Host')
+
+    @classmethod
+    def _mass_add_ports(cls, hosts, ports):
+        vgname = settings["default_vlangroup"]
+        vg = VlanGroup.objects.filter(name=vgname).first()
+        if vg is None:
+            logger.error('Host.mass_create: default_vlangroup %s missing.',
+                         vgname)
+            return
+        rules = []
+        for proto, private in ports:
+            # hosts sharing a public address get their ports at once
+            shared = OrderedDict()
+            for host in hosts:
+                rule = Rule(direction='in', owner=host.owner, dport=private,
+                            proto=proto, nat=False, action='accept',
+                            host=host, foreign_network=vg)
+                if host.behind_nat:
+                    rule.nat = True
+                    shared.setdefault(host.get_port_key(proto), []).append(
+                        rule)
+                rules.append(rule)
+            for nat_rules in shared.values():
+                public = nat_rules[0].host._get_random_ports(
+                    proto, len(nat_rules))
+                for rule, port in zip(nat_rules, public):
+                    rule.nat_external_port = port
+        for rule in rules:
+            rule.full_clean()
+        Rule.objects.bulk_create(rules)
+
     def get_network_config(self):
         interface = {'addresses': []}
 
@@ -797,6 +956,9 @@ class Host(models.Model):
         Get a random unused port for given protocol for current host's public
         IP address.
 
+        Ports of hosts behind NAT are taken from the cached index of the
+        public address, and reserved until the rule using them is saved.
+
         :param proto: The transport protocol of the generated port (tcp|udp).
         :type proto: str.
         :param used_ports: Optional set of used ports returned by
@@ -804,19 +966,61 @@ class Host(models.Model):
         :returns: int -- the generated port number.
         :raises: ValidationError
         """
+        from firewall.allocation import PortIndex
+
+        if used_ports is None and self.behind_nat:
+            return self._get_random_ports(proto, 1)[0]
         if used_ports is None:
             used_ports = self._get_ports_used(proto)
+        public = PortIndex(PUBLIC_PORT_RANGES, used_ports).find_free(
+            PUBLIC_PORT_RANGES[0])
+        if public is None:
+            raise ValidationError(
+                _("All %s ports are already in use.") % proto)
+        return public
 
-        public = random.randint(1024, 21000)  # pick a random port
-        if public in used_ports:  # if it's in use, select smallest free one
-            for i in range(1024, 21000) + range(24000, 65535):
-                if i not in used_ports:
-                    public = i
-                    break
-            else:
+    def _get_random_ports(self, proto, count):
+        """Get count reserved, unused ports for given protocol for the shared
+        public IP address of current host.
+
+        The reservations expire after RESERVATION_TIMEOUT seconds, so the
+        allocated ports are checked against the saved rules as well, and
+        the ones in use are replaced.
+        """
+        from firewall.allocation import allocate_ports, release_port
+
+        key = self.get_port_key(proto)
+        ports = []
+        while len(ports) < count:
+            new = allocate_ports(
+                key, PUBLIC_PORT_RANGES, lambda: self._get_ports_used(proto),
+                count - len(ports), PUBLIC_PORT_RANGES[0])
+            if not new:
+                for port in ports:
+                    release_port(key, port)
                 raise ValidationError(
                     _("All %s ports are already in use.") % proto)
-        return public
+            used = set(Rule.objects.filter(
+                host__external_ipv4=self.external_ipv4, nat=True,
+                proto=proto, nat_external_port__in=new).values_list(
+                    'nat_external_port', flat=True))
+            for port in used:
+                logger.info("Port %s of %s is in use, skipping.", port, key)
+                release_port(key, port)
+            ports.extend(port for port in new if port not in used)
+        return ports
+
+    def get_port_key(self, proto):
+        """Return the key of the index of the public ports of the host.
+        """
+        return 'nat:%s:%s' % (self.external_ipv4, proto)
+
+    def get_port_keys(self):
+        """Return the keys of the port indexes depending on the host.
+        """
+        if self.external_ipv4 is None:
+            return set()
+        return set(self.get_port_key(proto) for proto in ('tcp', 'udp'))
 
     def add_port(self, proto, public=None, private=None):
         """
@@ -947,6 +1151,20 @@ class Host(models.Model):
     def get_absolute_url(self):
         return reverse('network.host', kwargs={'pk': self.pk})
 
+    def get_dhcp_subnets(self):
+        """Return the vlans whose dhcp configuration depends on the host.
+        """
+        return set([self.vlan_id])
+
+    def get_dns_zones(self):
+        """Return the dns zones depending on the host.
+        """
+        zones = set(['vlan:%d' % self.vlan_id])
+        if self.pk:
+            zones.update('domain:%d' % pk for pk in
+                         self.record_set.values_list('domain_id', flat=True))
+        return zones
+
     @property
     def eui(self):
         return EUI(self.mac)
@@ -989,8 +1207,10 @@ class Firewall(models.Model):
     @method_cache(20)
     def get_dhcp_clients(self):
         try:
-            return get_dhcp_clients.apply_async(
-                queue=self.get_remote_queue_name(), expires=60).get(timeout=2)
+            queue = self.get_remote_queue_name()
+            with measure_remote(get_dhcp_clients.name, queue):
+                return get_dhcp_clients.apply_async(
+                    queue=queue, expires=60).get(timeout=2)
         except TimeoutError:
             logger.info("get_dhcp_clients task timed out")
         except IOError:
@@ -1097,6 +1317,23 @@ class Record(models.Model):
     def get_absolute_url(self):
         return reverse('network.record', kwargs={'pk': self.pk})
 
+    def get_dns_zones(self):
+        """Return the dns zones depending on the record, or None if
+        it may affect any of them.
+        """
+        if self.type == 'A' and not self.host_id:
+            # public reverse name of any host behind NAT
+            return None
+        zones = set(['domain:%d' % self.domain_id])
+        zones.update('vlan:%d' % pk for pk in Host.objects.filter(
+            pk=self.host_id).values_list('vlan_id', flat=True))
+        return zones
+
+    def get_dhcp_subnets(self):
+        """Return the vlans whose dhcp configuration depends on the record.
+        """
+        return set()
+
     class Meta:
         app_label = 'firewall'
         verbose_name = _("record")
@@ -1199,11 +1436,267 @@ class BlacklistItem(models.Model):
         return reverse('network.blacklist', kwargs={'pk': self.pk})
 
 
+@contextmanager
+def deferred_reload():
+    """Request the reloads caused by saving or deleting objects in the block
+    only once for each type, when leaving the outermost block.
+    """
+    if hasattr(_deferred_reload, 'types'):
+        yield
+        return
+    _deferred_reload.types = set()
+    try:
+        yield
+    finally:
+        types = _deferred_reload.types
+        del _deferred_reload.types
+        for type in types:
+            reloadtask.apply_async(queue='localhost.man', args=[type])
+
+
+_deferred_reload = local()
+
+
 def send_task(sender, instance, created=False, **kwargs):
-    reloadtask.apply_async(queue='localhost.man', args=[sender.__name__])
+    types = getattr(_deferred_reload, 'types', None)
+    if types is not None:
+        types.add(sender.__name__)
+    else:
+        reloadtask.apply_async(queue='localhost.man', args=[sender.__name__])
 
 
 for sender in [Host, Rule, Domain, Record, Vlan, Firewall, Group,
                BlacklistItem, SwitchPort, EthernetDevice]:
     post_save.connect(send_task, sender=sender)
     post_delete.connect(send_task, sender=sender)
+
+
+# fields the generated configuration depending on a model is selected by
+CONFIG_FIELDS = {
+    'Host': ('vlan_id', 'ipv4', 'ipv6', 'external_ipv4'),
+    'Record': ('type', 'host_id', 'domain_id'),
+    'Rule': ('nat', 'host_id', 'proto', 'nat_external_port', 'firewall_id',
+             'hostgroup_id', 'vlan_id'),
+    'Vlan': ('network4', ),
+}
+
+
+def get_config_fields(instance):
+    """Return the loaded values of the CONFIG_FIELDS of the instance.
+    """
+    return {field: instance.__dict__[field]
+            for field in CONFIG_FIELDS[instance.__class__.__name__]
+            if field in instance.__dict__}
+
+
+def get_old_copy(instance):
+    """Return a copy of the instance with the CONFIG_FIELDS it has been
+    loaded with, or the instance itself if they have not changed.
+    """
+    old_fields = getattr(instance, '_config_fields', None)
+    if not old_fields or old_fields == get_config_fields(instance):
+        return instance
+    old = copy(instance)
+    old.__dict__.update(old_fields)
+    for field in old_fields:
+        if field.endswith('_id'):
+            # drop the cached related object of the new value
+            old.__dict__.pop('_%s_cache' % field[:-3], None)
+    return old
+
+
+def get_old_config_field(instance, field):
+    """Return the value of the field the instance has been loaded with.
+    """
+    old_fields = getattr(instance, '_config_fields', None) or {}
+    return old_fields.get(field, getattr(instance, field))
+
+
+def touch_generated_config(sender, instance, **kwargs):
+    """Mark the dns zones and dhcp subnets depending on the instance as
+    changed, when the transaction is committed.
+
+    Models without get_dns_zones or get_dhcp_subnets methods affect all
+    zones and subnets.
+
+    The configuration depending on the values of the CONFIG_FIELDS the
+    instance has been loaded with is touched as well.
+    """
+    from firewall.fw import touch_dns_zones, touch_dhcp_subnets
+
+    instances = [instance]
+    old = get_old_copy(instance)
+    if not kwargs.get('created') and old is not instance:
+        instances.append(old)
+    if sender.__name__ in CONFIG_FIELDS:
+        instance._config_fields = get_config_fields(instance)
+
+    for i in instances:
+        touch_dns_zones(i.get_dns_zones()
+                        if hasattr(i, 'get_dns_zones') else None)
+        touch_dhcp_subnets(i.get_dhcp_subnets()
+                           if hasattr(i, 'get_dhcp_subnets') else None)
+
+
+def update_rule_ports(sender, instance, created=False, signal=None,
+                      **kwargs):
+    """Update the port indexes of this process with the public port of the
+    saved or deleted rule.
+    """
+    from firewall.allocation import update_port_indexes
+
+    new = instance.get_public_port()
+    old = None if created else get_old_copy(instance).get_public_port()
+    if signal is post_delete:
+        new = None
+    if old != new:
+        update_port_indexes(added=filter(None, [new]),
+                            removed=filter(None, [old]))
+    instance._config_fields = get_config_fields(instance)
+
+
+def touch_rule_sections(sender, instance, created=False, **kwargs):
+    """Mark the sections of the iptables rules depending on the rule, or on
+    the values it has been loaded with, as changed.
+    """
+    from firewall.fw import touch_firewall_sections
+
+    sections = instance.get_firewall_sections()
+    if not created:
+        sections |= get_old_copy(instance).get_firewall_sections()
+    touch_firewall_sections(sections)
+
+
+def touch_host_sections(sender, instance, created=False, signal=None,
+                        **kwargs):
+    """Mark the sections of the iptables rules depending on the addresses
+    of the host as changed, if they have changed or the host is deleted.
+
+    Rules and group memberships of the host touch their sections
+    themselves.
+    """
+    from firewall.fw import touch_firewall_sections
+
+    if created:
+        if instance.external_ipv4 is not None:
+            touch_firewall_sections(['nat'])
+    elif signal is post_delete or get_old_copy(instance) is not instance:
+        touch_firewall_sections(['host', 'nat'])
+
+
+def touch_all_sections(sender, instance, **kwargs):
+    """Mark all sections of the iptables rules as changed.
+    """
+    from firewall.fw import touch_firewall_sections
+
+    touch_firewall_sections()
+
+
+# sections of the iptables rules depending on many-to-many relations,
+# None for all of them
+M2M_SECTIONS = {
+    VlanGroup.vlans.through: None,
+    Host.groups.through: ['host'],
+    Vlan.snat_to.through: ['nat'],
+}
+
+
+def touch_m2m_sections(sender, action, **kwargs):
+    """Mark the sections of the iptables rules depending on the changed
+    relation as changed.
+    """
+    from firewall.fw import touch_firewall_sections
+
+    if action.startswith('post_'):
+        touch_firewall_sections(M2M_SECTIONS[sender])
+
+
+def touch_host_ports(sender, instance, created=False, **kwargs):
+    """Mark the port indexes of the old and new public address of the host
+    as changed, if its public address has changed.
+    """
+    from firewall.allocation import touch_port_indexes
+
+    old = get_old_copy(instance)
+    if (not created and
+            unicode(old.external_ipv4) != unicode(instance.external_ipv4)):
+        touch_port_indexes(old.get_port_keys() | instance.get_port_keys())
+
+
+def update_host_addresses(sender, instance, created=False, signal=None,
+                          **kwargs):
+    """Update the address indexes of this process with the addresses of the
+    saved or deleted host.
+
+    Connected before touch_generated_config, which replaces the tracked
+    fields with the saved ones.
+    """
+    from firewall.allocation import host_addresses, update_address_indexes
+
+    new = host_addresses(instance.vlan_id, instance.ipv4, instance.ipv6,
+                         instance.external_ipv4)
+    if created:
+        update_address_indexes(added=[new])
+        return
+    old = host_addresses(*(get_old_config_field(instance, field)
+                           for field in CONFIG_FIELDS['Host']))
+    if signal is post_delete:
+        update_address_indexes(removed=[old])
+    elif old != new:
+        update_address_indexes(added=[new], removed=[old])
+
+
+def touch_vlan_addresses(sender, instance, created=False, signal=None,
+                         **kwargs):
+    """Mark the address index of the vlan as changed, if its network has
+    changed or it is deleted.
+    """
+    from firewall.allocation import touch_address_indexes
+
+    old = get_old_config_field(instance, 'network4')
+    if signal is post_delete or (not created and
+                                 unicode(old) != unicode(instance.network4)):
+        touch_address_indexes([instance.pk])
+
+
+def track_config_fields(sender, instance, **kwargs):
+    instance._config_fields = get_config_fields(instance)
+
+
+def load_config_fields(sender, instance, raw=False, **kwargs):
+    """Query the CONFIG_FIELDS the instance has been loaded without.
+    """
+    if raw or instance.pk is None:
+        return
+    fields = CONFIG_FIELDS[sender.__name__]
+    tracked = getattr(instance, '_config_fields', None) or {}
+    if len(tracked) < len(fields):
+        values = sender.objects.filter(pk=instance.pk).values(*fields).first()
+        if values is not None:
+            values.update(tracked)
+            instance._config_fields = values
+
+
+for sender in [Host, Record, Rule, Vlan]:
+    post_init.connect(track_config_fields, sender=sender)
+    pre_save.connect(load_config_fields, sender=sender)
+    pre_delete.connect(load_config_fields, sender=sender)
+post_save.connect(update_host_addresses, sender=Host)
+post_delete.connect(update_host_addresses, sender=Host)
+post_save.connect(touch_host_ports, sender=Host)
+post_save.connect(touch_host_sections, sender=Host)
+post_delete.connect(touch_host_sections, sender=Host)
+post_save.connect(touch_rule_sections, sender=Rule)
+post_delete.connect(touch_rule_sections, sender=Rule)
+for sender in [Vlan, VlanGroup]:
+    post_save.connect(touch_all_sections, sender=sender)
+    post_delete.connect(touch_all_sections, sender=sender)
+for sender in M2M_SECTIONS:
+    m2m_changed.connect(touch_m2m_sections, sender=sender)
+post_save.connect(touch_vlan_addresses, sender=Vlan)
+post_delete.connect(touch_vlan_addresses, sender=Vlan)
+for sender in [Host, Record, Domain, Vlan]:
+    post_save.connect(touch_generated_config, sender=sender)
+    post_delete.connect(touch_generated_config, sender=sender)
+post_save.connect(update_rule_ports, sender=Rule)
+post_delete.connect(update_rule_ports, sender=Rule)
@@ -15,38 +15,153 @@
 # You should have received a copy of the GNU General Public License along
 # with CIRCLE.  If not, see <http://www.gnu.org/licenses/>.
 
+from hashlib import sha1
 from logging import getLogger
 from socket import gethostname
+from time import time
 
 import django.conf
 from django.core.cache import cache
 from celery.exceptions import TimeoutError
 
 from manager.mancelery import celery
+from manager.presence import get_online_since
 from common.models import WorkerNotFound
 
 settings = django.conf.settings.FIREWALL_SETTINGS
 logger = getLogger(__name__)
 
+COMPONENTS = ('dns', 'dhcp', 'firewall', 'firewall_vlan', 'blacklist')
+
+
+def _reload_window():
+    """Return the quiet period and the maximal delay of reloads in seconds.
+
+    A reload is started when no change has been requested for the quiet
+    period, or when the first pending request is older than the maximal
+    delay.
+    """
+    return (float(settings.get('reload_quiet_period', 5)),
+            float(settings.get('reload_max_delay', 30)))
+
+
+def _digest(data):
+    """Return a stable content hash of the arguments of a reload task.
+    """
+
+    return sha1(repr(data)).hexdigest()
+
+
+def _digest_key(name, queue):
+    return "%s_digest_%s" % (name, queue)
+
+
+def _get_applied(name, queues):
+    """Return the digest of the configuration last applied on each queue.
+
+    Digests are dropped when the worker of the queue has come online since
+    the configuration was sent (see manager.presence), or when a reload of
+    the component has been forced.  They also expire after
+    reload_digest_ttl seconds, as a firewall may lose its configuration
+    without reconnecting.
+    """
+
+    reset = cache.get("%s_digest_reset" % name) or 0
+    stored = cache.get_many([_digest_key(name, queue) for queue in queues])
+    applied = {}
+    for queue in queues:
+        value = stored.get(_digest_key(name, queue))
+        if value is None:
+            continue
+        digest, sent_at = value
+        since = get_online_since(queue)
+        if sent_at > reset and (since is None or sent_at > since):
+            applied[queue] = digest
+    return applied
+
 
 def _apply_once(name, tasks, queues, task, data):
-    """Reload given networking component if needed.
+    """Send the configuration of given networking component if needed.
+
+    Queues which have already received the same configuration are skipped.
+    Returns a list of (name, queue, digest, sending time, result) tuples of
+    the sent tasks, which can be waited for by _collect_results.
     """
 
     if name not in tasks:
-        return
+        return []
 
     data = data()
+    digest = _digest(data)
+    applied = _get_applied(name, queues)
+    sent = []
     for queue in queues:
-        try:
-            task.apply_async(args=data, queue=queue, expires=60).get(timeout=2)
-            logger.info("%s configuration is reloaded. (queue: %s)",
+        if applied.get(queue) == digest:
+            logger.info("%s configuration is unchanged. (queue: %s)",
                         name, queue)
-        except TimeoutError as e:
-            logger.critical('%s (queue: %s, task: %s)', e, queue, name)
-        except:
+            continue
+        try:
+            sent.append((name, queue, digest, time(), task.apply_async(
+                args=data, queue=queue, expires=60)))
+        except Exception:
             logger.critical('Unhandled exception: queue: %s data: %s task: %s',
                             queue, data, name, exc_info=True)
+    return sent
+
+
+def _collect_results(sent, timeout=2):
+    """Wait for the sent reload tasks in parallel.
+
+    Each task has its own deadline of timeout seconds after the fan-out
+    for itself and for every task sent to the same queue before it, as
+    the worker of a queue runs them one after the other.
+
+    Returns a dict of the result ('ok', 'timeout' or 'error') by
+    (name, queue).
+    """
+
+    results = {}
+    applied = {}
+    started = time()
+    queued = {}
+    for name, queue, digest, sent_at, result in sent:
+        queued[queue] = queued.get(queue, 0) + 1
+        deadline = started + timeout * queued[queue]
+        try:
+            result.get(timeout=max(deadline - time(), 0.1))
+        except TimeoutError as e:
+            logger.critical('%s (queue: %s, task: %s)', e, queue, name)
+            results[(name, queue)] = 'timeout'
+        except Exception:
+            logger.critical('Unhandled exception: queue: %s task: %s',
+                            queue, name, exc_info=True)
+            results[(name, queue)] = 'error'
+        else:
+            logger.info("%s configuration is reloaded. (queue: %s)",
+                        name, queue)
+            results[(name, queue)] = 'ok'
+            applied[_digest_key(name, queue)] = (digest, sent_at)
+
+    if applied:
+        cache.set_many(applied, settings.get('reload_digest_ttl', 300))
+    return results
+
+
+def _send_metrics(latency, requests, results):
+    from monitor.client import Client
+
+    now = time()
+    prefix = "circle.%s.firewall.reload" % gethostname()
+    metrics = ["%s.latency %f %d" % (prefix, latency, now),
+               "%s.requests %d %d" % (prefix, requests, now),
+               "%s.tasks %d %d" % (prefix, len(results), now),
+               "%s.failed %d %d" % (
+                   prefix, len([i for i in results.values() if i != 'ok']),
+                   now)]
+    try:
+        Client().send(metrics)
+    except Exception:
+        logger.exception("Failed to send reload metrics.")
 
 
 def get_firewall_queues():
@@ -60,39 +175,69 @@ def get_firewall_queues():
     return list(retval)
 
 
+def _build_firewall():
+    from firewall.fw import BuildFirewall
+    return BuildFirewall().build_ipt()
+
+
 @celery.task
-def reloadtask_worker():
-    from firewall.fw import BuildFirewall, dhcp, dns, ipset, vlan
+def reloadtask_worker(debounce=True):
+    from firewall.fw import dhcp, dns, ipset, vlan
     from remote_tasks import (reload_dns, reload_dhcp, reload_firewall,
                               reload_firewall_vlan, reload_blacklist)
 
+    quiet_period, max_delay = _reload_window()
+    now = time()
+    first_request = float(cache.get('reload_first_request') or now)
+    if debounce:
+        last_request = float(cache.get('reload_last_request') or now)
+        wait = min(last_request + quiet_period,
+                   first_request + max_delay) - now
+        if wait > 0.5:
+            logger.info("reloadtask_worker: postponed by %.1f s", wait)
+            reloadtask_worker.apply_async(queue='localhost.man',
+                                          countdown=wait)
+            return
+
+    cache.delete('reload_scheduled')
+    requests = int(cache.get('reload_requests') or 0)
+    cache.delete_many(['reload_first_request', 'reload_requests'])
+
     tasks = []
-    for i in ('dns', 'dhcp', 'firewall', 'firewall_vlan', 'blacklist'):
+    for i in COMPONENTS:
         lockname = "%s_lock" % i
         if cache.get(lockname):
             tasks.append(i)
         cache.delete(lockname)
 
-    logger.info("reloadtask_worker: Reload %s", ", ".join(tasks))
+    if not tasks:
+        return
+    logger.info("reloadtask_worker: Reload %s (%d requests coalesced)",
+                ", ".join(tasks), requests)
 
     firewall_queues = get_firewall_queues()
     dns_queues = [("%s.dns" % i) for i in
                   settings.get('dns_queues', [gethostname()])]
 
-    _apply_once('dns', tasks, dns_queues, reload_dns,
-                lambda: (dns(), ))
-    _apply_once('dhcp', tasks, firewall_queues, reload_dhcp,
-                lambda: (dhcp(), ))
-    _apply_once('firewall', tasks, firewall_queues, reload_firewall,
-                lambda: (BuildFirewall().build_ipt()))
-    _apply_once('firewall_vlan', tasks, firewall_queues, reload_firewall_vlan,
-                lambda: (vlan(), ))
-    _apply_once('blacklist', tasks, firewall_queues, reload_blacklist,
-                lambda: (list(ipset()), ))
+    sent = []
+    sent += _apply_once('dns', tasks, dns_queues, reload_dns,
+                        lambda: (dns(), ))
+    sent += _apply_once('dhcp', tasks, firewall_queues, reload_dhcp,
+                        lambda: (dhcp(), ))
+    sent += _apply_once('firewall', tasks, firewall_queues, reload_firewall,
+                        _build_firewall)
+    sent += _apply_once('firewall_vlan', tasks, firewall_queues,
+                        reload_firewall_vlan, lambda: (vlan(), ))
+    sent += _apply_once('blacklist', tasks, firewall_queues, reload_blacklist,
+                        lambda: (list(ipset()), ))
+    results = _collect_results(sent)
+
+    _send_metrics(time() - first_request, requests, results)
+    return results
 
 
 @celery.task
-def reloadtask(type='Host', timeout=15, sync=False):
+def reloadtask(type='Host', timeout=15, sync=False, force=False):
     reload = {
         'Host': ['dns', 'dhcp', 'firewall'],
         'Record': ['dns'],
@@ -106,7 +251,26 @@ def reloadtask(type='Host', timeout=15, sync=False):
     }[type]
     logger.info("Reload %s on next periodic iteration applying change to %s.",
                 ", ".join(reload), type)
-    if all([cache.add("%s_lock" % i, 'true', 30) for i in reload]):
-        res = reloadtask_worker.apply_async(queue='localhost.man', countdown=5)
-        if sync:
-            res.get(timeout)
+    if force:
+        cache.set_many({"%s_digest_reset" % i: time() for i in reload}, None)
+
+    quiet_period, max_delay = _reload_window()
+    ttl = int(max_delay + quiet_period) + 60
+    now = time()
+    for i in reload:
+        cache.add("%s_lock" % i, 'true', ttl)
+    cache.add('reload_first_request', now, ttl)
+    cache.set('reload_last_request', now, ttl)
+    if not cache.add('reload_requests', 1, ttl):
+        try:
+            cache.incr('reload_requests')
+        except ValueError:
+            pass
+
+    if sync:
+        res = reloadtask_worker.apply_async(queue='localhost.man',
+                                            kwargs={'debounce': False})
+        res.get(timeout)
+    elif cache.add('reload_scheduled', 'true', ttl):
+        reloadtask_worker.apply_async(queue='localhost.man',
+                                      countdown=quiet_period)
@@ -16,6 +16,7 @@
 # with CIRCLE.  If not, see <http://www.gnu.org/licenses/>.
 
 from manager.mancelery import celery
+from manager.presence import is_queue_alive
 
 
 def check_queue(firewall, queue_id, priority):
@@ -25,6 +26,9 @@ def check_queue(firewall, queue_id, priority):
     queue_name = firewall + "." + queue_id
     if priority is not None:
         queue_name = queue_name + "." + priority
+    alive = is_queue_alive(queue_name)
+    if alive is not None:
+        return alive
     inspect = celery.control.inspect()
     inspect.timeout = 0.1
     active_queues = inspect.active_queues()
@@ -15,21 +15,35 @@
 # You should have received a copy of the GNU General Public License along
 # with CIRCLE.  If not, see <http://www.gnu.org/licenses/>.
 
-from mock import patch
-from netaddr import IPSet, AddrFormatError
+from time import time
+
+from mock import patch, MagicMock
+from itertools import islice
+
+from netaddr import IPAddress, IPSet, IPNetwork, AddrFormatError
 
 import django.conf
 from django.contrib.auth.models import User
+from django.core.cache import cache
 from django.forms import ValidationError
-from django.test import TestCase
+from django.test import TestCase, override_settings
 
 from common.tests.celery_mock import MockCeleryMixin
+from common.tests.commit import run_commit_hooks
 from firewall.admin import HostAdmin
-from firewall.fw import dns, ipv6_to_octal
+from firewall.allocation import (AddressIndex, PortIndex,
+                                 RESERVATION_TIMEOUT, address_index_cache,
+                                 get_address_index, get_port_index,
+                                 release_address)
+from firewall.fw import (BuildFirewall, FIREWALL_SECTIONS, dhcp,
+                         dhcp_subnet_cache, dns, dns_zones, ipv6_to_octal,
+                         generate_ptr_records, generate_records,
+                         generate_soa_record)
 from firewall.iptables import IptRule, IptChain, InvalidRuleExcepion
 from firewall.models import (Vlan, Domain, Record, Host, VlanGroup, Group,
-                             Rule, Firewall)
-from firewall.tasks.local_tasks import reloadtask_worker, reloadtask
+                             Rule, Firewall, PUBLIC_PORT_RANGES)
+from firewall.tasks.local_tasks import (reloadtask_worker, reloadtask,
+                                        _apply_once, _collect_results)
 
 settings = django.conf.settings.FIREWALL_SETTINGS
 
@@ -87,9 +101,11 @@ class GetNewAddressTestCase(MockCeleryMixin, TestCase):
             Host(hostname='h-%d' % i, mac='01:02:03:04:05:%02d' % i,
                  ipv4='10.0.0.%d' % i, vlan=self.vlan,
                  owner=self.u1).save()
+        address_index_cache.clear()
 
     def tearDown(self):
         self.vlan.delete()
+        address_index_cache.clear()
 
     def test_new_addr_w_empty_vlan(self):
         self.vlan.host_set.all().delete()
@@ -115,6 +131,133 @@ class GetNewAddressTestCase(MockCeleryMixin, TestCase):
         used_v4 = IPSet(self.vlan.host_set.values_list('ipv4', flat=True))
         assert self.vlan.get_new_address()['ipv4'] not in used_v4
 
+    def test_new_addr_ipv6(self):
+        address = self.vlan.get_new_address()
+        self.assertEqual(address['ipv6'],
+                         self.vlan.convert_ipv4_to_ipv6(address['ipv4']))
+
+    def test_new_addresses(self):
+        addresses = self.vlan.get_new_addresses(2)
+        self.assertEqual(set(['10.0.0.2', '10.0.0.6']),
+                         set(str(a['ipv4']) for a in addresses))
+        self.assertRaises(ValidationError, self.vlan.get_new_addresses, 3)
+
+    @override_settings(CACHES={'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+    def test_new_addr_reserved(self):
+        cache.clear()
+        first = self.vlan.get_new_address()
+        address_index_cache.clear()
+        second = self.vlan.get_new_address()
+        self.assertNotEqual(first['ipv4'], second['ipv4'])
+        address_index_cache.clear()
+        release_address(first['ipv4'])
+        self.assertEqual(first['ipv4'], self.vlan.get_new_address()['ipv4'])
+        cache.clear()
+
+    @override_settings(CACHES={'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+    def test_address_index_update(self):
+        cache.clear()
+        index = get_address_index(self.vlan)
+        self.assertEqual(2, index.free_count())
+        host = Host(hostname='h-6', mac='01:02:03:04:05:06', ipv4='10.0.0.6',
+                    vlan=self.vlan, owner=self.u1)
+        host.save()
+        self.assertTrue(index.is_free('10.0.0.6'))
+        run_commit_hooks()
+        self.assertIs(index, get_address_index(self.vlan))
+        self.assertFalse(index.is_free('10.0.0.6'))
+        self.assertEqual(1, index.free_count())
+
+        host.ipv4 = '10.0.0.2'
+        host.save()
+        run_commit_hooks()
+        self.assertTrue(index.is_free('10.0.0.6'))
+        self.assertFalse(index.is_free('10.0.0.2'))
+
+        host.delete()
+        run_commit_hooks()
+        self.assertIs(index, get_address_index(self.vlan))
+        self.assertEqual(2, index.free_count())
+        cache.clear()
+
+    @override_settings(CACHES={'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+    def test_address_index_shared_external(self):
+        cache.clear()
+        index = get_address_index(self.vlan)
+        hosts = [Host(hostname='h-nat%d' % i, mac='01:02:03:04:06:%02d' % i,
+                      ipv4='100.0.0.%d' % i, external_ipv4='10.0.0.2',
+                      shared_ip=True, vlan=self.vlan, owner=self.u1)
+                 for i in (1, 2)]
+        for host in hosts:
+            host.save()
+        run_commit_hooks()
+        self.assertFalse(index.is_free('10.0.0.2'))
+        hosts[0].delete()
+        run_commit_hooks()
+        self.assertFalse(index.is_free('10.0.0.2'))
+        hosts[1].delete()
+        run_commit_hooks()
+        self.assertTrue(index.is_free('10.0.0.2'))
+        cache.clear()
+
+    @override_settings(CACHES={'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+    def test_address_index_network_change(self):
+        cache.clear()
+        index = get_address_index(self.vlan)
+        self.vlan.comment = 'changed'
+        self.vlan.save()
+        run_commit_hooks()
+        self.assertIs(index, get_address_index(self.vlan))
+        self.vlan.network4 = IPNetwork('10.0.0.0/28')
+        self.vlan.save()
+        run_commit_hooks()
+        self.assertIsNot(index, get_address_index(self.vlan))
+        cache.clear()
+
+    @override_settings(CACHES={'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+    def test_new_addr_after_concurrent_commit(self):
+        cache.clear()
+        first = self.vlan.get_new_address()['ipv4']
+        index = get_address_index(self.vlan)
+        other = ({'10.0.0.2', '10.0.0.6'} - {str(first)}).pop()
+        # saved by another process, the index of this one is not updated
+        Host.objects.bulk_create([Host(
+            hostname='h-other', mac='01:02:03:04:05:06',
+            ipv4=IPAddress(other),
+            vlan=self.vlan, owner=self.u1)])
+        self.assertTrue(index.is_free(other))
+        self.assertRaises(ValidationError, self.vlan.get_new_address)
+        self.assertFalse(get_address_index(self.vlan).is_free(other))
+        cache.clear()
+
+    @override_settings(CACHES={'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+    def test_new_addr_reservation_expiry(self):
+        cache.clear()
+        now = time()
+        first = self.vlan.get_new_address()['ipv4']
+        index = get_address_index(self.vlan)
+        self.assertFalse(index.is_free(first))
+        with patch('firewall.allocation.time',
+                   return_value=now + RESERVATION_TIMEOUT + 1):
+            self.assertIs(index, get_address_index(self.vlan))
+        self.assertTrue(index.is_free(first))
+        cache.clear()
+
+    def test_address_index_large_network(self):
+        network = IPNetwork('10.0.0.0/16')
+        used = list(islice(network.iter_hosts(), 65000))
+        index = AddressIndex(network, used)
+        self.assertEqual(65534 - 65000, index.free_count())
+        for i in range(65534 - 65000):
+            self.assertNotIn(index.find_free(), used[:10])
+        self.assertIsNone(index.find_free())
+
 
 class HostGetHostnameTestCase(MockCeleryMixin, TestCase):
     def setUp(self):
@@ -197,6 +340,15 @@ class IptablesTestCase(TestCase):
         self.assertEqual(len(compiled.splitlines()), len(ch))
         self.assertEqual(len(compiled_v6.splitlines()), 0)
 
+    def test_chain_digest(self):
+        ch = IptChain(name='test')
+        ch.add(*self.r[:4])
+        digest = ch.digest()
+        self.assertEqual(digest, ch.digest())
+        ch.add(self.r[4])
+        self.assertNotEqual(digest, ch.digest())
+        self.assertEqual(len(ch.compile().splitlines()), len(ch))
+
 
 class ReloadTestCase(MockCeleryMixin, TestCase):
     def setUp(self):
@@ -256,6 +408,7 @@ class ReloadTestCase(MockCeleryMixin, TestCase):
             self.rb.save()
         self.rm.save()
         self.rt.save()
+        run_commit_hooks()
 
     def tearDown(self):
         settings["default_host_groups"] = []
@@ -272,6 +425,72 @@ class ReloadTestCase(MockCeleryMixin, TestCase):
                          len((self.r1, self.r2, self.rm, self.rt)) + 1,
                          len(records))
 
+    @override_settings(CACHES={'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+    def test_dns_zones_regenerate_changed_only(self):
+        cache.clear()
+        first = dict(dns_zones())
+        self.assertEqual(first, dict(dns_zones()))
+        second = dict(dns_zones())
+        self.assertIs(first['vlan:%d' % self.vlan2.pk],
+                      second['vlan:%d' % self.vlan2.pk])
+        self.h1.ipv6 = '2001:2:3:4::0'
+        self.h1.save()
+        # the zones are touched when the transaction is committed
+        self.assertIs(first['vlan:%d' % self.vlan.pk],
+                      dict(dns_zones())['vlan:%d' % self.vlan.pk])
+        run_commit_hooks()
+        third = dict(dns_zones())
+        self.assertIs(first['vlan:%d' % self.vlan2.pk],
+                      third['vlan:%d' % self.vlan2.pk])
+        self.assertNotEqual(first['vlan:%d' % self.vlan.pk],
+                            third['vlan:%d' % self.vlan.pk])
+        self.assertEqual(sorted(dns()),
+                         sorted(generate_ptr_records() + generate_records() +
+                                [generate_soa_record(d)
+                                 for d in Domain.objects.all()]))
+        cache.clear()
+
+    @override_settings(CACHES={'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+    def test_dns_zones_of_moved_host(self):
+        cache.clear()
+        zones = dict(dns_zones())
+        host = Host.objects.get(pk=self.h1.pk)
+        host.vlan = self.vlan2
+        with self.assertNumQueries(0):
+            track = host._config_fields
+        host.save()
+        run_commit_hooks()
+        self.assertEqual(track['vlan_id'], self.vlan.pk)
+        changed = dict(dns_zones())
+        for vlan in (self.vlan, self.vlan2):
+            self.assertNotEqual(zones['vlan:%d' % vlan.pk],
+                                changed['vlan:%d' % vlan.pk])
+        cache.clear()
+
+    @override_settings(CACHES={'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+    def test_dhcp_regenerate_changed_only(self):
+        self.vlan2.dhcp_pool = 'manual'
+        self.vlan2.save()
+        run_commit_hooks()
+        config = dhcp()
+        self.assertEqual(len(config), 2 + Host.objects.count())
+        first = dict(dhcp_subnet_cache)
+        Host.objects.create(hostname='h-1', vlan=self.vlan2,
+                            mac='01:02:03:04:05:99', ipv4='10.1.0.6',
+                            owner=self.u1)
+        # the subnet is touched when the transaction is committed
+        dhcp()
+        self.assertIs(first[self.vlan2.pk], dhcp_subnet_cache[self.vlan2.pk])
+        run_commit_hooks()
+        config = dhcp()
+        self.assertIs(first[self.vlan.pk], dhcp_subnet_cache[self.vlan.pk])
+        self.assertIsNot(first[self.vlan2.pk],
+                         dhcp_subnet_cache[self.vlan2.pk])
+        self.assertIn('host h-1-2 {', ''.join(config))
+
     def test_host_add_port(self):
         h = self.h1
         h.ipv6 = '2001:2:3:4::0'
@@ -304,6 +523,21 @@ class ReloadTestCase(MockCeleryMixin, TestCase):
         self.assertEqual(endp['ipv6'][0], h.ipv6)
         assert int(endp['ipv6'][1])
 
+    def test_host_mass_create(self):
+        hosts = [Host(hostname='h-6', vlan=self.vlan, owner=self.u1,
+                      mac='01:02:03:04:05:06', ipv4='10.0.0.6'),
+                 Host(hostname='h-7', vlan=self.vlan2, owner=self.u1,
+                      mac='01:02:03:04:05:07', ipv4='10.1.0.6')]
+        with patch.object(Rule, 'full_clean', autospec=True,
+                          side_effect=Rule.full_clean) as full_clean:
+            Host.mass_create(hosts, [('tcp', 22)])
+        self.assertEqual(2, full_clean.call_count)
+        nat, public = [host.rules.get(dport=22) for host in hosts]
+        self.assertTrue(nat.nat)
+        self.assertIsNotNone(nat.nat_external_port)
+        self.assertFalse(public.nat)
+        self.assertEqual(1, Record.objects.filter(host=hosts[0]).count())
+
     def test_host_del_port(self):
         h = self.h1
         h.ipv6 = '2001:2:3:4::0'
@@ -314,6 +548,82 @@ class ReloadTestCase(MockCeleryMixin, TestCase):
         new_rules = h.rules.count()
         self.assertEqual(new_rules, old_rules - 1)
 
+    @override_settings(CACHES={'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+    def test_host_add_port_uses_port_index(self):
+        cache.clear()
+        h2 = Host.objects.get(hostname='h-2')
+        self.h1.add_port('tcp', private=22)
+        h2.add_port('tcp', private=22)
+        used = self.h1._get_ports_used('tcp')
+        index = get_port_index(self.h1.get_port_key('tcp'),
+                               PUBLIC_PORT_RANGES, lambda: used)
+        self.assertEqual(2, len(used))
+        for port in used:
+            self.assertFalse(index.is_free(port))
+        self.assertNotEqual(self.h1._get_random_port('tcp'),
+                            h2._get_random_port('tcp'))
+        cache.clear()
+
+    @override_settings(CACHES={'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+    def test_random_ports_checked_against_saved_rules(self):
+        cache.clear()
+        key = self.h1.get_port_key('tcp')
+        index = get_port_index(key, PUBLIC_PORT_RANGES, lambda: ())
+        start = PUBLIC_PORT_RANGES[0][0]
+        index.used[:] = bytearray(b'\1') * len(index.used)
+        index.used[start] = index.used[start + 1] = 0
+        # saved after the reservation of the port has expired, and
+        # before the index has been touched
+        Rule.objects.bulk_create([Rule(
+            direction='in', owner=self.u1, dport=22, proto='tcp',
+            nat=True, action='accept', host=self.h1,
+            foreign_network=VlanGroup.objects.get(name='public'),
+            nat_external_port=start)])
+        self.assertEqual([start + 1], self.h1._get_random_ports('tcp', 1))
+        # the full index is built again, the reserved port is skipped
+        port = self.h1._get_random_ports('tcp', 1)[0]
+        self.assertNotIn(port, (start, start + 1))
+        self.assertIsNot(index, get_port_index(key, PUBLIC_PORT_RANGES,
+                                               lambda: ()))
+        cache.clear()
+
+    @override_settings(CACHES={'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+    def test_port_index_update(self):
+        cache.clear()
+        key = self.h1.get_port_key('tcp')
+        self.h1.add_port('tcp', private=22)
+        run_commit_hooks()
+        index = get_port_index(key, PUBLIC_PORT_RANGES, lambda: ())
+        rule = self.h1.rules.get(nat=True, dport=22)
+        port = rule.nat_external_port
+        self.assertFalse(index.is_free(port))
+        rule.nat_external_port = port + 1
+        rule.save()
+        run_commit_hooks()
+        self.assertTrue(index.is_free(port))
+        self.assertFalse(index.is_free(port + 1))
+        self.h1.del_port('tcp', private=22)
+        run_commit_hooks()
+        self.assertIs(index, get_port_index(key, PUBLIC_PORT_RANGES,
+                                            lambda: ()))
+        self.assertTrue(index.is_free(port + 1))
+        cache.clear()
+
+    def test_port_index(self):
+        index = PortIndex([(10, 15), (20, 22)], [11, 12])
+        self.assertEqual(5, index.free_count())
+        self.assertFalse(index.is_free(16))
+        ports = [index.find_free() for i in range(5)]
+        self.assertEqual([10, 13, 14, 20, 21], ports)
+        self.assertIsNone(index.find_free((10, 15)))
+        index.unmark(13)
+        index.unmark(16)
+        self.assertTrue(index.is_free(13))
+        self.assertFalse(index.is_free(16))
+
     def test_host_add_port_wo_vlangroup(self):
         VlanGroup.objects.filter(name='public').delete()
         h = self.h1
@@ -322,6 +632,161 @@ class ReloadTestCase(MockCeleryMixin, TestCase):
         new_rules = h.rules.count()
         self.assertEqual(new_rules, old_rules)
 
+    def test_build_firewall_reuses_unchanged_chains(self):
+        BuildFirewall.last_chains = {}
+        BuildFirewall.last_output = None
+        first = BuildFirewall()
+        output = first.build_ipt()
+        self.assertEqual(set(first.changed_chains), set(first.chains))
+        second = BuildFirewall()
+        with patch('firewall.fw.loader.get_template') as get_template:
+            self.assertIs(output, second.build_ipt())
+        self.assertFalse(get_template.called)
+        self.assertEqual(second.changed_chains, [])
+        self.assertEqual(second.chain_digests(), first.chain_digests())
+        self.h1.add_port('tcp', private=22)
+        third = BuildFirewall()
+        third.build_ipt()
+        self.assertIn('PREROUTING', third.changed_chains)
+        self.assertIs(third.chains['OUTPUT'], first.chains['OUTPUT'])
+        self.assertNotEqual(output, BuildFirewall.last_output[1])
+
+    @override_settings(CACHES={'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+    def test_build_firewall_rebuilds_changed_sections(self):
+        cache.clear()
+        BuildFirewall.last_sections = {}
+        first = BuildFirewall()
+        output = first.build_ipt()
+        self.assertEqual(set(first.rebuilt_sections), set(FIREWALL_SECTIONS))
+        second = BuildFirewall()
+        # only the vlan names of the jump rules are queried
+        with self.assertNumQueries(1):
+            self.assertIs(output, second.build_ipt())
+        self.assertEqual(second.rebuilt_sections, [])
+
+        self.h1.description = 'changed'
+        self.h1.save()
+        run_commit_hooks()
+        third = BuildFirewall()
+        third.build_ipt()
+        self.assertEqual(third.rebuilt_sections, [])
+
+        self.h1.add_port('tcp', private=22)
+        run_commit_hooks()
+        fourth = BuildFirewall()
+        fourth.build_ipt()
+        self.assertEqual(set(fourth.rebuilt_sections), set(['host', 'nat']))
+        self.assertIn('PREROUTING', fourth.changed_chains)
+
+        self.h1.groups.remove(self.hg)
+        run_commit_hooks()
+        fifth = BuildFirewall()
+        fifth.build_ipt()
+        self.assertEqual(fifth.rebuilt_sections, ['host'])
+        cache.clear()
+
+    def test_group_rules_bulk_expansion(self):
+        rule = self.hg.rules.get()
+        expected = {}
+        for host in self.hg.host_set.all():
+            for chain_name, ipt_rule in rule.get_ipt_rules(host).items():
+                expected.setdefault(chain_name, set()).add(ipt_rule)
+        bulk = rule.get_ipt_rules_for_hosts(self.hg.get_host_addresses())
+        self.assertEqual(expected, {chain_name: set(ipt_rules) for
+                                    chain_name, ipt_rules in bulk.items()})
+
+    def apply_dns(self, task, queues=('fw.dns', 'fw2.dns')):
+        return _collect_results(_apply_once(
+            'dns', ['dns'], list(queues), task,
+            lambda: (['Zexample.org'], )))
+
+    @override_settings(CACHES={'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+    def test_apply_once_skips_unchanged(self):
+        task = MagicMock()
+        cache.clear()
+        self.apply_dns(task)
+        self.assertEqual(self.apply_dns(task), {})
+        self.assertEqual(task.apply_async.call_count, 2)
+        cache.clear()
+
+    @override_settings(CACHES={'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+    def test_apply_once_after_reconnect(self):
+        task = MagicMock()
+        cache.clear()
+        self.apply_dns(task)
+        since = {'fw.dns': time() + 1}
+        with patch('firewall.tasks.local_tasks.get_online_since',
+                   side_effect=since.get):
+            self.assertEqual({('dns', 'fw.dns'): 'ok'}, self.apply_dns(task))
+        self.assertEqual(task.apply_async.call_count, 3)
+        cache.clear()
+
+    @override_settings(CACHES={'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+    def test_apply_once_forced(self):
+        task = MagicMock()
+        cache.clear()
+        self.apply_dns(task)
+        with patch('firewall.tasks.local_tasks.reloadtask_worker'):
+            reloadtask('Record', force=True)
+        self.assertEqual(2, len(self.apply_dns(task)))
+        cache.clear()
+
+    def test_collect_results_deadline_per_queue(self):
+        timeouts = {}
+
+        def sent(name, queue):
+            result = MagicMock()
+            result.get.side_effect = lambda timeout: timeouts.update(
+                {(name, queue): timeout})
+            return (name, queue, 'digest', time(), result)
+
+        results = _collect_results([sent('dhcp', 'fw'), sent('dhcp', 'fw2'),
+                                    sent('firewall', 'fw')], timeout=10)
+        self.assertEqual(set(results.values()), set(['ok']))
+        self.assertTrue(9 < timeouts[('dhcp', 'fw')] <= 10)
+        self.assertTrue(9 < timeouts[('dhcp', 'fw2')] <= 10)
+        self.assertTrue(19 < timeouts[('firewall', 'fw')] <= 20)
+
+    def test_reload_requests_are_coalesced(self):
+        values = {}
+
+        def add(key, value, ttl=None):
+            if key in values:
+                return False
+            values[key] = value
+            return True
+
+        def incr(key):
+            values[key] += 1
+
+        worker = 'firewall.tasks.local_tasks.reloadtask_worker.apply_async'
+        with patch('firewall.tasks.local_tasks.cache') as cache, \
+                patch(worker) as worker:
+            cache.add.side_effect = add
+            cache.incr.side_effect = incr
+            cache.set.side_effect = lambda key, value, ttl: values.update(
+                {key: value})
+            for type in ('Host', 'Rule', 'Host', 'Record'):
+                reloadtask(type)
+        self.assertEqual(worker.call_count, 1)
+        self.assertEqual(values['reload_requests'], 4)
+        self.assertEqual(set(['dns_lock', 'dhcp_lock', 'firewall_lock']),
+                         set(i for i in values if i.endswith('_lock')))
+
+    def test_reload_is_postponed_while_changes_arrive(self):
+        worker = 'firewall.tasks.local_tasks.reloadtask_worker.apply_async'
+        with patch('firewall.tasks.local_tasks.cache') as cache, \
+                patch(worker) as worker:
+            cache.get.side_effect = lambda key: time()
+            reloadtask_worker()
+        assert worker.called
+        assert 4 < worker.call_args[1]['countdown'] < 6
+        assert not cache.delete.called
+
     def test_periodic_task(self):
         # TODO
         cache = patch('firewall.tasks.local_tasks.cache')
@@ -340,6 +805,7 @@ class ReloadTestCase(MockCeleryMixin, TestCase):
         dhcp = patch('firewall.tasks.remote_tasks.reload_dhcp.apply_async')
 
         with cache as cache, grqn, dns, fw, fw_vlan, blacklist, dhcp, worker:
+            cache.get_many.return_value = {}
             self.test_host_add_port()
             self.test_host_add_port2()
             reloadtask_worker()
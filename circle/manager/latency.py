@@ -0,0 +1,241 @@
+# Copyright 2014 Budapest University of Technology and Economics (BME IK)
+#
+# This file is part of CIRCLE Cloud.
+#
+# CIRCLE is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# CIRCLE is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along
+# with CIRCLE.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Latency of celery tasks and remote calls.
+
+Each process records in histograms how long the tasks it runs waited in
+the queue and ran, and the round trip of the remote calls it makes.  The
+histograms are published after each FLUSH_INTERVAL to Graphite and to the
+cache, where the dashboard merges the histograms of all processes.
+"""
+
+from bisect import bisect_left
+from contextlib import contextmanager
+from logging import getLogger
+from socket import gethostname
+from threading import Lock
+from time import time
+import os
+
+from celery.signals import (
+    before_task_publish, task_postrun, task_prerun, worker_process_shutdown)
+from django.core.cache import cache
+
+logger = getLogger(__name__)
+
+# upper bounds of the histogram buckets in seconds, from 1 ms to 2 hours
+BUCKETS = tuple(0.001 * 1.5 ** i for i in xrange(40))
+PERCENTILES = (50, 95, 99)
+# seconds between publishing the histograms of a process
+FLUSH_INTERVAL = 60
+# seconds the histograms of a process are kept in the cache
+KEEP_SECONDS = 600
+INDEX_KEY = 'task_latency_index'
+SENT_HEADER = 'circle_sent_at'
+
+QUEUE, RUN, REMOTE = 'queue', 'run', 'remote'
+
+
+class Histogram(object):
+    """Counts of durations in the BUCKETS.
+
+    Histograms of different processes can be merged.
+    """
+
+    def __init__(self, counts=None, total=0.0):
+        self.counts = list(counts or [0] * (len(BUCKETS) + 1))
+        self.total = total
+
+    @property
+    def count(self):
+        return sum(self.counts)
+
+    @property
+    def mean(self):
+        count = self.count
+        return self.total / count if count else None
+
+    def add(self, seconds):
+        self.counts[bisect_left(BUCKETS, seconds)] += 1
+        self.total += seconds
+
+    def merge(self, other):
+        self.counts = [a + b for a, b in zip(self.counts, other.counts)]
+        self.total += other.total
+
+    def percentile(self, percent):
+        """Return the upper bound of the bucket of the percentile, or None
+        if the histogram is empty.
+        """
+        rank = self.count * percent / 100.0
+        seen = 0
+        for i, count in enumerate(self.counts):
+            seen += count
+            if count and seen >= rank:
+                return BUCKETS[min(i, len(BUCKETS) - 1)]
+        return None
+
+    def __getstate__(self):
+        return (self.counts, self.total)
+
+    def __setstate__(self, state):
+        self.counts, self.total = state
+
+
+def merge_histograms(target, histograms):
+    for key, histogram in histograms.iteritems():
+        if key in target:
+            target[key].merge(histogram)
+        else:
+            target[key] = Histogram(histogram.counts, histogram.total)
+    return target
+
+
+class LatencyRecorder(object):
+    """The histograms of this process by kind, task name and target queue.
+    """
+
+    def __init__(self):
+        self.lock = Lock()
+        self.histograms = {}
+        self.recent = []  # (end of window, histograms)
+        self.window_start = time()
+        self.cache_key = 'task_latency_%s_%d' % (gethostname(), os.getpid())
+
+    def record(self, kind, name, target, seconds):
+        key = (kind, name, target or '')
+        with self.lock:
+            if key not in self.histograms:
+                self.histograms[key] = Histogram()
+            self.histograms[key].add(max(seconds, 0))
+            due = time() - self.window_start >= FLUSH_INTERVAL
+        if due:
+            self.flush()
+
+    def flush(self):
+        """Publish the histograms of the current window.
+        """
+        now = time()
+        with self.lock:
+            histograms, self.histograms = self.histograms, {}
+            self.window_start = now
+            if not histograms:
+                return
+            self.recent = [(end, h) for end, h in self.recent
+                           if now - end < KEEP_SECONDS]
+            self.recent.append((now, histograms))
+            kept = {}
+            for end, h in self.recent:
+                merge_histograms(kept, h)
+        try:
+            save_histograms(self.cache_key, kept)
+        except Exception:
+            logger.exception('Saving task latency histograms failed.')
+        try:
+            send_histograms(histograms, now)
+        except Exception:
+            logger.exception('Sending task latency metrics failed.')
+
+
+def save_histograms(cache_key, histograms):
+    cache.set(cache_key, histograms, KEEP_SECONDS)
+    index = cache.get(INDEX_KEY) or []
+    if cache_key not in index:
+        alive = cache.get_many(index)
+        index = [key for key in index if key in alive] + [cache_key]
+        cache.set(INDEX_KEY, index, None)
+
+
+def get_histograms():
+    """Return the histograms of all processes from the last KEEP_SECONDS
+    merged.
+    """
+    result = {}
+    for histograms in cache.get_many(cache.get(INDEX_KEY) or []).values():
+        merge_histograms(result, histograms)
+    return result
+
+
+def send_histograms(histograms, now):
+    from monitor.client import Client
+
+    try:
+        client = Client()
+    except RuntimeError as e:
+        logger.debug('Not sending task latency metrics: %s', unicode(e))
+        return
+
+    def clean(name):
+        return (name or 'none').replace('.', '_')
+
+    metrics = []
+    for (kind, name, target), histogram in histograms.iteritems():
+        prefix = '%s.tasks.%s.%s.%s' % (client.name, kind, clean(name),
+                                        clean(target))
+        metrics.append('%s.count %d %d' % (prefix, histogram.count, now))
+        for percent in PERCENTILES:
+            metrics.append('%s.p%d %f %d' % (
+                prefix, percent, histogram.percentile(percent) * 1000, now))
+    client.send(metrics)
+
+
+recorder = LatencyRecorder()
+
+
+@contextmanager
+def measure_remote(task_name, queue):
+    """Record the round trip of a remote call made in the block.
+    """
+    start = time()
+    try:
+        yield
+    finally:
+        recorder.record(REMOTE, task_name, queue, time() - start)
+
+
+# start of the tasks running in this process by task id
+_started = {}
+
+
+@before_task_publish.connect
+def stamp_task(headers=None, **kwargs):
+    if headers is not None:
+        headers[SENT_HEADER] = time()
+
+
+@task_prerun.connect
+def task_started(task_id=None, task=None, **kwargs):
+    now = time()
+    request = task.request
+    sent = (request.headers or {}).get(SENT_HEADER)
+    if sent is not None:
+        target = (request.delivery_info or {}).get('routing_key')
+        recorder.record(QUEUE, task.name, target, now - sent)
+    _started[task_id] = now
+
+
+@task_postrun.connect
+def task_finished(task_id=None, task=None, **kwargs):
+    start = _started.pop(task_id, None)
+    if start is not None:
+        target = (task.request.delivery_info or {}).get('routing_key')
+        recorder.record(RUN, task.name, target, time() - start)
+
+
+@worker_process_shutdown.connect
+def flush_latency(**kwargs):
+    recorder.flush()
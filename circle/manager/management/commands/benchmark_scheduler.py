@@ -0,0 +1,116 @@
+# Copyright 2014 Budapest University of Technology and Economics (BME IK)
+#
+# This file is part of CIRCLE Cloud.
+#
+# CIRCLE is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# CIRCLE is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along
+# with CIRCLE.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import unicode_literals, absolute_import
+
+from collections import namedtuple
+from random import Random
+from time import time
+
+from django.core.management.base import BaseCommand
+
+from manager.scheduler import (
+    ClusterSnapshot, NodeState, POLICIES, SchedulerError)
+from vm.models.node import trait_mask
+
+SyntheticNode = namedtuple('SyntheticNode', ['pk', 'priority'])
+
+GIB = 1024 * 1024 * 1024
+
+
+class Command(BaseCommand):
+    help = ('Simulate placing instances on a synthetic cluster with each '
+            'scheduler policy.')
+
+    def add_arguments(self, parser):
+
+        parser.add_argument('--nodes',
+                            action='store',
+                            dest='nodes',
+                            default=1000,
+                            type=int,
+                            help='number of synthetic nodes')
+
+        parser.add_argument('--instances',
+                            action='store',
+                            dest='instances',
+                            default=2000,
+                            type=int,
+                            help='number of instances to place')
+
+        parser.add_argument('--traits',
+                            action='store',
+                            dest='traits',
+                            default=8,
+                            type=int,
+                            help='number of distinct traits')
+
+        parser.add_argument('--policies',
+                            action='store',
+                            dest='policies',
+                            default=','.join(sorted(POLICIES)),
+                            help='comma separated scheduler policies')
+
+    def handle(self, *args, **options):
+        self.stdout.write('%-15s %10s %8s %7s %7s %9s %9s' % (
+            'policy', 'place', 'placed', 'failed', 'nodes', 'max fill',
+            'avg fill'))
+        for policy in options['policies'].split(','):
+            self.simulate(policy, options['nodes'], options['instances'],
+                          options['traits'])
+
+    def create_snapshot(self, random, count, traits, policy):
+        states = []
+        for i in xrange(count):
+            ram_size = random.choice((32, 64, 128, 256)) * GIB
+            states.append(NodeState(
+                SyntheticNode(pk=i, priority=random.randint(0, 10)),
+                traits=trait_mask(t for t in range(traits)
+                                  if random.random() < 0.2),
+                ram_size=ram_size,
+                ram_usage=ram_size * random.random() * 0.5,
+                ram_size_with_overcommit=ram_size * 1.5,
+                allocated_ram=ram_size * random.random() * 0.5,
+                num_cores=random.choice((8, 16, 32, 64)),
+                cpu_usage=random.random()))
+        return ClusterSnapshot(states, policy)
+
+    def simulate(self, policy, nodes, instances, traits):
+        random = Random(42)
+        snapshot = self.create_snapshot(random, nodes, traits, policy)
+        requests = [(random.choice((512, 1024, 2048, 4096, 8192)),
+                     random.choice((1, 2, 4, 8)),
+                     trait_mask([random.randrange(traits)])
+                     if random.random() < 0.1 else 0)
+                    for i in xrange(instances)]
+
+        placed = failed = 0
+        start = time()
+        for ram_size, num_cores, req_traits in requests:
+            try:
+                snapshot.place(ram_size, num_cores, req_traits)
+                placed += 1
+            except SchedulerError:
+                failed += 1
+        elapsed = time() - start
+
+        used = [s for s in snapshot.states if s.reserved_ram]
+        fill = [float(s.allocated_ram + s.reserved_ram) /
+                s.ram_size_with_overcommit for s in snapshot.states]
+        self.stdout.write('%-15s %7.2f us %8d %7d %7d %8.1f%% %8.1f%%' % (
+            policy, elapsed * 1e6 / max(instances, 1), placed, failed,
+            len(used), max(fill) * 100, sum(fill) * 100 / len(fill)))
@@ -21,6 +21,8 @@ from datetime import timedelta
 from kombu import Queue, Exchange
 from os import getenv
 
+from manager import latency  # noqa, records the latency of the tasks
+
 HOSTNAME = "localhost"
 QUEUE_NAME = HOSTNAME + '.monitor'
 
@@ -43,6 +45,12 @@ celery.conf.update(
             'schedule': timedelta(seconds=10),
             'options': {'queue': 'localhost.monitor'}
         },
+        'vm.reconcile_node_allocations': {
+            'task': 'vm.tasks.local_periodic_tasks.'
+                    'reconcile_node_allocations',
+            'schedule': timedelta(minutes=5),
+            'options': {'queue': 'localhost.monitor'}
+        },
         'monitor.measure_response_time': {
             'task': 'monitor.tasks.local_periodic_tasks.'
                     'measure_response_time',
@@ -61,12 +69,24 @@ celery.conf.update(
             'schedule': timedelta(seconds=30),
             'options': {'queue': 'localhost.monitor'}
         },
+        'monitor.refresh_node_metrics': {
+            'task': 'monitor.tasks.local_periodic_tasks.'
+                    'refresh_node_metrics',
+            'schedule': timedelta(seconds=15),
+            'options': {'queue': 'localhost.monitor'}
+        },
         'monitor.allocated_memory': {
             'task': 'monitor.tasks.local_periodic_tasks.'
                     'allocated_memory',
             'schedule': timedelta(seconds=30),
             'options': {'queue': 'localhost.monitor'}
         },
+        'monitor.resource_usage': {
+            'task': 'monitor.tasks.local_periodic_tasks.'
+                    'resource_usage',
+            'schedule': timedelta(seconds=60),
+            'options': {'queue': 'localhost.monitor'}
+        },
     }
 
 )
@@ -0,0 +1,188 @@
+# Copyright 2014 Budapest University of Technology and Economics (BME IK)
+#
+# This file is part of CIRCLE Cloud.
+#
+# CIRCLE is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# CIRCLE is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along
+# with CIRCLE.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Registry of the live celery queues, fed by worker heartbeat events.
+
+The watch_workers command consumes the worker events and publishes the
+queues of the live workers to the cache, so checking whether a queue is
+alive does not need a broadcast inspect.
+"""
+
+from logging import getLogger
+from time import time
+
+from django.core.cache import cache
+
+logger = getLogger(__name__)
+
+PRESENCE_KEY = 'worker_presence'
+# seconds after the last heartbeat of a worker when it is considered dead
+WORKER_EXPIRY = 30
+# seconds between publishing the registry to the cache
+SAVE_INTERVAL = 1
+# seconds between reading the registry from the cache again
+READ_INTERVAL = 1
+
+
+class WorkerRegistry(object):
+    """The queues and the last heartbeat of each live worker.
+    """
+
+    def __init__(self, get_queues):
+        """:param get_queues: Function returning the names of the queues
+                              of a worker, called when a worker appears.
+        """
+        self.get_queues = get_queues
+        self.workers = {}
+        self.saved = 0
+
+    def seen(self, worker, timestamp=None):
+        timestamp = time() if timestamp is None else timestamp
+        if worker in self.workers:
+            queues, last_seen, since = self.workers[worker]
+            self.workers[worker] = (queues, timestamp, since)
+        else:
+            self.online(worker, timestamp)
+
+    def online(self, worker, timestamp=None):
+        try:
+            queues = frozenset(self.get_queues(worker))
+        except Exception:
+            logger.exception('Getting the queues of %s failed.', worker)
+            return
+        logger.info('Worker %s is online with queues %s.', worker,
+                    ', '.join(sorted(queues)))
+        timestamp = time() if timestamp is None else timestamp
+        self.workers[worker] = (queues, timestamp, timestamp)
+
+    def offline(self, worker):
+        if self.workers.pop(worker, None) is not None:
+            logger.info('Worker %s is offline.', worker)
+
+    def get_queues_seen(self, now=None):
+        """Return the last heartbeat of each queue of the live workers.
+        """
+        now = time() if now is None else now
+        result = {}
+        for worker, (queues, last_seen, since) in self.workers.items():
+            if now - last_seen > WORKER_EXPIRY:
+                logger.info('Worker %s has expired.', worker)
+                del self.workers[worker]
+                continue
+            for queue in queues:
+                result[queue] = max(result.get(queue, 0), last_seen)
+        return result
+
+    def get_queues_since(self):
+        """Return when the last worker of each queue has come online.
+        """
+        result = {}
+        for queues, last_seen, since in self.workers.values():
+            for queue in queues:
+                result[queue] = max(result.get(queue, 0), since)
+        return result
+
+    def save(self, force=False):
+        """Publish the registry to the cache, at most once a SAVE_INTERVAL.
+        """
+        now = time()
+        if force or now - self.saved >= SAVE_INTERVAL:
+            cache.set(PRESENCE_KEY, {'updated': now,
+                                     'queues': self.get_queues_seen(now),
+                                     'since': self.get_queues_since()},
+                      WORKER_EXPIRY * 2)
+            self.saved = now
+
+
+def watch(app):
+    """Keep the registry up to date with the worker events of the celery
+    app.  Does not return.
+
+    Workers always send these events, even without the -E option.
+    """
+    def get_queues(worker):
+        inspect = app.control.inspect(destination=[worker], timeout=1)
+        result = inspect.active_queues() or {}
+        return [queue['name'] for queue in result.get(worker, ())]
+
+    registry = WorkerRegistry(get_queues)
+
+    def on_heartbeat(event):
+        registry.seen(event['hostname'])
+        registry.save()
+
+    def on_online(event):
+        registry.online(event['hostname'])
+        registry.save(force=True)
+
+    def on_offline(event):
+        registry.offline(event['hostname'])
+        registry.save(force=True)
+
+    with app.connection() as connection:
+        receiver = app.events.Receiver(connection, handlers={
+            'worker-heartbeat': on_heartbeat,
+            'worker-online': on_online,
+            'worker-offline': on_offline,
+        })
+        receiver.capture(limit=None, timeout=None, wakeup=True)
+
+
+# 'presence': (time of reading, the registry read from the cache)
+local_presence = {}
+
+
+def read_presence():
+    """Return the registry read from the cache, or None if the registry is
+    not running.
+    """
+    now = time()
+    read, presence = local_presence.get('presence', (0, None))
+    if now - read > READ_INTERVAL:
+        presence = cache.get(PRESENCE_KEY)
+        local_presence['presence'] = (now, presence)
+    if presence is None or now - presence['updated'] > WORKER_EXPIRY:
+        return None
+    return presence
+
+
+def get_presence():
+    """Return the last heartbeat of each live queue, or None if the registry
+    is not running.
+    """
+    presence = read_presence()
+    return None if presence is None else presence['queues']
+
+
+def get_online_since(queue_name):
+    """Return when the worker of the queue has come online, or None if it is
+    unknown.
+    """
+    presence = read_presence()
+    if presence is None:
+        return None
+    return presence.get('since', {}).get(queue_name)
+
+
+def is_queue_alive(queue_name):
+    """True if a worker of the queue has been seen recently, False if not,
+    and None if the registry is not running.
+    """
+    presence = get_presence()
+    if presence is None:
+        return None
+    return time() - presence.get(queue_name, 0) <= WORKER_EXPIRY
@@ -17,6 +17,8 @@
 
 from logging import getLogger
 
+from django.conf import settings
+from django.db.models import QuerySet
 from django.utils.translation import ugettext_noop
 
 from common.models import HumanReadableException
@@ -50,77 +52,201 @@ class TraitsUnsatisfiableException(SchedulerError):
         "new virtual machine currently.")
 
 
-def select_node(instance, nodes):
-    ''' Select a node for hosting an instance based on its requirements.
-    '''
-    # check required traits
-    nodes = [n for n in nodes
-             if n.schedule_enabled and n.online and
-             has_traits(instance.req_traits.all(), n)]
-    if not nodes:
-        logger.warning('select_node: no usable node for %s', unicode(instance))
-        raise TraitsUnsatisfiableException()
-
-    # check required RAM
-    nodes = [n for n in nodes if has_enough_ram(instance.ram_size, n)]
-    if not nodes:
-        logger.warning('select_node: no enough RAM for %s', unicode(instance))
-        raise NotEnoughMemoryException()
-
-    # sort nodes first by processor usage, then priority
-    nodes.sort(key=lambda n: n.priority, reverse=True)
-    nodes.sort(key=free_cpu_time, reverse=True)
-    result = nodes[0]
-
-    logger.info('select_node: %s for %s', unicode(result), unicode(instance))
-    return result
-
-
-def has_traits(traits, node):
-    """True, if the node has all specified traits; otherwise, false.
+class NodeState(object):
+    """The state of a node in a cluster snapshot.
+
+    All values are read once when the snapshot is built, the memory and
+    processor cores of the instances placed in the current round are
+    recorded as reservations.
+    """
+
+    def __init__(self, node, traits=0, ram_size=0, ram_usage=0,
+                 ram_size_with_overcommit=0, allocated_ram=0,
+                 num_cores=0, cpu_usage=0):
+        self.node = node
+        self.pk = node.pk
+        self.priority = node.priority
+        # bitmask of the traits of the node
+        self.traits = traits
+        self.ram_size = ram_size
+        self.ram_usage = ram_usage
+        self.ram_size_with_overcommit = ram_size_with_overcommit
+        self.allocated_ram = allocated_ram
+        self.num_cores = num_cores
+        self.cpu_usage = cpu_usage
+        self.reserved_ram = 0
+        self.reserved_cores = 0
+        # bytes of memory not used on the node
+        self.unused_ram = ram_size - ram_usage
+        # bytes of memory not allocated to instances, with overcommit
+        self.free_ram = ram_size_with_overcommit - allocated_ram
+        self.free_cpu_time = num_cores * (1 - cpu_usage / 100.0)
+
+    @classmethod
+    def from_node(cls, node, allocated_ram=None, traits=None):
+        """Read the state of the node, or return None if the monitoring
+        data of the node is incorrect.
+        """
+        from vm.models.node import trait_mask
+        if allocated_ram is None:
+            allocated_ram = node.allocated_ram
+        if traits is None:
+            traits = trait_mask(node.traits.all())
+        try:
+            values = dict(
+                ram_size=node.ram_size, ram_usage=node.byte_ram_usage,
+                ram_size_with_overcommit=node.ram_size_with_overcommit,
+                num_cores=node.num_cores, cpu_usage=node.cpu_usage)
+        except TypeError:
+            values = {}
+        if not values or None in values.values():
+            logger.warning('Got incorrect monitoring data for node %s.',
+                           unicode(node))
+            return None
+        return cls(node, traits=traits, allocated_ram=allocated_ram, **values)
+
+    def reserve(self, ram_size, num_cores):
+        ram_size = ram_size * 1024 * 1024
+        self.reserved_ram += ram_size
+        self.reserved_cores += num_cores
+        self.unused_ram -= ram_size
+        self.free_ram -= ram_size
+        self.free_cpu_time -= num_cores
+
+
+def spread(state, ram_size, num_cores, traits):
+    """Prefer the node with the most idle processor time, then priority.
+    """
+    return (state.free_cpu_time, state.priority)
+
+
+def pack(state, ram_size, num_cores, traits):
+    """Prefer the node with the least free memory, filling up nodes before
+    using new ones.
+    """
+    return (-min(state.unused_ram, state.free_ram), state.priority,
+            state.free_cpu_time)
+
+
+def trait_affinity(state, ram_size, num_cores, traits):
+    """Prefer the node with the least traits not required, keeping nodes
+    with special traits for the instances requiring them.
     """
-    traits = set(traits)
-    return traits.issubset(node.traits.all())
+    return (-bin(state.traits & ~traits).count('1'), state.free_cpu_time,
+            state.priority)
+
+
+POLICIES = {
+    'spread': spread,
+    'pack': pack,
+    'trait_affinity': trait_affinity,
+}
 
 
-def has_enough_ram(ram_size, node):
-    """True, if the node has enough memory to accomodate a guest requiring
-       ram_size mebibytes of memory; otherwise, false.
+def get_policy(policy=None):
+    """Return the policy function of the given name, or the one set by
+    VM_SCHEDULER_POLICY.
     """
-    ram_size = ram_size * 1024 * 1024
-    try:
-        total = node.ram_size
-        used = node.byte_ram_usage
-        unused = total - used
+    if policy is None:
+        policy = getattr(settings, 'VM_SCHEDULER_POLICY', 'spread')
+    if callable(policy):
+        return policy
+    return POLICIES[policy]
 
-        overcommit = node.ram_size_with_overcommit
-        reserved = node.allocated_ram
-        free = overcommit - reserved
 
-        retval = ram_size < unused and ram_size < free
+class ClusterSnapshot(object):
+    """The state of the schedulable nodes for one scheduling round.
 
-        logger.debug('has_enough_ram(%d, %s)=%s (total=%s unused=%s'
-                     ' overcommit=%s free=%s free_ok=%s overcommit_ok=%s)',
-                     ram_size, node, retval, total, unused, overcommit, free,
-                     ram_size < unused, ram_size < free)
-        return retval
-    except TypeError as e:
-        logger.exception('Got incorrect monitoring data for node %s. %s',
-                         unicode(node), unicode(e))
-        return False
+    The nodes are queried once when the snapshot is built, placing an
+    instance only looks at the snapshot.
+    """
+
+    def __init__(self, states, policy=None):
+        self.states = list(states)
+        self.policy = get_policy(policy)
+
+    @classmethod
+    def build(cls, nodes, policy=None):
+        from vm.models.node import get_trait_index
+        if isinstance(nodes, QuerySet):
+            nodes = nodes.filter(schedule_enabled=True)
+            allocated = get_allocated_ram(nodes)
+            index = get_trait_index()
+        else:
+            allocated = index = None
+        states = (NodeState.from_node(
+            node, None if allocated is None else allocated.get(node.pk, 0),
+            None if index is None else index.get_mask(node))
+            for node in nodes if node.schedule_enabled and node.online)
+        return cls([s for s in states if s is not None], policy)
+
+    def place(self, ram_size, num_cores, traits=0):
+        """Return the state of the best node for an instance with the given
+        requirements, and reserve its resources on the node.
+
+        :param traits: Bitmask of the required traits.
+        """
+        policy = self.policy
+        ram = ram_size * 1024 * 1024
+        usable = False
+        result = best = None
+        for state in self.states:
+            if state.traits & traits != traits:
+                continue
+            usable = True
+            # not enough memory
+            if ram >= state.unused_ram or ram >= state.free_ram:
+                continue
+            key = policy(state, ram_size, num_cores, traits)
+            if result is None or key > best:
+                result, best = state, key
+        if not usable:
+            raise TraitsUnsatisfiableException()
+        if result is None:
+            raise NotEnoughMemoryException()
+        result.reserve(ram_size, num_cores)
+        return result
+
+
+def get_allocated_ram(nodes):
+    """Return the bytes of memory allocated on each of the nodes, read from
+    the ledger of node allocations.
+    """
+    from vm.models.node import get_allocations
+    return {pk: ram * 1024 * 1024
+            for pk, (ram, cores) in get_allocations(nodes).items()}
+
+
+def select_node(instance, nodes):
+    ''' Select a node for hosting an instance based on its requirements.
+    '''
+    return select_nodes([instance], nodes)[0]
 
 
-def free_cpu_time(node):
-    """Get an indicator number for idle processor time on the node.
+def select_nodes(instances, nodes, policy=None):
+    """Select a node for each of the instances based on their requirements.
 
-    Higher values indicate more idle time.
+    The nodes are read once into a snapshot, and the memory and processor
+    cores of the instances placed earlier are reserved on it, so a batch is
+    spread over the nodes instead of being placed on the same node.
     """
-    try:
-        activity = node.cpu_usage / 100
-        inactivity = 1 - activity
-        cores = node.num_cores
-        return cores * inactivity
-    except TypeError as e:
-        logger.warning('Got incorrect monitoring data for node %s. %s',
-                       unicode(node), unicode(e))
-        return False  # monitoring data is incorrect
+    from vm.models.node import trait_mask
+    snapshot = ClusterSnapshot.build(nodes, policy)
+    results = []
+    for instance in instances:
+        traits = trait_mask(instance.req_traits.all())
+        try:
+            state = snapshot.place(instance.ram_size, instance.num_cores,
+                                   traits)
+        except TraitsUnsatisfiableException:
+            logger.warning('select_node: no usable node for %s',
+                           unicode(instance))
+            raise
+        except NotEnoughMemoryException:
+            logger.warning('select_node: no enough RAM for %s',
+                           unicode(instance))
+            raise
+        logger.info('select_node: %s for %s', unicode(state.node),
+                    unicode(instance))
+        results.append(state.node)
+    return results
@@ -21,6 +21,8 @@ from datetime import timedelta
 from kombu import Queue, Exchange
 from os import getenv
 
+from manager import latency  # noqa, records the latency of the tasks
+
 HOSTNAME = "localhost"
 QUEUE_NAME = HOSTNAME + '.man.slow'
 
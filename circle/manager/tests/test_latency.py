@@ -0,0 +1,141 @@
+# Copyright 2014 Budapest University of Technology and Economics (BME IK)
+#
+# This file is part of CIRCLE Cloud.
+#
+# CIRCLE is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# CIRCLE is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along
+# with CIRCLE.  If not, see <http://www.gnu.org/licenses/>.
+
+
+from time import time
+
+from django.core.cache import cache
+from django.test import TestCase, override_settings
+from mock import MagicMock, patch
+
+from ..latency import (
+    BUCKETS, Histogram, LatencyRecorder, QUEUE, REMOTE, RUN, SENT_HEADER,
+    get_histograms, measure_remote, stamp_task, task_finished, task_started,
+)
+
+
+class HistogramTestCase(TestCase):
+
+    def test_empty(self):
+        histogram = Histogram()
+        self.assertEqual(histogram.count, 0)
+        self.assertIsNone(histogram.mean)
+        self.assertIsNone(histogram.percentile(50))
+
+    def test_percentiles(self):
+        histogram = Histogram()
+        for i in range(99):
+            histogram.add(0.001)
+        histogram.add(10)
+        self.assertEqual(histogram.count, 100)
+        self.assertEqual(histogram.percentile(50), BUCKETS[0])
+        self.assertEqual(histogram.percentile(99), BUCKETS[0])
+        self.assertGreaterEqual(histogram.percentile(100), 10)
+        self.assertAlmostEqual(histogram.mean, (0.099 + 10) / 100)
+
+    def test_merge(self):
+        a, b = Histogram(), Histogram()
+        a.add(0.01)
+        b.add(1)
+        b.add(1)
+        a.merge(b)
+        self.assertEqual(a.count, 3)
+        self.assertGreaterEqual(a.percentile(50), 1)
+
+
+@override_settings(CACHES={'default': {
+    'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+class LatencyRecorderTestCase(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        patcher = patch('manager.latency.send_histograms')
+        self.send = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        cache.clear()
+
+    def test_flush(self):
+        first, second = LatencyRecorder(), LatencyRecorder()
+        second.cache_key += '_other'
+        first.record(RUN, 'task', 'node.vm.fast', 0.1)
+        second.record(RUN, 'task', 'node.vm.fast', 0.2)
+        second.record(QUEUE, 'task', 'node.vm.fast', 0.01)
+        first.flush()
+        second.flush()
+        histograms = get_histograms()
+        self.assertEqual(histograms[(RUN, 'task', 'node.vm.fast')].count, 2)
+        self.assertEqual(histograms[(QUEUE, 'task', 'node.vm.fast')].count, 1)
+        self.assertEqual(self.send.call_count, 2)
+
+    def test_flush_keeps_recent_windows(self):
+        recorder = LatencyRecorder()
+        recorder.record(RUN, 'task', None, 0.1)
+        recorder.flush()
+        recorder.record(RUN, 'task', None, 0.1)
+        recorder.flush()
+        self.assertEqual(get_histograms()[(RUN, 'task', '')].count, 2)
+        # only the new window is sent
+        sent = self.send.call_args[0][0]
+        self.assertEqual(sent[(RUN, 'task', '')].count, 1)
+
+    def test_flush_empty(self):
+        LatencyRecorder().flush()
+        self.assertFalse(self.send.called)
+        self.assertEqual(get_histograms(), {})
+
+    def test_measure_remote(self):
+        recorder = LatencyRecorder()
+        with patch('manager.latency.recorder', recorder):
+            with self.assertRaises(ValueError):
+                with measure_remote('vm.tasks.deploy', 'node.vm.slow'):
+                    raise ValueError()
+        self.assertEqual(recorder.histograms[
+            (REMOTE, 'vm.tasks.deploy', 'node.vm.slow')].count, 1)
+
+
+class TaskSignalTestCase(TestCase):
+
+    def test_task_signals(self):
+        headers = {}
+        stamp_task(headers=headers)
+        headers[SENT_HEADER] -= 2
+        task = MagicMock()
+        task.name = 'vm.tasks.deploy'
+        task.request.headers = headers
+        task.request.delivery_info = {'routing_key': 'node.vm.fast'}
+        recorder = LatencyRecorder()
+        with patch('manager.latency.recorder', recorder):
+            task_started(task_id='1', task=task)
+            task_finished(task_id='1', task=task)
+        queued = recorder.histograms[(QUEUE, 'vm.tasks.deploy',
+                                      'node.vm.fast')]
+        self.assertEqual(queued.count, 1)
+        self.assertGreaterEqual(queued.total, 2)
+        self.assertLess(queued.total, time())
+        self.assertEqual(recorder.histograms[
+            (RUN, 'vm.tasks.deploy', 'node.vm.fast')].count, 1)
+
+    def test_task_without_header(self):
+        task = MagicMock()
+        task.request.headers = None
+        recorder = LatencyRecorder()
+        with patch('manager.latency.recorder', recorder):
+            task_started(task_id='2', task=task)
+            task_finished(task_id='2', task=task)
+        self.assertEqual([key[0] for key in recorder.histograms], [RUN])
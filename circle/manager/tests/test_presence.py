@@ -0,0 +1,81 @@
+# Copyright 2014 Budapest University of Technology and Economics (BME IK)
+#
+# This file is part of CIRCLE Cloud.
+#
+# CIRCLE is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# CIRCLE is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along
+# with CIRCLE.  If not, see <http://www.gnu.org/licenses/>.
+
+from time import time
+
+from django.core.cache import cache
+from django.test import TestCase, override_settings
+from mock import patch
+
+from ..presence import (
+    WORKER_EXPIRY, WorkerRegistry, get_online_since, is_queue_alive,
+    local_presence,
+)
+from vm.tasks.vm_tasks import check_queue
+
+
+@override_settings(CACHES={'default': {
+    'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+class WorkerRegistryTestCase(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        local_presence.clear()
+        self.registry = WorkerRegistry(lambda worker: [
+            worker + '.vm.fast', worker + '.vm.slow'])
+
+    def tearDown(self):
+        cache.clear()
+        local_presence.clear()
+
+    def test_not_running(self):
+        self.assertIsNone(is_queue_alive('node1.vm.fast'))
+
+    def test_heartbeat(self):
+        self.registry.seen('node1')
+        self.registry.save(force=True)
+        self.assertTrue(is_queue_alive('node1.vm.fast'))
+        self.assertFalse(is_queue_alive('node2.vm.fast'))
+
+    def test_offline(self):
+        self.registry.seen('node1')
+        self.registry.offline('node1')
+        self.registry.save(force=True)
+        self.assertFalse(is_queue_alive('node1.vm.fast'))
+
+    def test_expired(self):
+        self.registry.seen('node1', time() - WORKER_EXPIRY - 1)
+        self.registry.seen('node2')
+        self.assertEqual(set(['node2.vm.fast', 'node2.vm.slow']),
+                         set(self.registry.get_queues_seen()))
+
+    def test_online_since(self):
+        self.registry.seen('node1', 100)
+        self.registry.seen('node1', 110)
+        self.registry.offline('node1')
+        self.registry.seen('node1', time())
+        self.registry.save(force=True)
+        self.assertGreater(get_online_since('node1.vm.fast'), 110)
+        self.assertIsNone(get_online_since('node2.vm.fast'))
+
+    def test_check_queue_without_inspect(self):
+        self.registry.seen('node1')
+        self.registry.save(force=True)
+        with patch('vm.tasks.vm_tasks.get_queues') as get_queues:
+            self.assertTrue(check_queue('node1', 'vm', 'slow'))
+            self.assertFalse(check_queue('node1', 'net', 'fast'))
+        self.assertFalse(get_queues.called)
@@ -15,14 +15,189 @@
 # You should have received a copy of the GNU General Public License along
 # with CIRCLE.  If not, see <http://www.gnu.org/licenses/>.
 
+from collections import deque
 from itertools import islice
 from socket import gethostname
+from threading import Lock, RLock, Thread
+from time import sleep, time
+import atexit
 import logging
 import os
 import pika
 
 logger = logging.getLogger(__name__)
 
+# metrics kept while the server is unreachable, the oldest ones are dropped
+BUFFER_SIZE = 10000
+# metrics sent in one message
+CHUNK_SIZE = 100
+# seconds the metrics wait at most in the buffer
+FLUSH_INTERVAL = 5
+# seconds between attempts to connect to the server after a failure
+RETRY_INTERVAL = 10
+
+
+class Publisher(object):
+    """Long-lived connection of a process to the graphite server, with a
+    bounded buffer of the metrics not sent yet.
+
+    The buffer is flushed when it reaches CHUNK_SIZE or FLUSH_INTERVAL has
+    passed.  Metrics are removed from it only when the server has confirmed
+    them.
+    """
+
+    def __init__(self, parameters, exchange):
+        self.parameters = parameters
+        self.exchange = exchange
+        self.connection = self.channel = None
+        self.buffer = deque()
+        self.lock = RLock()
+        self.last_flush = time()
+        self.last_failure = 0
+        self.flusher = None
+        self.stats = {'sent': 0, 'dropped': 0, 'failures': 0,
+                      'connections': 0}
+
+    def get_stats(self):
+        with self.lock:
+            return dict(self.stats, buffered=len(self.buffer))
+
+    def connect(self):
+        """Connect to the server unless connected, or failed to connect in
+        the last RETRY_INTERVAL.  Return whether connected.
+        """
+        if self.channel is not None:
+            return True
+        if time() - self.last_failure < RETRY_INTERVAL:
+            return False
+        try:
+            self.connection = pika.BlockingConnection(self.parameters)
+            self.channel = self.connection.channel()
+            self.channel.confirm_delivery()
+        except Exception:
+            logger.exception('Cannot connect to the server %s.',
+                             self.parameters.host)
+            self.fail()
+            return False
+        self.stats['connections'] += 1
+        logger.info('Connection established to %s.', self.parameters.host)
+        return True
+
+    def disconnect(self):
+        connection = self.connection
+        self.connection = self.channel = None
+        if connection is not None:
+            try:
+                connection.close()
+            except Exception as e:
+                logger.debug('An error has occured while disconnecting. %s',
+                             unicode(e))
+
+    def fail(self):
+        self.stats['failures'] += 1
+        self.last_failure = time()
+        self.disconnect()
+
+    def publish(self, metrics):
+        """Add the metrics to the buffer, and flush it if it is due.
+        """
+        with self.lock:
+            for metric in metrics:
+                if len(self.buffer) >= BUFFER_SIZE:
+                    self.buffer.popleft()
+                    self.stats['dropped'] += 1
+                self.buffer.append(metric)
+            if (len(self.buffer) >= CHUNK_SIZE or
+                    time() - self.last_flush >= FLUSH_INTERVAL):
+                self.flush()
+            self.start_flusher()
+
+    def flush(self):
+        """Send the buffered metrics in chunks.  Return whether the buffer
+        has been emptied.
+        """
+        with self.lock:
+            self.last_flush = time()
+            while self.buffer:
+                chunk = list(islice(self.buffer, CHUNK_SIZE))
+                if not self._send("\n".join(chunk)):
+                    return False
+                for i in xrange(len(chunk)):
+                    self.buffer.popleft()
+                self.stats['sent'] += len(chunk)
+            return True
+
+    def _send(self, body):
+        """Publish the body and wait for the confirmation of the server.
+        This function expects that the graphite server want the metric name
+        given in the message body.
+        """
+        reconnected = self.channel is None
+        while self.connect():
+            try:
+                confirmed = self.channel.basic_publish(
+                    exchange=self.exchange, routing_key='', body=body)
+            except Exception:
+                logger.exception('An error has occured while sending '
+                                 'metrics (%dB).', len(body))
+                confirmed = None
+            if confirmed:
+                return True
+            if confirmed is False:
+                logger.error('The server has not confirmed the metrics '
+                             '(%dB).', len(body))
+            if reconnected:
+                self.fail()
+                return False
+            # the server may have closed the connection while it was idle
+            self.disconnect()
+            reconnected = True
+        return False
+
+    def start_flusher(self):
+        if self.flusher is None or not self.flusher.is_alive():
+            self.flusher = Thread(target=self.run_flusher,
+                                  name='monitor-publisher')
+            self.flusher.daemon = True
+            self.flusher.start()
+
+    def run_flusher(self):
+        while True:
+            sleep(FLUSH_INTERVAL)
+            try:
+                with self.lock:
+                    if (self.buffer and
+                            time() - self.last_flush >= FLUSH_INTERVAL):
+                        self.flush()
+            except Exception:
+                logger.exception('Flushing the metrics failed.')
+
+
+# publishers of the processes by connection parameters
+publishers = {}
+publishers_lock = Lock()
+
+
+def get_publisher(key, get_parameters, exchange):
+    """Return the publisher of this process for the key, created with the
+    parameters returned by get_parameters if missing.
+    """
+    key = (os.getpid(), ) + key
+    with publishers_lock:
+        publisher = publishers.get(key)
+        if publisher is None:
+            publisher = Publisher(get_parameters(), exchange)
+            publishers[key] = publisher
+        return publisher
+
+
+@atexit.register
+def flush_publishers():
+    pid = os.getpid()
+    for key, publisher in publishers.items():
+        if key[0] == pid:
+            publisher.flush()
+
 
 class Client:
 
@@ -48,6 +223,8 @@ class Client:
         - GRAPHITE_AMQP_QUEUE:
         - GRAPHITE_AMQP_VHOST:
         Missing only one of these variables will cause the client not to work.
+
+        The clients of a process share one connection, see Publisher.
         """
         self.name = 'circle.%s' % gethostname()
         for var, env_var in self.env_config.items():
@@ -57,70 +234,37 @@ class Client:
             else:
                 raise RuntimeError('%s environment variable missing' % env_var)
 
-    def connect(self):
+    def get_parameters(self):
         """
-        This method creates the connection to the queue of the graphite
+        Return the parameters of the connection to the queue of the graphite
         server using the environmental variables given in the constructor.
         """
-        try:
-            credentials = pika.PlainCredentials(self.amqp_user, self.amqp_pass)
-            params = pika.ConnectionParameters(host=self.server_address,
-                                               port=int(self.server_port),
-                                               virtual_host=self.amqp_vhost,
-                                               credentials=credentials)
-            self.connection = pika.BlockingConnection(params)
-            self.channel = self.connection.channel()
-            logger.info('Connection established to %s.', self.server_address)
-        except RuntimeError:
-            logger.error('Cannot connect to the server. '
-                         'Parameters may be wrong.')
-            logger.error("An error has occured while connecting to the server")
-            raise
-        except:  # FIXME
-            logger.error('Cannot connect to the server. There is no one '
-                         'listening on the other side.')
-            raise
+        credentials = pika.PlainCredentials(self.amqp_user, self.amqp_pass)
+        return pika.ConnectionParameters(host=self.server_address,
+                                         port=int(self.server_port),
+                                         virtual_host=self.amqp_vhost,
+                                         credentials=credentials)
 
-    def disconnect(self):
-        """
-        Break up the connection to the graphite server. If something went
-        wrong while disconnecting it simply cut the connection up.
-        """
-        try:
-            self.channel.close()
-            self.connection.close()
-        except RuntimeError as e:
-            logger.error('An error has occured while disconnecting. %s',
-                         unicode(e))
-            raise
-
-    def _send(self, message):
-        """
-        Send the message given in the parameters given in the message
-        parameter. This function expects that the graphite server want the
-        metric name given in the message body. (This option must be enabled
-        on the server. Otherwise it can't parse the data sent.)
+    @property
+    def publisher(self):
+        return get_publisher(
+            (self.server_address, self.server_port, self.amqp_vhost,
+             self.amqp_user, self.amqp_queue),
+            self.get_parameters, self.amqp_queue)
+
+    def send(self, message):
+        """Queue the metrics for sending.  Does not block on the server if
+        it is unreachable.
         """
-        body = "\n".join(message)
-        try:
-            self.channel.basic_publish(exchange=self.amqp_queue,
-                                       routing_key='', body=body)
-        except:
-            logger.error('An error has occured while sending metrics (%dB).',
-                         len(body))
-            raise
-
-    @staticmethod
-    def _chunker(seq, size):
-        """Yield seq in size-long chunks.
+        self.publisher.publish(message)
+
+    def flush(self):
+        """Send the queued metrics now.  Return whether all have been sent.
         """
-        for pos in xrange(0, len(seq), size):
-            yield islice(seq, pos, pos + size)
+        return self.publisher.flush()
 
-    def send(self, message):
-        self.connect()
-        try:
-            for chunk in self._chunker(message, 100):
-                self._send(chunk)
-        finally:
-            self.disconnect()
+    def get_stats(self):
+        """Return the number of metrics sent, buffered and dropped, and the
+        number of connections and failures of the publisher.
+        """
+        return self.publisher.get_stats()
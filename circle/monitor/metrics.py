@@ -0,0 +1,131 @@
+# Copyright 2014 Budapest University of Technology and Economics (BME IK)
+#
+# This file is part of CIRCLE Cloud.
+#
+# CIRCLE is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# CIRCLE is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along
+# with CIRCLE.  If not, see <http://www.gnu.org/licenses/>.
+
+from time import time
+import logging
+
+from django.conf import settings
+from django.core.cache import cache
+import requests
+
+logger = logging.getLogger(__name__)
+
+NODE_METRICS = ('cpu.percent', 'memory.usage')
+CACHE_KEY = 'cluster_node_metrics'
+# seconds between refreshes of the metrics by the periodic task
+REFRESH_INTERVAL = 15
+# metrics older than this are fetched again when they are read
+MAX_AGE = 120
+# seconds a process fetching the metrics keeps the others waiting for it
+FETCH_LOCK_TIMEOUT = 10
+
+
+class ClusterMetrics(object):
+    """The latest metrics of all nodes, fetched at once.
+    """
+
+    def __init__(self, values, updated):
+        """:param values: Dict of the metrics of each node by hostname.
+        :param updated: Timestamp of the fetch.
+        """
+        self.values = values
+        self.updated = updated
+
+    @property
+    def age(self):
+        """Seconds since the metrics have been fetched.
+        """
+        return time() - self.updated
+
+    def get(self, hostname):
+        return self.values.get(hostname, {})
+
+
+def parse_metrics(targets, prefix='circle.'):
+    """Return the last complete value of each target of a Graphite render
+    response, as a dict of metrics by hostname.
+    """
+    result = {}
+    for target in targets:
+        # Example:
+        # {"target": "circle.szianode.cpu.percent",
+        #  "datapoints": [[0.6, 1403045700], [0.5, 1403045760]
+        name = target.get('target', '')
+        if not name.startswith(prefix):
+            continue
+        try:
+            hostname, metric = name[len(prefix):].split('.', 1)
+        except ValueError:
+            continue
+        # the last datapoint may be incomplete
+        values = [value for value, timestamp in target['datapoints'][:-1]
+                  if value is not None]
+        if values:
+            result.setdefault(hostname, {})[metric] = float(values[-1])
+    return result
+
+
+def fetch_metrics():
+    """Fetch the metrics of all nodes with a single Graphite render call.
+    """
+    if not settings.GRAPHITE_URL:
+        raise ValueError('GRAPHITE_URL is not set.')
+    params = [('target', 'circle.*.%s' % metric) for metric in NODE_METRICS]
+    params.append(('from', '-5min'))
+    params.append(('format', 'json'))
+    response = requests.get(settings.GRAPHITE_URL, params=params, timeout=5)
+    response.raise_for_status()
+    return parse_metrics(response.json())
+
+
+# 'metrics': the ClusterMetrics last read by this process
+local_metrics = {}
+
+
+def refresh_metrics():
+    """Fetch the metrics of all nodes, and share them with the other
+    processes.
+    """
+    metrics = ClusterMetrics(fetch_metrics(), time())
+    cache.set(CACHE_KEY, (metrics.values, metrics.updated), MAX_AGE * 2)
+    local_metrics['metrics'] = metrics
+    return metrics
+
+
+def get_metrics():
+    """Return the metrics of all nodes.
+
+    The metrics are kept in memory and read again from the shared cache
+    after REFRESH_INTERVAL.  They are fetched from Graphite only if they
+    are older than MAX_AGE, and only by one process at a time, the others
+    get the stale metrics meanwhile.
+    """
+    metrics = local_metrics.get('metrics')
+    if metrics is None or metrics.age > REFRESH_INTERVAL:
+        cached = cache.get(CACHE_KEY)
+        if cached is not None:
+            metrics = ClusterMetrics(*cached)
+            local_metrics['metrics'] = metrics
+    if metrics is None or metrics.age > MAX_AGE:
+        locked = cache.add('%s_lock' % CACHE_KEY, True, FETCH_LOCK_TIMEOUT)
+        if locked or metrics is None:
+            try:
+                metrics = refresh_metrics()
+            finally:
+                if locked:
+                    cache.delete('%s_lock' % CACHE_KEY)
+    return metrics
@@ -20,18 +20,37 @@ import requests
 from time import time
 
 from django.conf import settings
+from django.db.models import Case, Count, IntegerField, Sum, When
 from manager.mancelery import celery
 
 from vm.tasks.vm_tasks import check_queue
 from firewall.tasks.remote_tasks import check_queue as check_queue_fw
-from vm.models import Node, InstanceTemplate
+from vm.models import Instance, Node, InstanceTemplate
+from vm.models.node import get_allocations
 from firewall.models import Firewall
-from storage.models import DataStore
+from storage.models import DataStore, Disk
 from monitor.client import Client
+from monitor.metrics import refresh_metrics
 
 logger = logging.getLogger(__name__)
 
 
+def aggregate_metrics(pattern, queryset, group_by, now, **aggregates):
+    """Return a metric for each aggregate of each group of the queryset,
+    computed with a single GROUP BY query.
+
+    The metric name is the pattern formatted with the group and the name of
+    the aggregate.
+    """
+    metrics = []
+    rows = queryset.order_by().values(group_by).annotate(**aggregates)
+    for row in rows:
+        for name in aggregates:
+            metrics.append("%s %d %s" % (
+                pattern % (row[group_by], name), row[name] or 0, now))
+    return metrics
+
+
 @celery.task(ignore_result=True)
 def measure_response_time():
     try:
@@ -97,18 +116,55 @@ def instance_per_template():
             pk, state, val, time)
     )
 
+    counts = dict(
+        (row['template'], (row['running'], row['total']))
+        for row in Instance.objects.filter(
+            destroyed_at=None, template__isnull=False).order_by().values(
+            'template').annotate(
+            total=Count('id'),
+            running=Sum(Case(When(status="RUNNING", then=1), default=0,
+                             output_field=IntegerField()))))
+
     metrics = []
-    for t in InstanceTemplate.objects.all():
-        base = t.instance_set.filter(destroyed_at=None)
-        running = base.filter(status="RUNNING").count()
-        not_running = base.exclude(status="RUNNING").count()
-        metrics.append(graphite_string(t.pk, "running", running, time()))
-        metrics.append(graphite_string(t.pk, "not_running", not_running,
-                                       time()))
+    now = time()
+    for pk in InstanceTemplate.objects.values_list('pk', flat=True):
+        running, total = counts.get(pk, (0, 0))
+        metrics.append(graphite_string(pk, "running", running, now))
+        metrics.append(graphite_string(pk, "not_running", total - running,
+                                       now))
+
+    Client().send(metrics)
+
+
+@celery.task(ignore_result=True)
+def resource_usage():
+    """Send the resources used by each owner, lease and datastore.
+    """
+    now = time()
+    instances = Instance.objects.filter(destroyed_at=None)
+    disks = Disk.objects.filter(destroyed=None)
+    metrics = (
+        aggregate_metrics("user.%d.%s", instances, 'owner', now,
+                          instances=Count('id'), ram=Sum('ram_size'),
+                          cores=Sum('num_cores')) +
+        aggregate_metrics("lease.%d.%s", instances, 'lease', now,
+                          instances=Count('id'), ram=Sum('ram_size')) +
+        aggregate_metrics("datastore.%d.%s", disks, 'datastore', now,
+                          disks=Count('id'), size=Sum('size')))
 
     Client().send(metrics)
 
 
+@celery.task(ignore_result=True)
+def refresh_node_metrics():
+    """Fetch the metrics of all nodes for the web and manager processes.
+    """
+    try:
+        refresh_metrics()
+    except Exception:
+        logger.exception('Fetching node metrics failed.')
+
+
 @celery.task(ignore_result=True)
 def allocated_memory():
     def graphite_string(hostname, val, time): return (
@@ -116,10 +172,11 @@ def allocated_memory():
             hostname, val, time)
     )
 
+    nodes = Node.objects.select_related('host')
+    allocations = get_allocations(nodes)
     metrics = []
-    for n in Node.objects.all():
-        print n.allocated_ram
+    for n in nodes:
         metrics.append(graphite_string(
-            n.host.hostname, n.allocated_ram, time()))
+            n.host.hostname, allocations[n.pk][0] * 1024 * 1024, time()))
 
     Client().send(metrics)
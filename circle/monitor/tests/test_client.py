@@ -0,0 +1,95 @@
+# Copyright 2014 Budapest University of Technology and Economics (BME IK)
+#
+# This file is part of CIRCLE Cloud.
+#
+# CIRCLE is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# CIRCLE is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along
+# with CIRCLE.  If not, see <http://www.gnu.org/licenses/>.
+
+from django.test import TestCase
+from mock import patch
+
+from ..client import CHUNK_SIZE, Client, Publisher, publishers
+
+ENVIRON = {
+    'GRAPHITE_HOST': 'localhost',
+    'GRAPHITE_AMQP_PORT': '5672',
+    'GRAPHITE_AMQP_USER': 'user',
+    'GRAPHITE_AMQP_PASSWORD': 'password',
+    'GRAPHITE_AMQP_QUEUE': 'graphite',
+    'GRAPHITE_AMQP_VHOST': '/',
+}
+
+
+class PublisherTestCase(TestCase):
+
+    def setUp(self):
+        publishers.clear()
+        patches = [patch.dict('os.environ', ENVIRON),
+                   patch.object(Publisher, 'start_flusher'),
+                   patch('monitor.client.pika.BlockingConnection')]
+        for p in patches:
+            self.connection = p.start()
+            self.addCleanup(p.stop)
+        self.channel = self.connection.return_value.channel.return_value
+        self.channel.basic_publish.return_value = True
+
+    def tearDown(self):
+        publishers.clear()
+
+    def metrics(self, count):
+        return ['test.metric %d 0' % i for i in xrange(count)]
+
+    def test_connection_reused(self):
+        Client().send(self.metrics(CHUNK_SIZE))
+        Client().send(self.metrics(CHUNK_SIZE * 2))
+        self.assertEqual(self.connection.call_count, 1)
+        self.assertEqual(self.channel.basic_publish.call_count, 3)
+        self.assertTrue(self.channel.confirm_delivery.called)
+        self.assertEqual(Client().get_stats()['sent'], CHUNK_SIZE * 3)
+
+    def test_buffered(self):
+        client = Client()
+        client.send(self.metrics(1))
+        self.assertFalse(self.channel.basic_publish.called)
+        self.assertEqual(client.get_stats()['buffered'], 1)
+        self.assertTrue(client.flush())
+        self.assertEqual(client.get_stats()['buffered'], 0)
+
+    def test_kept_until_confirmed(self):
+        client = Client()
+        self.channel.basic_publish.return_value = False
+        client.send(self.metrics(CHUNK_SIZE))
+        stats = client.get_stats()
+        self.assertEqual(stats['buffered'], CHUNK_SIZE)
+        self.assertEqual(stats['failures'], 1)
+        # no reconnection until RETRY_INTERVAL
+        self.assertFalse(client.flush())
+        self.assertEqual(self.connection.call_count, 1)
+
+    def test_reconnect(self):
+        client = Client()
+        client.send(self.metrics(CHUNK_SIZE))
+        self.channel.basic_publish.side_effect = [Exception(), True]
+        client.send(self.metrics(CHUNK_SIZE))
+        self.assertEqual(self.connection.call_count, 2)
+        self.assertEqual(client.get_stats()['sent'], CHUNK_SIZE * 2)
+
+    def test_dropped(self):
+        self.connection.side_effect = Exception()
+        client = Client()
+        with patch('monitor.client.BUFFER_SIZE', 150):
+            client.send(self.metrics(CHUNK_SIZE))
+            client.send(self.metrics(CHUNK_SIZE))
+        stats = client.get_stats()
+        self.assertEqual(stats['buffered'], 150)
+        self.assertEqual(stats['dropped'], 50)
@@ -0,0 +1,55 @@
+# Copyright 2014 Budapest University of Technology and Economics (BME IK)
+#
+# This file is part of CIRCLE Cloud.
+#
+# CIRCLE is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# CIRCLE is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along
+# with CIRCLE.  If not, see <http://www.gnu.org/licenses/>.
+
+from django.test import TestCase
+from mock import patch
+
+from ..tasks.local_periodic_tasks import (
+    instance_per_template, resource_usage,
+)
+from vm.models import Instance
+
+
+class CollectorTestCase(TestCase):
+    fixtures = ['test-vm-fixture.json', 'node.json']
+
+    def setUp(self):
+        p = patch('monitor.tasks.local_periodic_tasks.Client')
+        self.client = p.start()
+        self.addCleanup(p.stop)
+
+    def get_metrics(self):
+        metrics = self.client.return_value.send.call_args[0][0]
+        return dict(m.rsplit(' ', 1)[0].split(' ') for m in metrics)
+
+    def test_instance_per_template(self):
+        Instance.objects.filter(pk=1).update(template=1)
+        with self.assertNumQueries(2):
+            instance_per_template()
+        self.assertEqual(self.get_metrics(), {
+            'template.1.instances.running': '1',
+            'template.1.instances.not_running': '0',
+        })
+
+    def test_resource_usage(self):
+        with self.assertNumQueries(3):
+            resource_usage()
+        metrics = self.get_metrics()
+        self.assertEqual(metrics['user.1.instances'], '2')
+        self.assertEqual(metrics['user.1.ram'], '400')
+        self.assertEqual(metrics['lease.1.instances'], '2')
+        self.assertEqual(metrics['datastore.1.size'], '8589934592')
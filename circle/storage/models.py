@@ -20,6 +20,7 @@
 from __future__ import unicode_literals
 
 import logging
+from collections import defaultdict, deque, OrderedDict
 from os.path import join
 import uuid
 import re
@@ -38,8 +39,10 @@ from sizefield.models import FileSizeField
 from .tasks import local_tasks, storage_tasks
 from celery.exceptions import TimeoutError
 from common.models import (
-    WorkerNotFound, HumanReadableException, humanize_exception, method_cache
+    WorkerNotFound, HumanReadableException, humanize_exception, method_cache,
+    bulk_insert,
 )
+from manager.latency import measure_remote
 
 logger = logging.getLogger(__name__)
 
@@ -137,8 +140,9 @@ class DataStore(Model):
     def get_statistics(self, timeout=15):
         q = self.get_remote_queue_name("storage", priority="fast")
         try:
-            return storage_tasks.get_storage_stat.apply_async(
-                args=[self.type, self.path], queue=q).get(timeout=timeout)
+            with measure_remote(storage_tasks.get_storage_stat.name, q):
+                return storage_tasks.get_storage_stat.apply_async(
+                    args=[self.type, self.path], queue=q).get(timeout=timeout)
         except Exception:
             return {'free_space': -1,
                     'free_percent': -1}
@@ -153,9 +157,10 @@ class DataStore(Model):
         :type timeout: int
         """
         queue_name = self.get_remote_queue_name('storage', "slow")
-        files = set(storage_tasks.list_files.apply_async(
-            args=[self.type, self.path], queue=queue_name).get(
-                timeout=timeout))
+        with measure_remote(storage_tasks.list_files.name, queue_name):
+            files = set(storage_tasks.list_files.apply_async(
+                args=[self.type, self.path], queue=queue_name).get(
+                    timeout=timeout))
         disks = set([disk.filename for disk in self.disk_set.all()])
 
         orphans = []
@@ -172,9 +177,10 @@ class DataStore(Model):
         :type timeout: int
         """
         queue_name = self.get_remote_queue_name('storage', "slow")
-        files = set(storage_tasks.list_files.apply_async(
-            args=[self.type, self.path], queue=queue_name).get(
-                timeout=timeout))
+        with measure_remote(storage_tasks.list_files.name, queue_name):
+            files = set(storage_tasks.list_files.apply_async(
+                args=[self.type, self.path], queue=queue_name).get(
+                    timeout=timeout))
         disks = Disk.objects.filter(destroyed__isnull=True, is_ready=True,
                                     datastore=self)
         return disks.exclude(filename__in=files)
@@ -196,9 +202,11 @@ class DataStore(Model):
     @method_cache(120)
     def get_file_statistics(self, timeout=30):
         queue_name = self.get_remote_queue_name('storage', "slow")
-        data = storage_tasks.get_file_statistics.apply_async(
-            args=[self.type, self.path], queue=queue_name).get(timeout=timeout)
-        return data
+        with measure_remote(storage_tasks.get_file_statistics.name,
+                            queue_name):
+            return storage_tasks.get_file_statistics.apply_async(
+                args=[self.type, self.path],
+                queue=queue_name).get(timeout=timeout)
 
 
 class Disk(TimeStampedModel):
@@ -403,10 +411,8 @@ class Disk(TimeStampedModel):
         except ObjectDoesNotExist:
             return None
 
-    def get_exclusive(self):
-        """Get an instance of the disk for exclusive usage.
-
-        This method manipulates the database only.
+    def get_exclusive_type(self):
+        """Return the type of the disks for exclusive usage of the disk.
         """
         type_mapping = {
             'qcow2-norm': 'qcow2-snap',
@@ -418,11 +424,34 @@ class Disk(TimeStampedModel):
         if self.type not in type_mapping.keys():
             raise self.WrongDiskTypeError(self)
 
-        new_type = type_mapping[self.type]
+        return type_mapping[self.type]
 
+    def get_exclusive(self):
+        """Get an instance of the disk for exclusive usage.
+
+        This method manipulates the database only.
+        """
         return Disk.create(base=self, datastore=self.datastore,
                            name=self.name, size=self.size,
-                           type=new_type, dev_num=self.dev_num)
+                           type=self.get_exclusive_type(),
+                           dev_num=self.dev_num)
+
+    def mass_get_exclusive(self, amount):
+        """Get amount instances of the disk for exclusive usage, inserted
+        in bulk.
+
+        This method manipulates the database only.
+        """
+        new_type = self.get_exclusive_type()
+        disks = [Disk(base=self, datastore=self.datastore, name=self.name,
+                      size=self.size, type=new_type, dev_num=self.dev_num,
+                      filename=str(uuid.uuid4()))
+                 for i in xrange(amount)]
+        for disk in disks:
+            disk.clean()
+        bulk_insert(Disk, disks)
+        logger.debug(u"%d disks created from: %s", amount, unicode(self))
+        return disks
 
     def get_disk_desc(self):
         """Serialize disk object to the storage driver.
@@ -520,22 +549,82 @@ class Disk(TimeStampedModel):
 
         if self.is_ready:
             return True
+        self._send_deploy_task().get(timeout=timeout)
+
+        self.is_ready = True
+        self.save()
+        return True
+
+    def _send_deploy_task(self):
         if self.base and not self.base.is_ready:
             raise self.DiskBaseIsNotReady(self, base=self.base)
         queue_name = self.get_remote_queue_name('storage', priority="fast")
         disk_desc = self.get_disk_desc()
         if self.base is not None:
-            storage_tasks.snapshot.apply_async(args=[disk_desc],
-                                               queue=queue_name
-                                               ).get(timeout=timeout)
+            return storage_tasks.snapshot.apply_async(args=[disk_desc],
+                                                      queue=queue_name)
         else:
-            storage_tasks.create.apply_async(args=[disk_desc],
-                                             queue=queue_name
-                                             ).get(timeout=timeout)
+            return storage_tasks.create.apply_async(args=[disk_desc],
+                                                    queue=queue_name)
 
-        self.is_ready = True
-        self.save()
-        return True
+    @classmethod
+    def mass_deploy(cls, disks, concurrency=8, timeout=15):
+        """Reify the disk models, deploying up to concurrency disks of each
+        data store at the same time.
+
+        :return: The exceptions of the failed disks by disk pk.
+        :rtype: dict
+        """
+        pending = cls._get_pending_by_datastore(disks)
+        errors = {}
+        running = deque()
+        in_flight = defaultdict(int)
+        while pending or running:
+            cls._send_deploy_tasks(pending, running, in_flight, concurrency,
+                                   errors)
+            if not running:
+                continue
+            disk, result = running.popleft()
+            in_flight[disk.datastore_id] -= 1
+            try:
+                result.get(timeout=timeout)
+            except Exception as e:
+                logger.warning("Deploying disk %s failed: %s", disk, e)
+                errors[disk.pk] = e
+            else:
+                disk.is_ready = True
+                disk.save()
+        return errors
+
+    @staticmethod
+    def _get_pending_by_datastore(disks):
+        """Return the disks to be deployed in a queue by data store pk.
+        """
+        pending = OrderedDict()
+        for disk in disks:
+            if disk.destroyed:
+                disk.destroyed = None
+                disk.save()
+            if not disk.is_ready:
+                pending.setdefault(disk.datastore_id, deque()).append(disk)
+        return pending
+
+    @staticmethod
+    def _send_deploy_tasks(pending, running, in_flight, concurrency, errors):
+        """Send the deploy task of the pending disks until concurrency
+        disks of each data store are in flight.
+        """
+        for datastore, queue in pending.items():
+            while queue and in_flight[datastore] < concurrency:
+                disk = queue.popleft()
+                try:
+                    running.append((disk, disk._send_deploy_task()))
+                except Exception as e:
+                    errors[disk.pk] = e
+                else:
+                    in_flight[datastore] += 1
+            if not queue:
+                del pending[datastore]
 
     @staticmethod
     def get_type_for_datastore(datastore):
@@ -583,19 +672,20 @@ class Disk(TimeStampedModel):
         params.setdefault('datastore', datastore)
         disk = cls.__create(params=params, user=user)
         queue_name = disk.get_remote_queue_name('storage', priority='slow')
-        remote = storage_tasks.download.apply_async(
-            kwargs={'url': url, 'parent_id': task.request.id,
-                    'disk': disk.get_disk_desc()},
-            queue=queue_name)
-        while True:
-            try:
-                result = remote.get(timeout=5)
-                break
-            except TimeoutError as e:
-                if task is not None and task.is_aborted():
-                    AbortableAsyncResult(remote.id).abort()
-                    raise humanize_exception(ugettext_noop(
-                        "Operation aborted by user."), e)
+        with measure_remote(storage_tasks.download.name, queue_name):
+            remote = storage_tasks.download.apply_async(
+                kwargs={'url': url, 'parent_id': task.request.id,
+                        'disk': disk.get_disk_desc()},
+                queue=queue_name)
+            while True:
+                try:
+                    result = remote.get(timeout=5)
+                    break
+                except TimeoutError as e:
+                    if task is not None and task.is_aborted():
+                        AbortableAsyncResult(remote.id).abort()
+                        raise humanize_exception(ugettext_noop(
+                            "Operation aborted by user."), e)
         disk.size = result['size']
         disk.type = result['type']
         disk.checksum = result.get('checksum', None)
@@ -616,11 +706,12 @@ class Disk(TimeStampedModel):
         """
         queue_name = self.datastore.get_remote_queue_name(
             'storage', priority='slow')
-        res = storage_tasks.exists.apply_async(
-            args=[self.datastore.type,
-                  self.datastore.path,
-                  self.filename],
-            queue=queue_name).get(timeout=timeout)
+        with measure_remote(storage_tasks.exists.name, queue_name):
+            res = storage_tasks.exists.apply_async(
+                args=[self.datastore.type,
+                      self.datastore.path,
+                      self.filename],
+                queue=queue_name).get(timeout=timeout)
         if res:
             logger.info("Image: %s at Datastore: %s recovered." %
                         (self.filename, self.datastore.path))
@@ -666,25 +757,26 @@ class Disk(TimeStampedModel):
                            type=new_type, dev_num=self.dev_num)
 
         queue_name = self.get_remote_queue_name("storage", priority="slow")
-        remote = storage_tasks.merge.apply_async(kwargs={
-            "old_json": self.get_disk_desc(),
-            "new_json": disk.get_disk_desc(),
-            "parent_id": task.request.id},
-            queue=queue_name
-        )  # Timeout
-        while True:
-            try:
-                remote.get(timeout=5)
-                break
-            except TimeoutError as e:
-                if task is not None and task.is_aborted():
-                    AbortableAsyncResult(remote.id).abort()
+        with measure_remote(storage_tasks.merge.name, queue_name):
+            remote = storage_tasks.merge.apply_async(kwargs={
+                "old_json": self.get_disk_desc(),
+                "new_json": disk.get_disk_desc(),
+                "parent_id": task.request.id},
+                queue=queue_name
+            )  # Timeout
+            while True:
+                try:
+                    remote.get(timeout=5)
+                    break
+                except TimeoutError as e:
+                    if task is not None and task.is_aborted():
+                        AbortableAsyncResult(remote.id).abort()
+                        disk.destroy()
+                        raise humanize_exception(ugettext_noop(
+                            "Operation aborted by user."), e)
+                except:
                     disk.destroy()
-                    raise humanize_exception(ugettext_noop(
-                        "Operation aborted by user."), e)
-            except:
-                disk.destroy()
-                raise
+                    raise
         disk.is_ready = True
         disk.save()
         return disk
@@ -16,6 +16,7 @@
 # with CIRCLE.  If not, see <http://www.gnu.org/licenses/>.
 
 from manager.mancelery import celery
+from manager.presence import is_queue_alive
 from celery.contrib.abortable import AbortableTask
 
 
@@ -27,6 +28,9 @@ def check_queue(storage, queue_id, priority):
     queue_name = storage + "." + queue_id
     if priority is not None:
         queue_name = queue_name + "." + priority
+    alive = is_queue_alive(queue_name)
+    if alive is not None:
+        return alive
     inspect = celery.control.inspect()
     inspect.timeout = 0.5
     active_queues = inspect.active_queues()
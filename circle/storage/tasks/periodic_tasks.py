@@ -17,6 +17,7 @@
 
 from storage.models import DataStore
 from manager.mancelery import celery
+from manager.latency import measure_remote
 import logging
 from storage.tasks import storage_tasks
 
@@ -35,8 +36,10 @@ def garbage_collector(timeout=15, percent=10):
     """
     for ds in DataStore.objects.all():
         queue_name = ds.get_remote_queue_name('storage', priority='fast')
-        files = set(storage_tasks.list_files.apply_async(
-            args=[ds.type, ds.path], queue=queue_name).get(timeout=timeout))
+        with measure_remote(storage_tasks.list_files.name, queue_name):
+            files = set(storage_tasks.list_files.apply_async(
+                args=[ds.type, ds.path],
+                queue=queue_name).get(timeout=timeout))
         disks = ds.get_deletable_disks()
         queue_name = ds.get_remote_queue_name('storage', priority='slow')
 
@@ -45,9 +48,11 @@ def garbage_collector(timeout=15, percent=10):
             logger.info("Image: %s at Datastore: %s fetch for destroy." %
                         (i, ds.path))
         try:
-            success = storage_tasks.make_free_space.apply_async(
-                args=[ds.type, ds.path, deletable_disks, percent],
-                queue=queue_name).get(timeout=timeout)
+            with measure_remote(storage_tasks.make_free_space.name,
+                                queue_name):
+                success = storage_tasks.make_free_space.apply_async(
+                    args=[ds.type, ds.path, deletable_disks, percent],
+                    queue=queue_name).get(timeout=timeout)
             if not success:
                 logger.warning("Has no deletable disk.")
         except Exception as e:
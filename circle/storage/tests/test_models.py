@@ -19,7 +19,7 @@ from datetime import timedelta
 
 from django.test import TestCase
 from django.utils import timezone
-from mock import MagicMock
+from mock import MagicMock, patch
 
 from ..models import Disk, DataStore
 
@@ -102,3 +102,28 @@ class DiskTestCase(TestCase):
     def test_undeployed_disk_ready(self):
         d = self._disk()
         assert not d.is_ready
+
+    def test_mass_deploy_limits_concurrency(self):
+        disks = [self._disk() for i in range(5)]
+        in_flight = []
+        peak = []
+
+        def send(disk):
+            in_flight.append(disk)
+            peak.append(len(in_flight))
+            result = MagicMock()
+
+            def get(timeout):
+                in_flight.remove(disk)
+                if disk == disks[3]:
+                    raise Exception('failed')
+            result.get.side_effect = get
+            return result
+
+        with patch.object(Disk, '_send_deploy_task', autospec=True,
+                          side_effect=send):
+            errors = Disk.mass_deploy(disks, concurrency=2)
+        self.assertEqual(2, max(peak))
+        self.assertEqual([disks[3].pk], errors.keys())
+        self.assertEqual([True, True, True, False, True],
+                         [Disk.objects.get(pk=d.pk).is_ready for d in disks])
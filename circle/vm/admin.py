@@ -17,9 +17,9 @@
 
 from django.contrib import admin
 
-from .models import (Instance, InstanceActivity, InstanceTemplate, Interface,
-                     InterfaceTemplate, Lease, NamedBaseResourceConfig, Node,
-                     NodeActivity, Trait)
+from .models import (Instance, InstanceActivity, InstanceBatchActivity,
+                     InstanceTemplate, Interface, InterfaceTemplate, Lease,
+                     NamedBaseResourceConfig, Node, NodeActivity, Trait)
 
 
 class InstanceActivityAdmin(admin.ModelAdmin):
@@ -28,6 +28,7 @@ class InstanceActivityAdmin(admin.ModelAdmin):
 
 admin.site.register(Instance)
 admin.site.register(InstanceActivity, InstanceActivityAdmin)
+admin.site.register(InstanceBatchActivity)
 admin.site.register(InstanceTemplate)
 admin.site.register(Interface)
 admin.site.register(InterfaceTemplate)
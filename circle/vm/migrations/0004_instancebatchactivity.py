@@ -0,0 +1,43 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+import jsonfield.fields
+import model_utils.fields
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('vm', '0003_auto_20160404_1525'),
+        ('vm', '0003_auto_20171105_2011'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='InstanceBatchActivity',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created', model_utils.fields.AutoCreatedField(default=django.utils.timezone.now, editable=False, verbose_name='created')),
+                ('modified', model_utils.fields.AutoLastModifiedField(default=django.utils.timezone.now, editable=False, verbose_name='modified')),
+                ('activity_code', models.CharField(max_length=100, verbose_name='activity code')),
+                ('readable_name_data', jsonfield.fields.JSONField(blank=True, help_text='Human readable name of activity.', null=True, verbose_name='human readable name')),
+                ('task_uuid', models.CharField(blank=True, help_text='Celery task unique identifier.', max_length=50, null=True, unique=True, verbose_name='task_uuid')),
+                ('started', models.DateTimeField(blank=True, help_text='Time of activity initiation.', null=True, verbose_name='started at')),
+                ('finished', models.DateTimeField(blank=True, help_text='Time of activity finalization.', null=True, verbose_name='finished at')),
+                ('succeeded', models.NullBooleanField(help_text='True, if the activity has finished successfully.')),
+                ('result_data', jsonfield.fields.JSONField(blank=True, help_text='Human readable result of activity.', null=True, verbose_name='result')),
+                ('instances', models.ManyToManyField(help_text='Instances this activity works on.', related_name='batch_activity_log', to='vm.Instance', verbose_name='instances')),
+                ('parent', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='children', to='vm.InstanceBatchActivity')),
+                ('user', models.ForeignKey(blank=True, help_text='The person who started this activity.', null=True, on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL, verbose_name='user')),
+            ],
+            options={
+                'ordering': ['-finished', '-started', '-id'],
+                'db_table': 'vm_instancebatchactivity',
+            },
+        ),
+    ]
@@ -1,5 +1,7 @@
 # flake8: noqa
 from .activity import InstanceActivity
+from .activity import InstanceBatchActivity
+from .activity import instance_batch_activity
 from .activity import NodeActivity
 from .activity import node_activity
 from .common import BaseResourceConfigModel
@@ -17,7 +19,8 @@ from .network import Interface
 from .node import Node
 
 __all__ = [
-    'InstanceActivity', 'BaseResourceConfigModel',
+    'InstanceActivity', 'InstanceBatchActivity', 'instance_batch_activity',
+    'BaseResourceConfigModel',
     'NamedBaseResourceConfig', 'VirtualMachineDescModel', 'InstanceTemplate',
     'Instance', 'post_state_changed', 'pre_state_changed', 'InterfaceTemplate',
     'Interface', 'Trait', 'Node', 'NodeActivity', 'Lease', 'node_activity',
@@ -23,7 +23,9 @@ from warnings import warn
 from celery.contrib.abortable import AbortableAsyncResult
 
 from django.core.urlresolvers import reverse
-from django.db.models import CharField, ForeignKey, BooleanField
+from django.db.models import (
+    CharField, ForeignKey, BooleanField, ManyToManyField
+)
 from django.utils import timezone
 from django.utils.translation import ugettext_lazy as _, ugettext_noop
 
@@ -253,6 +255,50 @@ class NodeActivity(ActivityModel):
         return activitycontextimpl(act)
 
 
+class InstanceBatchActivity(ActivityModel):
+    """Activity working on a batch of instances at once, e.g. deploying the
+    virtual machines of a course lab.
+    """
+    ACTIVITY_CODE_BASE = join_activity_code('vm', 'InstanceBatch')
+    instances = ManyToManyField('Instance', related_name='batch_activity_log',
+                                help_text=_('Instances this activity works '
+                                            'on.'),
+                                verbose_name=_('instances'))
+
+    class Meta:
+        app_label = 'vm'
+        db_table = 'vm_instancebatchactivity'
+        ordering = ['-finished', '-started', '-id']
+
+    @classmethod
+    def create(cls, code_suffix, instances, task_uuid=None, user=None,
+               readable_name=None):
+
+        readable_name = _normalize_readable_name(readable_name, code_suffix)
+        activity_code = cls.construct_activity_code(code_suffix)
+        act = cls(activity_code=activity_code, parent=None,
+                  readable_name_data=readable_name.to_dict(),
+                  started=timezone.now(), task_uuid=task_uuid, user=user)
+        act.save()
+        act.instances.add(*instances)
+        return act
+
+    def update_progress(self, result):
+        """Save the human readable progress of the unfinished activity as
+        its result.
+        """
+        self.result = result
+        self.save(update_fields=['result_data', 'modified'])
+
+
+@contextmanager
+def instance_batch_activity(code_suffix, instances, task_uuid=None,
+                            user=None, readable_name=None):
+    act = InstanceBatchActivity.create(code_suffix, instances, task_uuid,
+                                       user, readable_name=readable_name)
+    return activitycontextimpl(act)
+
+
 @contextmanager
 def node_activity(code_suffix, node, task_uuid=None, user=None,
                   readable_name=None):
@@ -272,6 +318,7 @@ def cleanup(conf=None, **kwargs):
         if op and op.async_queue == queue_name:
             i.finish(False, result=message)
             logger.error('Forced finishing stale activity %s', i)
-    for i in NodeActivity.objects.filter(finished__isnull=True):
-        i.finish(False, result=message)
-        logger.error('Forced finishing stale activity %s', i)
+    for model in (NodeActivity, InstanceBatchActivity):
+        for i in model.objects.filter(finished__isnull=True):
+            i.finish(False, result=message)
+            logger.error('Forced finishing stale activity %s', i)
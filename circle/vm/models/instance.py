@@ -19,6 +19,7 @@ from __future__ import absolute_import, unicode_literals
 from contextlib import contextmanager
 from datetime import timedelta
 from functools import partial
+from itertools import chain
 from importlib import import_module
 from logging import getLogger
 from warnings import warn
@@ -30,29 +31,38 @@ from django.core.exceptions import PermissionDenied
 from django.db.models import (BooleanField, CharField, DateTimeField,
                               IntegerField, ForeignKey, Manager,
                               ManyToManyField, permalink, SET_NULL, TextField)
-from django.db import IntegrityError
+from django.db import IntegrityError, transaction
+from django.db.models.signals import (
+    post_delete, post_init, post_save, pre_delete, pre_save
+)
 from django.dispatch import Signal
 from django.utils import timezone
 from django.utils.translation import ugettext_lazy as _, ugettext_noop
 from django.contrib.contenttypes.fields import GenericRelation
+from django.contrib.contenttypes.models import ContentType
 
 from model_utils import Choices
 from model_utils.managers import QueryManager
 from model_utils.models import TimeStampedModel, StatusModel
 from taggit.managers import TaggableManager
+from taggit.models import Tag, TaggedItem
 
 from acl.models import AclBase
 from common.models import (
-    activitycontextimpl, create_readable, HumanReadableException,
+    activitycontextimpl, bulk_insert, create_readable, HumanReadableException,
 )
 from common.operations import OperatedMixin
-from ..tasks import agent_tasks
-from .activity import (ActivityInProgressError, InstanceActivity)
+from firewall.allocation import allocate_port, update_port_indexes
+from firewall.models import deferred_reload
+from manager.scheduler import SchedulerError
+from ..tasks import agent_tasks, local_tasks
+from .activity import (ActivityInProgressError, InstanceActivity,
+                       instance_batch_activity)
 from .common import BaseResourceConfigModel, Lease
 from .network import Interface
-from .node import Node, Trait
+from .node import Node, Trait, update_allocation
 from network.models import EditorElement
-from storage.models import DataStore
+from storage.models import DataStore, Disk
 
 
 logger = getLogger(__name__)
@@ -83,9 +93,15 @@ def find_unused_port(port_range, used_ports=[]):
 
 
 def find_unused_vnc_port():
-    port = find_unused_port(
-        port_range=django.conf.settings.VNC_PORT_RANGE,
-        used_ports=Instance.objects.values_list('vnc_port', flat=True))
+    """Return a reserved, unused port for VNC.
+
+    The port is taken from the cached index of the VNC port range, which
+    marks the ports allocated and yielded in place.
+    """
+    port = allocate_port(
+        'vnc', [django.conf.settings.VNC_PORT_RANGE],
+        lambda: Instance.objects.filter(vnc_port__isnull=False).values_list(
+            'vnc_port', flat=True))
 
     if port is None:
         raise Exception("No unused port could be found for VNC.")
@@ -397,6 +413,80 @@ class Instance(AclBase, VirtualMachineDescModel, StatusModel, OperatedMixin,
 
             return inst
 
+    @classmethod
+    def mass_create(cls, params_list, disks, networks, req_traits, tags):
+        """Create new Instance objects with the same owner in bulk.
+
+        Does the same as calling create with each of the parameters, but
+        related objects are inserted with a few queries for all instances,
+        and a single firewall reload is requested.
+        """
+        owner = params_list[0]['owner']
+        assert all(params['owner'] == owner for params in params_list)
+
+        # permission check
+        for network in networks:
+            if not network.vlan.has_level(owner, 'user'):
+                raise PermissionDenied()
+
+        insts = [cls(**params) for params in params_list]
+        for inst in insts:
+            inst.full_clean()
+
+        with transaction.atomic(), deferred_reload():
+            bulk_insert(cls, insts)
+            # the receivers of post_save are called explicitly
+            for inst in insts:
+                update_node_allocations(cls, inst, created=True)
+            cls.mass_set_level(insts, owner, 'owner')
+
+            readable_name = create_readable(ugettext_noop("create instance"))
+            acts = bulk_insert(InstanceActivity, [InstanceActivity(
+                activity_code=InstanceActivity.construct_activity_code(
+                    'create'),
+                instance=inst, started=timezone.now(), user=owner,
+                readable_name_data=readable_name.to_dict())
+                for inst in insts])
+
+            # create related entities
+            through = cls.disks.through
+            through.objects.bulk_create(
+                through(instance_id=inst.pk, disk_id=disk.pk)
+                for base in disks
+                for inst, disk in zip(insts,
+                                      base.mass_get_exclusive(len(insts))))
+
+            for net in networks:
+                Interface.mass_create(insts, vlan=net.vlan, owner=owner,
+                                      managed=net.managed,
+                                      base_activities=acts)
+
+            through = cls.req_traits.through
+            through.objects.bulk_create(
+                through(instance_id=inst.pk, trait_id=trait.pk)
+                for inst in insts for trait in req_traits)
+
+            tags = [tag if isinstance(tag, Tag)
+                    else Tag.objects.get_or_create(name=tag)[0]
+                    for tag in tags]
+            ct = ContentType.objects.get_for_model(cls)
+            TaggedItem.objects.bulk_create(
+                TaggedItem(content_type=ct, object_id=inst.pk, tag=tag)
+                for inst in insts for tag in tags)
+
+            now = timezone.now()
+            InstanceActivity.objects.filter(
+                pk__in=[act.pk for act in acts]).update(
+                finished=now, succeeded=True, resultant_state='PENDING')
+            # what _update_status does on finishing each activity
+            cls.objects.filter(pk__in=[inst.pk for inst in insts]).update(
+                status='PENDING', status_changed=now)
+            for inst in insts:
+                inst.status = 'PENDING'
+                inst.status_changed = now
+
+        return insts
+
     @classmethod
     def create_from_template(cls, template, owner, disks=None, networks=None,
                              req_traits=None, tags=None, **kwargs):
@@ -441,9 +531,12 @@ class Instance(AclBase, VirtualMachineDescModel, StatusModel, OperatedMixin,
         if amount > 1 and '%d' not in params['name']:
             params['name'] += ' %d'
 
-        customized_params = (dict(params,
+        customized_params = [dict(params,
                                   name=params['name'].replace('%d', str(i)))
-                             for i in xrange(amount))
+                             for i in xrange(amount)]
+        if amount > 1:
+            return cls.mass_create(customized_params, disks, networks,
+                                   req_traits, tags)
         return [cls.create(cps, disks, networks, req_traits, tags)
                 for cps in customized_params]
 
@@ -748,6 +841,145 @@ class Instance(AclBase, VirtualMachineDescModel, StatusModel, OperatedMixin,
         """
         return scheduler.select_node(self, Node.objects.all())
 
+    @classmethod
+    def select_nodes(cls, instances):
+        """Returns the nodes the VMs should be deployed to, placing them as
+        a batch.
+        """
+        nodes = Node.objects.all()
+        if hasattr(scheduler, 'select_nodes'):
+            return scheduler.select_nodes(instances, nodes)
+        return [scheduler.select_node(instance, nodes)
+                for instance in instances]
+
+    @classmethod
+    def mass_deploy(cls, instances, user):
+        """Deploy the instances as a batch in the background.
+        """
+        local_tasks.mass_deploy.apply_async(
+            args=[[instance.pk for instance in instances], user.pk],
+            queue='localhost.man')
+
+    @classmethod
+    def _mass_deploy(cls, instances, user):
+        """Place the instances at once, deploy the disks of all of them
+        concurrently, then start the deploy operation of each instance.
+
+        Instances the deploy operation is not available for are skipped.
+        The progress of the batch is shown by an InstanceBatchActivity, and
+        the owner is notified about its outcome.
+        """
+        instances = cls._get_deployable(instances, user)
+        if not instances:
+            return
+        count = len(instances)
+        with instance_batch_activity(
+                'mass_deploy', instances, user=user,
+                readable_name=create_readable(
+                    ugettext_noop("deploy %(count)d virtual machines"),
+                    count=count)) as batch:
+            nodes = cls._select_batch_nodes(instances)
+            acts = cls._create_disk_activities(instances, user)
+            disks = {instance: list(instance.disks.all())
+                     for instance in acts}
+            errors = Disk.mass_deploy(chain(*disks.values()))
+            ready = cls._finish_disk_activities(acts, disks, errors)
+            batch.update_progress(create_readable(
+                ugettext_noop("Disks of %(ready)d of %(count)d virtual "
+                              "machines have been deployed."),
+                ready=ready, count=count))
+            started = cls._start_deploys(instances, nodes, user)
+            batch.result = create_readable(
+                ugettext_noop('Disks of %(ready)d of %(count)d virtual '
+                              'machines have been deployed, %(started)d of '
+                              'them are starting.'),
+                count=count, started=started, ready=ready)
+
+        try:
+            user.profile.notify(
+                ugettext_noop('%(count)d virtual machines deploying'),
+                ugettext_noop('Disks of %(ready)d of %(count)d virtual '
+                              'machines have been deployed, %(started)d of '
+                              'them are starting.'),
+                count=count, started=started, ready=ready)
+        except Exception as e:
+            logger.debug('Could not notify %s about deploying instances. %s',
+                         user, unicode(e))
+
+    @classmethod
+    def _get_deployable(cls, instances, user):
+        """Return the instances the deploy operation is available for.
+        """
+        deployable = []
+        for instance in instances:
+            error = instance.deploy.get_availability(user)
+            if error is None:
+                deployable.append(instance)
+            else:
+                logger.warning("Instance %s can not be deployed: %s",
+                               instance, error)
+        return deployable
+
+    @classmethod
+    def _select_batch_nodes(cls, instances):
+        try:
+            return cls.select_nodes(instances)
+        except SchedulerError as e:
+            # the deploy operations will report it one by one
+            logger.warning("Placing %d instances failed: %s",
+                           len(instances), e)
+            return [None] * len(instances)
+
+    @classmethod
+    def _create_disk_activities(cls, instances, user):
+        """Return the deploying_disks activity of each instance by instance.
+
+        Instances with an activity in progress are left out.
+        """
+        acts = {}
+        for instance in instances:
+            try:
+                acts[instance] = InstanceActivity.create(
+                    code_suffix='deploying_disks', instance=instance,
+                    user=user, readable_name=create_readable(
+                        ugettext_noop("deploy disks")))
+            except ActivityInProgressError:
+                pass  # the disks are deployed by the deploy operation
+        return acts
+
+    @classmethod
+    def _finish_disk_activities(cls, acts, disks, errors):
+        """Finish the deploying_disks activities with the errors returned
+        by Disk.mass_deploy, and return the number of succeeded ones.
+        """
+        ready = 0
+        for instance, act in acts.items():
+            failed = [disk for disk in disks[instance] if disk.pk in errors]
+            if failed:
+                act.finish(False, result=create_readable(
+                    ugettext_noop("Failed to deploy %(count)d disks."),
+                    count=len(failed)))
+            else:
+                act.finish(True)
+                ready += 1
+        return ready
+
+    @classmethod
+    def _start_deploys(cls, instances, nodes, user):
+        """Start the deploy operation of each instance on its node, and
+        return the number of started ones.
+        """
+        started = 0
+        for instance, node in zip(instances, nodes):
+            try:
+                instance.deploy.async(user=user, node=node)
+            except Exception as e:
+                logger.warning("Deploying instance %s failed: %s",
+                               instance, e)
+            else:
+                started += 1
+        return started
+
     def destroy_disks(self):
         """Destroy all associated disks.
         """
@@ -798,8 +1030,10 @@ class Instance(AclBase, VirtualMachineDescModel, StatusModel, OperatedMixin,
 
     def yield_vnc_port(self):
         if self.vnc_port is not None:
+            port = self.vnc_port
             self.vnc_port = None
             self.save()
+            update_port_indexes(removed=[('vnc', port)])
 
     def get_status_icon(self):
         return {
@@ -895,3 +1129,59 @@ class Instance(AclBase, VirtualMachineDescModel, StatusModel, OperatedMixin,
         datastore = max(freqs.items(), key=lambda x: x[1])
 
         return datastore[0]
+
+
+def get_allocation(instance):
+    """Return the node, memory and processor cores of the instance, or None
+    if some of them are not loaded.
+    """
+    fields = ('node_id', 'ram_size', 'num_cores')
+    if not all(name in instance.__dict__ for name in fields):
+        return None
+    return tuple(instance.__dict__[name] for name in fields)
+
+
+def track_allocation(sender, instance, **kwargs):
+    instance._allocation = get_allocation(instance)
+
+
+def query_allocation(instance):
+    return tuple(Instance.objects.filter(pk=instance.pk).values_list(
+        'node', 'ram_size', 'num_cores').first() or (None, 0, 0))
+
+
+def load_old_allocation(sender, instance, raw=False, **kwargs):
+    """Query the allocation the instance has been loaded with, if it has
+    been loaded with deferred fields.
+    """
+    if (not raw and instance.pk is not None and
+            getattr(instance, '_allocation', None) is None):
+        instance._allocation = query_allocation(instance)
+
+
+def update_node_allocations(sender, instance, created=False, raw=False,
+                            **kwargs):
+    """Move the memory and processor cores of the instance in the ledger of
+    node allocations, if its node or resources have changed.
+    """
+    if raw:
+        return
+    old = None if created else getattr(instance, '_allocation', None)
+    if kwargs.get('signal') is post_delete:
+        new = None
+    else:
+        new = get_allocation(instance) or query_allocation(instance)
+    if old == new:
+        return
+    if old is not None and old[0] is not None:
+        update_allocation(old[0], -old[1], -old[2])
+    if new is not None and new[0] is not None:
+        update_allocation(new[0], new[1], new[2])
+    instance._allocation = new
+
+
+post_init.connect(track_allocation, sender=Instance)
+pre_save.connect(load_old_allocation, sender=Instance)
+pre_delete.connect(load_old_allocation, sender=Instance)
+post_save.connect(update_node_allocations, sender=Instance)
+post_delete.connect(update_node_allocations, sender=Instance)
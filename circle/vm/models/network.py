@@ -21,10 +21,12 @@ from logging import getLogger
 from netaddr import EUI, mac_unix
 
 from django.db.models import Model, ForeignKey, BooleanField, CharField
+from django.utils import timezone
 from django.utils.translation import ugettext_lazy as _, ugettext_noop
 
-from common.models import create_readable
+from common.models import create_readable, join_activity_code
 from firewall.models import Vlan, Host
+from manager.latency import measure_remote
 from network.models import Vxlan
 from ..tasks import net_tasks
 
@@ -193,15 +195,80 @@ class Interface(Model):
         iface.save()
         return iface
 
+    @classmethod
+    def mass_create(cls, instances, vlan, managed, owner=None,
+                    base_activities=None):
+        """Create a new interface for each of the VM instances to the
+        specified VLAN, allocating addresses and saving hosts in bulk.
+
+        :param base_activities: optional list of the creating activity of
+                                each instance
+        """
+        hosts = [None] * len(instances)
+        if managed:
+            addresses = vlan.get_new_addresses(len(instances))
+            for i, (instance, address) in enumerate(zip(instances,
+                                                        addresses)):
+                host = Host(vlan=vlan, owner=owner,
+                            mac=str(cls.generate_mac(instance, vlan.vid,
+                                                     False)),
+                            hostname=instance.vm_name,
+                            ipv4=address['ipv4'], ipv6=address['ipv6'])
+                if vlan.network_type == 'public':
+                    host.shared_ip = False
+                    host.external_ipv4 = None
+                elif vlan.network_type == 'portforward':
+                    host.shared_ip = True
+                    host.external_ipv4 = vlan.snat_ip
+                hosts[i] = host
+            from .instance import ACCESS_PROTOCOLS
+            ports = set(tuple(ACCESS_PROTOCOLS[instance.access_method][1:3])
+                        for instance in instances)
+            Host.mass_create(hosts, ports=[(proto, port)
+                                           for port, proto in ports])
+            if base_activities is not None:
+                cls._log_allocations(base_activities, hosts, vlan)
+
+        ifaces = [cls(vlan=vlan, host=hosts[i], instance=instance)
+                  for i, instance in enumerate(instances)]
+        cls.objects.bulk_create(ifaces)
+        return ifaces
+
+    @staticmethod
+    def _log_allocations(base_activities, hosts, vlan):
+        from .activity import InstanceActivity
+
+        now = timezone.now()
+        acts = []
+        for parent, host in zip(base_activities, hosts):
+            act = InstanceActivity(
+                activity_code=join_activity_code(parent.activity_code,
+                                                 'allocating_ip'),
+                instance=parent.instance, parent=parent, user=parent.user,
+                readable_name_data=create_readable(
+                    ugettext_noop("allocate IP address")).to_dict(),
+                started=now, finished=now, succeeded=True)
+            act.result = create_readable(
+                ugettext_noop("Interface successfully created."),
+                ugettext_noop("Interface successfully created. "
+                              "New addresses: ipv4: %(ip4)s, "
+                              "ipv6: %(ip6)s, vlan: %(vlan)s."),
+                ip4=unicode(host.ipv4), ip6=unicode(host.ipv6),
+                vlan=vlan.name)
+            acts.append(act)
+        InstanceActivity.objects.bulk_create(acts)
+
     def deploy(self):
         queue_name = self.instance.get_remote_queue_name('net', 'fast')
-        return net_tasks.create.apply_async(args=[self.get_vmnetwork_desc()],
-                                            queue=queue_name).get()
+        with measure_remote(net_tasks.create.name, queue_name):
+            return net_tasks.create.apply_async(
+                args=[self.get_vmnetwork_desc()], queue=queue_name).get()
 
     def shutdown(self):
         queue_name = self.instance.get_remote_queue_name('net', 'fast')
-        return net_tasks.destroy.apply_async(args=[self.get_vmnetwork_desc()],
-                                             queue=queue_name).get()
+        with measure_remote(net_tasks.destroy.name, queue_name):
+            return net_tasks.destroy.apply_async(
+                args=[self.get_vmnetwork_desc()], queue=queue_name).get()
 
     def destroy(self):
         if self.host is not None:
@@ -21,17 +21,18 @@ from glob import glob
 from logging import getLogger
 import os.path
 from warnings import warn
-import requests
 from salt.client import LocalClient
 from salt.exceptions import SaltClientError
 import salt.utils
 from time import time, sleep
 
-from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
 from django.db.models import (
     CharField, IntegerField, ForeignKey, BooleanField, ManyToManyField,
     FloatField, permalink, Sum
 )
+from django.db.models.signals import m2m_changed, post_delete
 from django.utils import timezone
 from django.utils.translation import ugettext_lazy as _
 
@@ -39,9 +40,14 @@ from celery.exceptions import TimeoutError
 from model_utils.models import TimeStampedModel
 from taggit.managers import TaggableManager
 
-from common.models import method_cache, WorkerNotFound, HumanSortField
+from common.models import (
+    get_tokens, method_cache, touch_tokens_on_commit, WorkerNotFound,
+    HumanSortField
+)
 from common.operations import OperatedMixin
+from monitor.metrics import get_metrics
 from firewall.models import Host
+from manager.latency import measure_remote, recorder, REMOTE
 from ..tasks import vm_tasks
 from .activity import NodeActivity
 from .common import Trait
@@ -194,8 +200,15 @@ class Node(OperatedMixin, TimeStampedModel):
 
     @property
     def allocated_ram(self):
-        return (self.instance_set.aggregate(
-            r=Sum('ram_size'))['r'] or 0) * 1024 * 1024
+        """Bytes of memory allocated to the instances of the node.
+        """
+        return get_allocations([self.pk])[self.pk][0] * 1024 * 1024
+
+    @property
+    def allocated_cores(self):
+        """Number of processor cores allocated to the instances of the node.
+        """
+        return get_allocations([self.pk])[self.pk][1]
 
     @property
     def ram_size(self):
@@ -311,10 +324,10 @@ class Node(OperatedMixin, TimeStampedModel):
         TimeoutError or WorkerNotFound exception.
         """
         try:
-            r = task.apply_async(
-                queue=self.get_remote_queue_name('vm', priority),
-                expires=timeout + 60)
-            return r.get(timeout=timeout)
+            queue = self.get_remote_queue_name('vm', priority)
+            with measure_remote(task.name, queue):
+                r = task.apply_async(queue=queue, expires=timeout + 60)
+                return r.get(timeout=timeout)
         except (TimeoutError, WorkerNotFound):
             if raise_:
                 raise
@@ -323,39 +336,30 @@ class Node(OperatedMixin, TimeStampedModel):
 
     @property
     @node_available
-    @method_cache(10)
     def monitor_info(self):
-        metrics = ('cpu.percent', 'memory.usage')
-        prefix = 'circle.%s.' % self.host.hostname
-        params = [('target', '%s%s' % (prefix, metric))
-                  for metric in metrics]
-        params.append(('from', '-5min'))
-        params.append(('format', 'json'))
-
+        """The latest metrics of the node, from the metrics of all nodes
+        fetched at once.
+        """
         try:
-            logger.info('%s %s', settings.GRAPHITE_URL, params)
-            response = requests.get(settings.GRAPHITE_URL, params=params)
-            retval = {}
-            for target in response.json():
-                # Example:
-                # {"target": "circle.szianode.cpu.usage",
-                #  "datapoints": [[0.6, 1403045700], [0.5, 1403045760]
-                try:
-                    metric = target['target']
-                    if metric.startswith(prefix):
-                        metric = metric[len(prefix):]
-                    else:
-                        continue
-                    value = target['datapoints'][-2][0]
-                    retval[metric] = float(value)
-                except (KeyError, IndexError, ValueError):
-                    continue
-
-            return retval
-        except:
+            return get_metrics().get(self.host.hostname)
+        except Exception:
             logger.exception('Unhandled exception: ')
-            return self.remote_query(vm_tasks.get_node_metrics, timeout=30,
-                                     priority="fast")
+            return self.get_remote_metrics()
+
+    @property
+    @node_available
+    def metrics_age(self):
+        """Seconds since the metrics of the node have been fetched.
+        """
+        try:
+            return get_metrics().age
+        except Exception:
+            return None
+
+    @method_cache(10)
+    def get_remote_metrics(self):
+        return self.remote_query(vm_tasks.get_node_metrics, timeout=30,
+                                 priority="fast", default={})
 
     @property
     @node_available
@@ -402,45 +406,126 @@ class Node(OperatedMixin, TimeStampedModel):
         Query state of all libvirt domains, and notify Instances by their
         vm_state_changed hook.
         """
-        domains = {}
-        domain_list = self.remote_query(vm_tasks.list_domains_info, timeout=5,
-                                        priority="fast")
-        if domain_list is None:
-            logger.info("Monitoring failed at: %s", self.name)
-            return
-        for i in domain_list:
-            # [{'name': 'cloud-1234', 'state': 'RUNNING', ...}, ...]
-            try:
-                id = int(i['name'].split('-')[1])
-            except:
-                pass  # name format doesn't match
-            else:
-                domains[id] = i['state']
+        self.apply_domain_states(self.query_domain_states([self]))
+
+    @classmethod
+    def update_all_vm_states(cls, nodes=None, timeout=5):
+        """Update state of Instances running on the available Nodes.
 
-        instances = [{'id': i.id, 'state': i.state}
-                     for i in self.instance_set.order_by('id').all()]
-        for i in instances:
+        The domains of the nodes are queried at the same time, so a slow
+        node does not delay the others.
+        """
+        if nodes is None:
+            nodes = cls.objects.filter(enabled=True).select_related('host')
+        nodes = [node for node in nodes if node.enabled and node.online]
+        cls.apply_domain_states(cls.query_domain_states(nodes, timeout))
+
+    @staticmethod
+    def query_domain_states(nodes, timeout=5):
+        """Query the state of the libvirt domains of the nodes.
+
+        The queries are sent to all nodes before waiting for the first
+        result, and all of them have to finish in timeout secs.  The round
+        trip of each node is recorded by manager.latency.
+
+        :return: The state of the domains by instance id, by node. Nodes
+                 failing to respond are missing.
+        :rtype: dict
+        """
+        task = vm_tasks.list_domains_info
+        sent = []
+        for node in nodes:
+            try:
+                queue = node.get_remote_queue_name('vm', 'fast')
+                sent.append((node, queue, time(), task.apply_async(
+                    queue=queue, expires=timeout + 60)))
+            except WorkerNotFound:
+                logger.info("Monitoring failed at: %s", node.name)
+
+        deadline = time() + timeout
+        result = {}
+        for node, queue, start, remote in sent:
             try:
-                d = domains[i['id']]
-            except KeyError:
+                domain_list = remote.get(
+                    timeout=max(deadline - time(), 0.1))
+            except TimeoutError:
+                domain_list = None
+            except Exception:
+                logger.exception("Querying the domains of %s failed.",
+                                 node.name)
+                domain_list = None
+            recorder.record(REMOTE, task.name, queue, time() - start)
+            if domain_list is None:
+                logger.info("Monitoring failed at: %s", node.name)
+                continue
+            domains = result[node] = {}
+            for i in domain_list:
+                # [{'name': 'cloud-1234', 'state': 'RUNNING', ...}, ...]
+                try:
+                    id = int(i['name'].split('-')[1])
+                except:
+                    pass  # name format doesn't match
+                else:
+                    domains[id] = i['state']
+        return result
+
+    @staticmethod
+    def apply_domain_states(node_domains, batch_size=50):
+        """Notify the Instances whose state differs from their libvirt
+        domain by their vm_state_changed hook.
+
+        The Instances of the nodes are read with a single query, and the
+        changes are saved in transactions of batch_size Instances, each
+        Instance in its own savepoint, so a failing one is rolled back
+        alone.
+
+        :param node_domains: The state of the domains by instance id, by
+                             node, as returned by query_domain_states.
+        """
+        from .instance import Instance
+
+        reported = {}  # instance id: (node, state)
+        for node, domains in node_domains.iteritems():
+            for id, state in domains.iteritems():
+                reported[id] = (node, state)
+
+        changes = []  # (instance, new state, new node)
+        nodes = dict((node.pk, node) for node in node_domains)
+        for i in Instance.objects.filter(node__in=nodes.keys()):
+            i.node = nodes[i.node_id]
+            node, state = reported.pop(i.id, (None, None))
+            if node is None:
                 logger.info('Node %s update: instance %s missing from '
-                            'libvirt', self, i['id'])
+                            'libvirt', i.node, i.id)
                 # Set state to STOPPED when instance is missing
-                self.instance_set.get(id=i['id']).vm_state_changed(
-                    'STOPPED', None)
-            else:
-                if d != i['state']:
-                    logger.info('Node %s update: instance %s state changed '
-                                '(libvirt: %s, db: %s)',
-                                self, i['id'], d, i['state'])
-                    self.instance_set.get(id=i['id']).vm_state_changed(d)
-
-                del domains[i['id']]
-        for id, state in domains.iteritems():
-            from .instance import Instance
+                changes.append((i, 'STOPPED', None))
+            elif node != i.node:
+                logger.error('Node %s update: domain %s in libvirt but '
+                             'on node %s in db.', node, i.id, i.node)
+                changes.append((i, state, node))
+            elif state != i.status:
+                logger.info('Node %s update: instance %s state changed '
+                            '(libvirt: %s, db: %s)',
+                            node, i.id, state, i.status)
+                changes.append((i, state, False))
+
+        instances = Instance.objects.select_related('node').in_bulk(
+            reported.keys())
+        for id, (node, state) in reported.iteritems():
             logger.error('Node %s update: domain %s in libvirt but not in db.',
-                         self, id)
-            Instance.objects.get(id=id).vm_state_changed(state, self)
+                         node, id)
+            if id in instances:
+                changes.append((instances[id], state, node))
+
+        for start in xrange(0, len(changes), batch_size):
+            with transaction.atomic():
+                for instance, state, node in changes[start:start + batch_size]:
+                    try:
+                        with transaction.atomic():
+                            instance.vm_state_changed(state, node)
+                    except Exception:
+                        logger.exception('Updating the state of instance %s '
+                                         'failed.', instance.pk)
 
     @classmethod
     def get_state_count(cls, online, enabled):
@@ -467,3 +552,184 @@ class Node(OperatedMixin, TimeStampedModel):
         for node in nodes:
             if node.get_online():
                 node.refresh_credential.async(user=user, username=ceph_user)
+
+
+def allocation_keys(node):
+    return ('node_allocated_ram_%s' % node, 'node_allocated_cores_%s' % node)
+
+
+def query_allocations(nodes=None):
+    """Return the mebibytes of memory and the processor cores allocated on
+    each of the nodes, or all nodes if nodes is None, summed by the database.
+    """
+    from .instance import Instance
+    instances = Instance.objects.filter(node__isnull=False)
+    if nodes is not None:
+        nodes = list(nodes)
+        instances = instances.filter(node__in=nodes)
+    result = {pk: (0, 0) for pk in nodes or ()}
+    for pk, ram, cores in (instances.order_by().values_list('node')
+                           .annotate(Sum('ram_size'), Sum('num_cores'))):
+        result[pk] = (ram or 0, cores or 0)
+    return result
+
+
+def get_allocations(nodes):
+    """Return the mebibytes of memory and the processor cores allocated on
+    each of the nodes, as a dict of (ram_size, num_cores) tuples by node id.
+
+    The values are read from the ledger in the shared cache.  Nodes missing
+    from it are summed by the database with a single query, and stored.
+    """
+    nodes = [getattr(node, 'pk', node) for node in nodes]
+    keys = {node: allocation_keys(node) for node in nodes}
+    values = cache.get_many([key for pair in keys.values() for key in pair])
+    result = {}
+    missing = []
+    for node, (ram_key, cores_key) in keys.items():
+        if ram_key in values and cores_key in values:
+            result[node] = (values[ram_key], values[cores_key])
+        else:
+            missing.append(node)
+    if missing:
+        queried = query_allocations(missing)
+        store_allocations(queried)
+        result.update(queried)
+    return result
+
+
+def store_allocations(allocations):
+    values = {}
+    for node, (ram_size, num_cores) in allocations.items():
+        ram_key, cores_key = allocation_keys(node)
+        values[ram_key] = ram_size
+        values[cores_key] = num_cores
+    cache.set_many(values, None)
+
+
+def update_allocation(node, ram_size, num_cores):
+    """Add ram_size mebibytes and num_cores processor cores, which may be
+    negative, to the allocations of the node in the ledger.
+
+    Nodes missing from the ledger are left out, they are summed by the
+    database when they are read next time.
+    """
+    for key, delta in zip(allocation_keys(node), (ram_size, num_cores)):
+        if not delta:
+            continue
+        try:
+            cache.incr(key, delta)
+        except ValueError:
+            cache.delete_many(allocation_keys(node))
+            return
+
+
+def reconcile_allocations():
+    """Replace the ledger with the allocations summed by the database, and
+    return the nodes whose values have differed.
+
+    Changes bypassing Instance.save, like queryset updates or rolled back
+    transactions, are corrected this way.
+    """
+    allocations = query_allocations(Node.objects.values_list('pk',
+                                                             flat=True))
+    keys = [key for node in allocations for key in allocation_keys(node)]
+    cached = cache.get_many(keys)
+    differed = []
+    for node, (ram_size, num_cores) in allocations.items():
+        ram_key, cores_key = allocation_keys(node)
+        if (ram_key in cached and cores_key in cached and
+                (cached[ram_key], cached[cores_key]) !=
+                (ram_size, num_cores)):
+            logger.warning('Allocations of node %s differed: %s, %s '
+                           'instead of %s, %s.', node, cached[ram_key],
+                           cached[cores_key], ram_size, num_cores)
+            differed.append(node)
+    store_allocations(allocations)
+    return differed
+
+
+def trait_mask(traits):
+    """Return the bitmask of the traits, given as Trait objects or ids.
+
+    The bit of each trait is the one at the position of its id.
+    """
+    mask = 0
+    for trait in traits:
+        mask |= 1 << getattr(trait, 'pk', trait)
+    return mask
+
+
+def mask_traits(mask):
+    """Return the ids of the traits in the bitmask.
+    """
+    return [i for i in xrange(mask.bit_length()) if mask >> i & 1]
+
+
+class TraitIndex(object):
+    """The traits of all nodes as bitmasks.
+
+    Checking whether a node has all the required traits is a single and
+    operation of two integers instead of two queries.
+    """
+
+    def __init__(self, node_traits=()):
+        """:param node_traits: (node id, trait id) pairs
+        """
+        self.masks = {}
+        for node, trait in node_traits:
+            self.masks[node] = self.masks.get(node, 0) | 1 << trait
+
+    def get_mask(self, node):
+        return self.masks.get(getattr(node, 'pk', node), 0)
+
+    def has_traits(self, node, traits):
+        """True, if the node has all the traits, given as a bitmask.
+        """
+        return self.get_mask(node) & traits == traits
+
+    def missing_traits(self, node, traits):
+        """Return the bitmask of the traits the node does not have.
+        """
+        return traits & ~self.get_mask(node)
+
+    def filter_nodes(self, nodes, traits):
+        """Return the nodes having all the traits, given as a bitmask.
+        """
+        masks = self.masks
+        return [node for node in nodes
+                if masks.get(node.pk, 0) & traits == traits]
+
+
+# 'index': (token, index) of the last built trait index
+trait_index_cache = {}
+
+
+def touch_trait_index():
+    """Mark the trait index as changed when the transaction is committed.
+    """
+    touch_tokens_on_commit('node_traits', ['index'])
+
+
+def get_trait_index():
+    """Return the trait index of the nodes, built again only if the traits
+    of a node have changed since the last call.
+    """
+    token = get_tokens('node_traits', ['index'])['index']
+    cached = trait_index_cache.get('index')
+    if None in token or cached is None or cached[0] != token:
+        pairs = Node.traits.through.objects.values_list('node_id',
+                                                        'trait_id')
+        cached = (token, TraitIndex(pairs))
+        trait_index_cache['index'] = cached
+    return cached[1]
+
+
+def touch_node_traits(sender, action=None, **kwargs):
+    if action is None or action.startswith('post_'):
+        touch_trait_index()
+
+
+m2m_changed.connect(touch_node_traits, sender=Node.traits.through)
+post_delete.connect(touch_node_traits, sender=Node)
+post_delete.connect(touch_node_traits, sender=Trait)
@@ -55,6 +55,7 @@ from .tasks import agent_tasks, vm_tasks
 
 from dashboard.store_api import Store, NoStoreException
 from firewall.models import Host
+from manager.latency import measure_remote
 from monitor.client import Client
 from storage.tasks import storage_tasks
 
@@ -67,9 +68,10 @@ class RemoteOperationMixin(object):
 
     def _operation(self, **kwargs):
         args = self._get_remote_args(**kwargs)
-        return self.task.apply_async(
-            args=args, queue=self._get_remote_queue()
-        ).get(timeout=self.remote_timeout)
+        queue = self._get_remote_queue()
+        with measure_remote(self.task.name, queue):
+            return self.task.apply_async(
+                args=args, queue=queue).get(timeout=self.remote_timeout)
 
     def check_precond(self):
         super(RemoteOperationMixin, self).check_precond()
@@ -81,17 +83,18 @@ class AbortableRemoteOperationMixin(object):
 
     def _operation(self, task, **kwargs):
         args = self._get_remote_args(**kwargs),
-        remote = self.task.apply_async(
-            args=args, queue=self._get_remote_queue())
-        for i in xrange(0, self.remote_timeout, self.remote_step):
-            try:
-                return remote.get(timeout=self.remote_step)
-            except TimeoutError as e:
-                if task is not None and task.is_aborted():
-                    AbortableAsyncResult(remote.id).abort()
-                    raise humanize_exception(ugettext_noop(
-                        "Operation aborted by user."), e)
-        raise TimeLimitExceeded()
+        queue = self._get_remote_queue()
+        with measure_remote(self.task.name, queue):
+            remote = self.task.apply_async(args=args, queue=queue)
+            for i in xrange(0, self.remote_timeout, self.remote_step):
+                try:
+                    return remote.get(timeout=self.remote_step)
+                except TimeoutError as e:
+                    if task is not None and task.is_aborted():
+                        AbortableAsyncResult(remote.id).abort()
+                        raise humanize_exception(ugettext_noop(
+                            "Operation aborted by user."), e)
+            raise TimeLimitExceeded()
 
 
 class InstanceOperation(Operation):
@@ -102,6 +105,8 @@ class InstanceOperation(Operation):
     accept_states = None
     deny_states = None
     resultant_state = None
+    # methods determining the availability, see get_availability_key
+    availability_methods = ('check_auth', 'check_precond')
 
     def __init__(self, instance):
         super(InstanceOperation, self).__init__(subject=instance)
@@ -137,6 +142,25 @@ class InstanceOperation(Operation):
                 not user.is_superuser):
             raise self.instance.WrongStateError(self.instance)
 
+    def get_availability_key(self, user):
+        """Return the state of the instance, the level of the user on it and
+        the state of its node.
+
+        Classes overriding any of the availability_methods have to extend
+        the key too, otherwise the result is not shared.
+        """
+        for cls in self.__class__.__mro__:
+            if 'get_availability_key' in vars(cls):
+                break
+            if any(name in vars(cls) for name in self.availability_methods):
+                return None
+        instance = self.instance
+        weight = instance.get_user_weights([instance], user).get(instance.pk)
+        node_offline = (not user.is_superuser and instance.node is not None
+                        and not instance.node.online)
+        return (instance.status, bool(instance.destroyed_at), weight,
+                node_offline)
+
     def create_activity(self, parent, user, kwargs):
         name = self.get_activity_name(kwargs)
         if parent:
@@ -169,6 +193,12 @@ class InstanceOperation(Operation):
 class RemoteInstanceOperation(RemoteOperationMixin, InstanceOperation):
 
     remote_queue = ('vm', 'fast')
+    availability_methods = InstanceOperation.availability_methods + (
+        '_get_remote_queue', )
+
+    def get_availability_key(self, user):
+        key = super(RemoteInstanceOperation, self).get_availability_key(user)
+        return key and key + (self.instance.node_id, self.remote_queue)
 
     def _get_remote_queue(self):
         return self.instance.get_remote_queue_name(*self.remote_queue)
@@ -1763,10 +1793,11 @@ class UpdateAgentOperation(RemoteAgentOperation):
         else:
             # Legacy update method
             executable = ""
-            return agent_tasks.update_legacy.apply_async(
-                queue=queue,
-                args=(instance.vm_name, self.create_linux_tar())
-            ).get(timeout=60)
+            with measure_remote(agent_tasks.update_legacy.name, queue):
+                return agent_tasks.update_legacy.apply_async(
+                    queue=queue,
+                    args=(instance.vm_name, self.create_linux_tar())
+                ).get(timeout=60)
 
         checksum = md5(data).hexdigest()
         chunk_size = 1024 * 1024
@@ -1776,17 +1807,20 @@ class UpdateAgentOperation(RemoteAgentOperation):
         while True:
             chunk = data[index:index+chunk_size]
             if chunk:
-                agent_tasks.append.apply_async(
-                    queue=queue,
-                    args=(instance.vm_name, chunk,
-                          filename, chunk_number)).get(timeout=60)
+                with measure_remote(agent_tasks.append.name, queue):
+                    agent_tasks.append.apply_async(
+                        queue=queue,
+                        args=(instance.vm_name, chunk,
+                              filename, chunk_number)).get(timeout=60)
                 index = index + chunk_size
                 chunk_number = chunk_number + 1
             else:
-                agent_tasks.update.apply_async(
-                    queue=queue,
-                    args=(instance.vm_name, filename, executable, checksum)
-                ).get(timeout=60)
+                with measure_remote(agent_tasks.update.name, queue):
+                    agent_tasks.update.apply_async(
+                        queue=queue,
+                        args=(instance.vm_name, filename, executable,
+                              checksum)
+                    ).get(timeout=60)
                 break
 
 
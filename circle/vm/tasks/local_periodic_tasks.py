@@ -21,15 +21,25 @@ from django.utils.translation import ugettext_noop
 
 from manager.mancelery import celery
 from vm.models import Node, Instance
+from vm.models.node import reconcile_allocations
 
 logger = logging.getLogger(__name__)
 
 
 @celery.task(ignore_result=True)
 def update_domain_states():
-    nodes = Node.objects.filter(enabled=True).all()
-    for node in nodes:
-        node.update_vm_states()
+    Node.update_all_vm_states()
+
+
+@celery.task(ignore_result=True)
+def reconcile_node_allocations():
+    """Correct the ledger of the memory and processor cores allocated on
+    each node with the sums of the database.
+    """
+    differed = reconcile_allocations()
+    if differed:
+        logger.warning("Allocations of %d nodes were reconciled.",
+                       len(differed))
 
 
 @celery.task(ignore_result=True)
@@ -53,3 +53,11 @@ def abortable_async_node_operation(task, operation_id, node_pk, activity_pk,
     allargs['task'] = task
 
     return operation._exec_op(allargs, auxargs)
+
+
+@celery.task
+def mass_deploy(instance_pks, user_pk):
+    from django.contrib.auth.models import User
+    from vm.models import Instance
+    instances = list(Instance.objects.filter(pk__in=instance_pks))
+    Instance._mass_deploy(instances, User.objects.get(pk=user_pk))
@@ -19,6 +19,7 @@ from django.core.cache import cache
 from logging import getLogger
 
 from manager.mancelery import celery
+from manager.presence import is_queue_alive
 
 logger = getLogger(__name__)
 
@@ -36,6 +37,9 @@ def check_queue(node_hostname, queue_id, priority=None):
     queue_name = node_hostname + "." + queue_id
     if priority is not None:
         queue_name = queue_name + "." + priority
+    alive = is_queue_alive(queue_name)
+    if alive is not None:
+        return alive
     active_queues = get_queues()
     if active_queues is None:
         return False
@@ -20,16 +20,30 @@ from mock import Mock, MagicMock, patch, call
 import types
 
 from celery.contrib.abortable import AbortableAsyncResult
+from celery.exceptions import TimeoutError
 from django.contrib.auth.models import User
-from django.test import TestCase
+from django.core.cache import cache
+from django.test import TestCase, override_settings
 from django.utils.translation import ugettext_lazy as _
 
+from common.models import WorkerNotFound
 from common.tests.celery_mock import MockCeleryMixin
+from common.tests.commit import run_commit_hooks
+from firewall.allocation import port_index_cache
+from monitor.metrics import local_metrics
+from manager import scheduler
 
 from ..models import (
     Lease, Node, Interface, Instance, InstanceTemplate, InstanceActivity,
+    Trait,
+)
+from ..models.instance import (
+    find_unused_port, find_unused_vnc_port, ActivityInProgressError,
+)
+from ..models.node import (
+    TraitIndex, get_allocations, get_trait_index, mask_traits,
+    reconcile_allocations, trait_mask,
 )
-from ..models.instance import find_unused_port, ActivityInProgressError
 from ..operations import (
     RemoteOperationMixin, DeployOperation, DestroyOperation, FlushOperation,
     MigrateOperation,
@@ -56,6 +70,259 @@ class PortFinderTestCase(TestCase):
         port = find_unused_port(port_range=r, used_ports=range(*r))
         assert port is None
 
+    @override_settings(VNC_PORT_RANGE=(1000, 1003))
+    def test_find_unused_vnc_port(self):
+        with patch('vm.models.instance.Instance.objects') as objects, \
+                patch('firewall.allocation.get_tokens') as get_tokens, \
+                patch('firewall.allocation.reserve_port') as reserve_port:
+            get_tokens.return_value = {'vnc': (None, None)}
+            reserve_port.side_effect = lambda key, port: port != 1000
+            objects.filter.return_value.values_list.return_value = [1001]
+            self.assertEqual(1002, find_unused_vnc_port())
+            objects.filter.return_value.values_list.return_value = [
+                1001, 1002]
+            self.assertRaises(Exception, find_unused_vnc_port)
+
+    @override_settings(VNC_PORT_RANGE=(1000, 1003))
+    def test_yield_vnc_port(self):
+        port_index_cache.pop('vnc', None)
+        with patch('vm.models.instance.Instance.objects') as objects:
+            objects.filter.return_value.values_list.return_value = [1001]
+            port = find_unused_vnc_port()
+            index = port_index_cache['vnc'][1]
+            self.assertFalse(index.is_free(port))
+            inst = MagicMock(spec=Instance, vnc_port=port)
+            Instance.yield_vnc_port.im_func(inst)
+            self.assertFalse(index.is_free(port))
+            run_commit_hooks()
+            self.assertTrue(index.is_free(port))
+            self.assertIsNone(inst.vnc_port)
+        port_index_cache.pop('vnc', None)
+
+
+class SchedulerTestCase(TestCase):
+
+    def _node(self, pk, priority):
+        node = MagicMock(pk=pk, priority=priority, schedule_enabled=True,
+                         online=True, ram_size=4096 * 1024 * 1024,
+                         byte_ram_usage=0, allocated_ram=0,
+                         ram_size_with_overcommit=4096 * 1024 * 1024,
+                         cpu_usage=0, num_cores=4)
+        node.traits.all.return_value = []
+        return node
+
+    def test_select_nodes_spreads_batch(self):
+        nodes = [self._node(1, 10), self._node(2, 5)]
+        insts = [MagicMock(ram_size=1024, num_cores=2) for i in range(4)]
+        for inst in insts:
+            inst.req_traits.all.return_value = []
+        self.assertEqual([1, 2, 1, 2],
+                         [n.pk for n in scheduler.select_nodes(insts, nodes)])
+
+    def test_select_nodes_not_enough_ram(self):
+        nodes = [self._node(1, 10)]
+        insts = [MagicMock(ram_size=3000, num_cores=1) for i in range(2)]
+        for inst in insts:
+            inst.req_traits.all.return_value = []
+        self.assertRaises(scheduler.NotEnoughMemoryException,
+                          scheduler.select_nodes, insts, nodes)
+
+    def test_select_nodes_reads_nodes_once(self):
+        nodes = [self._node(1, 10), self._node(2, 5)]
+        insts = [MagicMock(ram_size=512, num_cores=1) for i in range(6)]
+        for inst in insts:
+            inst.req_traits.all.return_value = []
+        scheduler.select_nodes(insts, nodes)
+        for node in nodes:
+            self.assertEqual(1, node.traits.all.call_count)
+
+    def test_select_nodes_spread_integer_cpu_usage(self):
+        nodes = [self._node(1, 10), self._node(2, 5)]
+        nodes[0].cpu_usage = 50
+        nodes[1].cpu_usage = 25
+        inst = MagicMock(ram_size=1024, num_cores=1)
+        inst.req_traits.all.return_value = []
+        self.assertEqual([2], [n.pk for n in scheduler.select_nodes(
+            [inst], nodes, 'spread')])
+
+    def test_select_nodes_pack(self):
+        nodes = [self._node(1, 10), self._node(2, 5)]
+        nodes[1].byte_ram_usage = 1024 * 1024 * 1024
+        insts = [MagicMock(ram_size=1024, num_cores=2) for i in range(3)]
+        for inst in insts:
+            inst.req_traits.all.return_value = []
+        self.assertEqual(
+            [2, 2, 1],
+            [n.pk for n in scheduler.select_nodes(insts, nodes, 'pack')])
+
+    def test_select_nodes_trait_affinity(self):
+        nodes = [self._node(1, 10), self._node(2, 5)]
+        nodes[0].traits.all.return_value = [MagicMock(pk=7)]
+        inst = MagicMock(ram_size=1024, num_cores=2)
+        inst.req_traits.all.return_value = []
+        self.assertEqual([2], [n.pk for n in scheduler.select_nodes(
+            [inst], nodes, 'trait_affinity')])
+        inst.req_traits.all.return_value = [MagicMock(pk=7)]
+        self.assertEqual([1], [n.pk for n in scheduler.select_nodes(
+            [inst], nodes, 'trait_affinity')])
+
+    def test_select_nodes_traits_unsatisfiable(self):
+        nodes = [self._node(1, 10)]
+        inst = MagicMock(ram_size=1024, num_cores=2)
+        inst.req_traits.all.return_value = [MagicMock(pk=7)]
+        self.assertRaises(scheduler.TraitsUnsatisfiableException,
+                          scheduler.select_nodes, [inst], nodes)
+
+    def test_select_nodes_skips_incorrect_monitoring_data(self):
+        nodes = [self._node(1, 10), self._node(2, 5)]
+        nodes[0].byte_ram_usage = None
+        inst = MagicMock(ram_size=1024, num_cores=2)
+        inst.req_traits.all.return_value = []
+        self.assertEqual([2], [n.pk for n in scheduler.select_nodes(
+            [inst], nodes)])
+
+
+class TraitIndexTestCase(TestCase):
+    fixtures = ['test-vm-fixture.json', 'node.json']
+
+    def test_trait_mask(self):
+        self.assertEqual(0, trait_mask([]))
+        self.assertEqual(0b1010, trait_mask([1, MagicMock(pk=3)]))
+        self.assertEqual([1, 3], mask_traits(0b1010))
+
+    def test_has_traits(self):
+        index = TraitIndex([(1, 1), (1, 3), (2, 3)])
+        self.assertTrue(index.has_traits(1, trait_mask([1, 3])))
+        self.assertFalse(index.has_traits(2, trait_mask([1, 3])))
+        self.assertTrue(index.has_traits(5, 0))
+        self.assertEqual(trait_mask([1]),
+                         index.missing_traits(2, trait_mask([1, 3])))
+        nodes = [MagicMock(pk=i) for i in range(1, 4)]
+        self.assertEqual(nodes[:2],
+                         index.filter_nodes(nodes, trait_mask([3])))
+
+    @override_settings(CACHES={'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+    def test_trait_index_invalidation(self):
+        cache.clear()
+        node = Node.objects.get(pk=1)
+        trait = Trait.objects.create(name='testtrait')
+        index = get_trait_index()
+        self.assertIs(index, get_trait_index())
+        self.assertFalse(index.has_traits(node, trait_mask([trait])))
+        node.traits.add(trait)
+        # the index is touched when the transaction is committed
+        self.assertIs(index, get_trait_index())
+        run_commit_hooks()
+        self.assertTrue(get_trait_index().has_traits(
+            node, trait_mask([trait])))
+        trait.delete()
+        run_commit_hooks()
+        self.assertEqual(0, get_trait_index().get_mask(node))
+        cache.clear()
+
+
+@override_settings(CACHES={'default': {
+    'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+class NodeAllocationTestCase(TestCase):
+    fixtures = ['test-vm-fixture.json', 'node.json']
+
+    def setUp(self):
+        cache.clear()
+        self.node = Node.objects.get(pk=1)
+        self.inst = Instance.objects.get(pk=1)
+
+    def tearDown(self):
+        cache.clear()
+
+    def test_ledger_follows_instances(self):
+        self.assertEqual(0, self.node.allocated_ram)
+        self.inst.node = self.node
+        self.inst.save()
+        self.assertEqual(200 * 1024 * 1024, self.node.allocated_ram)
+        self.assertEqual(2, self.node.allocated_cores)
+
+        inst = Instance.objects.only('status').get(pk=1)
+        inst.ram_size = 300
+        inst.save()
+        self.assertEqual(300 * 1024 * 1024, self.node.allocated_ram)
+
+        inst = Instance.objects.get(pk=1)
+        inst.node = None
+        inst.save()
+        self.assertEqual((0, 0), get_allocations([self.node])[self.node.pk])
+
+    def test_ledger_read_from_cache(self):
+        self.node.allocated_ram
+        with self.assertNumQueries(0):
+            self.node.allocated_ram
+
+    def test_reconcile_allocations(self):
+        self.assertEqual(0, self.node.allocated_ram)
+        Instance.objects.filter(pk=1).update(node=self.node)
+        self.assertEqual(0, self.node.allocated_ram)
+        self.assertEqual([self.node.pk], reconcile_allocations())
+        self.assertEqual(200 * 1024 * 1024, self.node.allocated_ram)
+        self.assertEqual([], reconcile_allocations())
+
+
+class NodeDomainStatesTestCase(TestCase):
+    fixtures = ['test-vm-fixture.json', 'node.json']
+
+    def test_query_domain_states(self):
+        nodes = [MagicMock(spec=Node) for i in range(3)]
+        for i, node in enumerate(nodes):
+            node.get_remote_queue_name.return_value = 'node%d.vm.fast' % i
+        nodes[2].get_remote_queue_name.side_effect = WorkerNotFound()
+        results = [Mock(), Mock()]
+        results[0].get.return_value = [
+            {'name': 'cloud-1', 'state': 'RUNNING'},
+            {'name': 'foo', 'state': 'RUNNING'}]
+        results[1].get.side_effect = TimeoutError()
+        with patch('vm.models.node.vm_tasks.list_domains_info') as task:
+            task.apply_async.side_effect = results
+            self.assertEqual({nodes[0]: {1: 'RUNNING'}},
+                             Node.query_domain_states(nodes))
+        self.assertEqual(2, task.apply_async.call_count)
+
+    def test_apply_domain_states(self):
+        node = Node.objects.get(pk=1)
+        Instance.objects.filter(pk__in=[1, 12]).update(node=node,
+                                                       status='STOPPED')
+        with patch.object(Instance, 'vm_state_changed',
+                          autospec=True) as vm_state_changed:
+            Node.apply_domain_states({node: {1: 'RUNNING', 404: 'RUNNING'}},
+                                     batch_size=1)
+        self.assertEqual(
+            [(1, 'RUNNING', False), (12, 'STOPPED', None)],
+            sorted((args[0].pk, ) + args[1:]
+                   for args, kwargs in vm_state_changed.call_args_list))
+
+    def test_apply_domain_states_failure(self):
+        node = Node.objects.get(pk=1)
+        Instance.objects.filter(pk__in=[1, 12]).update(node=node,
+                                                       status='STOPPED')
+
+        def vm_state_changed(instance, state, node):
+            Instance.objects.filter(pk=instance.pk).update(status=state)
+            if instance.pk == 1:
+                raise Exception('failed')
+
+        with patch.object(Instance, 'vm_state_changed', autospec=True,
+                          side_effect=vm_state_changed):
+            Node.apply_domain_states({node: {1: 'RUNNING', 12: 'RUNNING'}})
+        self.assertEqual('STOPPED', Instance.objects.get(pk=1).status)
+        self.assertEqual('RUNNING', Instance.objects.get(pk=12).status)
+
+    def test_apply_domain_states_moved(self):
+        node = Node.objects.get(pk=1)
+        Instance.objects.filter(pk=1).update(node=None, status='STOPPED')
+        with patch.object(Instance, 'vm_state_changed',
+                          autospec=True) as vm_state_changed:
+            Node.apply_domain_states({node: {1: 'RUNNING'}})
+        instance, state, new_node = vm_state_changed.call_args[0]
+        self.assertEqual((1, 'RUNNING', node), (instance.pk, state, new_node))
+
 
 class TemplateTestCase(TestCase):
 
@@ -231,6 +498,27 @@ class NodeTestCase(TestCase):
         self.assertEqual(Node.get_state(node), "ACTIVE")
         assert isinstance(Node.get_status_display(node), _("x").__class__)
 
+    @override_settings(GRAPHITE_URL='http://graphite/render/')
+    def test_monitor_info_fetched_once(self):
+        local_metrics.clear()
+        nodes = [MagicMock(spec=Node, enabled=True, online=True)
+                 for i in range(2)]
+        nodes[0].host.hostname = 'node1'
+        nodes[1].host.hostname = 'node2'
+        with patch('monitor.metrics.requests.get') as get:
+            get.return_value.json.return_value = [
+                {'target': 'circle.node1.cpu.percent',
+                 'datapoints': [[20.0, 1], [50.0, 2], [None, 3]]},
+                {'target': 'circle.node2.memory.usage',
+                 'datapoints': [[30.0, 1], [None, 2], [None, 3]]},
+            ]
+            self.assertEqual({'cpu.percent': 50.0},
+                             Node.monitor_info.fget(nodes[0]))
+            self.assertEqual({'memory.usage': 30.0},
+                             Node.monitor_info.fget(nodes[1]))
+        self.assertEqual(1, get.call_count)
+        local_metrics.clear()
+
 
 class InstanceActivityTestCase(TestCase):
 
@@ -15,6 +15,9 @@
 # You should have received a copy of the GNU General Public License along
 # with CIRCLE.  If not, see <http://www.gnu.org/licenses/>.
 
+from copy import copy
+
+from django.contrib.auth.models import User
 from django.test import TestCase
 from mock import MagicMock
 
@@ -22,8 +25,9 @@ from common.operations import operation_registry_name as op_reg_name
 from vm.models import Instance, InstanceActivity, Node
 from vm.operations import (
     DeployOperation, DestroyOperation, FlushOperation, MigrateOperation,
-    RebootOperation, ResetOperation, SaveAsTemplateOperation,
-    ShutdownOperation, ShutOffOperation, SleepOperation, WakeUpOperation,
+    RebootOperation, RecoverOperation, ResetOperation,
+    SaveAsTemplateOperation, ShutdownOperation, ShutOffOperation,
+    SleepOperation, WakeUpOperation,
 )
 from test_models import DiskQuerySet
 
@@ -106,3 +110,58 @@ class SleepOperationTestCase(TestCase):
 class WakeUpOperationTestCase(TestCase):
     def test_operation_registered(self):
         assert WakeUpOperation.id in getattr(Instance, op_reg_name)
+
+
+class InstanceOperationAvailabilityTestCase(TestCase):
+    def setUp(self):
+        self.user = User.objects.create(username='user')
+
+    def get_instance(self, pk, status):
+        inst = MagicMock(spec=Instance, pk=pk, status=status,
+                         destroyed_at=None, node=None, node_id=None)
+        inst.WrongStateError = Instance.WrongStateError
+        inst.get_user_weights.return_value = {pk: 2}
+        inst.has_level.return_value = True
+        return inst
+
+    def test_shared_by_state(self):
+        running1 = self.get_instance(1, 'RUNNING')
+        running2 = self.get_instance(2, 'RUNNING')
+        stopped = self.get_instance(3, 'STOPPED')
+        self.assertIsNone(ShutOffOperation(running1).get_availability(
+            self.user))
+        self.assertIsNone(ShutOffOperation(running2).get_availability(
+            self.user))
+        assert running1.has_level.called
+        assert not running2.has_level.called
+        self.assertIsInstance(
+            ShutOffOperation(stopped).get_availability(self.user),
+            Instance.WrongStateError)
+
+    def test_level_change(self):
+        inst = self.get_instance(1, 'RUNNING')
+        self.assertIsNone(ShutOffOperation(inst).get_availability(self.user))
+        inst.get_user_weights.return_value = {1: 0}
+        inst.has_level.return_value = False
+        self.assertIsNotNone(
+            ShutOffOperation(inst).get_availability(self.user))
+
+    def test_remote_operation_key(self):
+        inst = self.get_instance(1, 'RUNNING')
+        inst.node_id = 1
+        key = RebootOperation(inst).get_availability_key(self.user)
+        self.assertEqual(key[-2:], (1, RebootOperation.remote_queue))
+
+    def test_overridden_checks_not_shared(self):
+        inst = self.get_instance(1, 'DESTROYED')
+        self.assertIsNone(
+            RecoverOperation(inst).get_availability_key(self.user))
+
+
+class BoundOperationTestCase(TestCase):
+    def test_not_copied(self):
+        inst = Instance(pk=1)
+        op = inst.shut_off
+        self.assertIs(inst.shut_off, op)
+        clone = copy(inst)
+        self.assertIs(clone.shut_off.instance, clone)